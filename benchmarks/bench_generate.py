@@ -0,0 +1,331 @@
+"""
+Benchmark the real `yoda generate` code path against the local fake services of benchmarks/fakes.py.
+
+Every combination of panel count and concurrency is run --repeat times in a fresh working directory with caching
+disabled. Each run reports panels/sec, the p95 latency of renders and inference requests taken from the trace of
+the run, and the peak RSS and process count of the whole process tree, sampled every 50ms from /proc (Linux only).
+Results are appended as json lines to --output so runs of different revisions can be compared with --baseline.
+
+Usage:
+    python benchmarks/bench_generate.py --panels 50,200 --concurrency 1,8,32
+    python benchmarks/bench_generate.py --panels 200 --concurrency 16 --inference ollama --slides --output results.jsonl
+    python benchmarks/bench_generate.py --panels 200 --concurrency 16 --baseline results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import click
+import yaml
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.tracing import summarize_spans
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SAMPLE_INTERVAL = 0.05
+
+def start_fake(kind: str, options: list[str]) -> tuple[subprocess.Popen, str]:
+    """
+    Start a fake server of benchmarks/fakes.py in its own process.
+
+    Args:
+        kind (str): grafana, inference or google
+        options (list[str]): command line options of the server
+
+    Returns:
+        tuple[subprocess.Popen, str]: server process and its root url
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fakes.py"), kind, *options], stdout=subprocess.PIPE, text=True)
+    port = process.stdout.readline().strip()
+    if not port:
+        raise click.ClickException(f"The fake {kind} server failed to start")
+    return process, f"http://127.0.0.1:{port}"
+
+def process_tree(root_pid: int) -> list[int]:
+    """
+    Pids of a process and all of its descendants.
+
+    Args:
+        root_pid (int): pid of the root process
+
+    Returns:
+        list[int]: pids of the tree
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as stat_file:
+                # The command name is in parentheses and may contain spaces
+                ppid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(children.get(pid, []))
+    return tree
+
+def rss_bytes(pid: int) -> int:
+    """
+    Resident memory of a process.
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        int: resident set size in bytes, 0 if the process is gone
+    """
+    try:
+        with open(f"/proc/{pid}/status", "r") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def write_workdir(workdir: str, grafana_url: str, panels: int, slides: bool) -> tuple[str, str]:
+    """
+    Write the config, slide mapping and token of a run.
+
+    Args:
+        workdir (str): working directory of the run
+        grafana_url (str): root url of the fake grafana
+        panels (int): number of panels to export
+        slides (bool): also write a slide mapping of every panel
+
+    Returns:
+        tuple[str, str]: config and slide mapping paths
+    """
+    output = os.path.join(workdir, "panels")
+    config = {"grafana": [{
+        "alias": "bench",
+        "url": grafana_url,
+        "username": "bench",
+        "password": "bench",
+        "dashboards": [{
+            "alias": f"bench-{panels}",
+            "raw_url": f"{grafana_url}/d/bench-{panels}/bench?orgId=1&from=1700000000000&to=1700600000000",
+            "output": output,
+            "panels": [{"id": panel_id, "alias": f"Panel {panel_id}"} for panel_id in range(1, panels + 1)],
+        }],
+    }]}
+    config_path = os.path.join(workdir, "config.yaml")
+    with open(config_path, "w") as config_file:
+        yaml.safe_dump(config, config_file)
+
+    mapping_path = os.path.join(workdir, "slide_content_mapping.yaml")
+    if slides:
+        mapping = {"slide_info": {f"slide_{idx}": {
+            "images": {f"image_{idx}": os.path.join(output, f"panel_{idx + 1}_Panel {idx + 1}.png")},
+            "texts": {f"text_{idx}": f"Panel {idx + 1}"},
+        } for idx in range(panels)}}
+        with open(mapping_path, "w") as mapping_file:
+            yaml.safe_dump(mapping, mapping_file)
+        # A token far from expiry is used as is, so neither a refresh nor an oauth flow is started
+        with open(os.path.join(workdir, "token.json"), "w") as token_file:
+            json.dump({"token": "bench", "refresh_token": "bench", "client_id": "bench", "client_secret": "bench", "expiry": "2099-01-01T00:00:00Z"}, token_file)
+    return config_path, mapping_path
+
+def load_trace(path: str) -> dict[str, dict]:
+    """
+    Summarize the spans of a chrome trace exported by --trace.
+
+    Args:
+        path (str): trace json file
+
+    Returns:
+        dict[str, dict]: summarize_spans of the trace, empty if there is no trace
+    """
+    try:
+        with open(path, "r") as trace_file:
+            events = json.load(trace_file)["traceEvents"]
+    except (OSError, ValueError, KeyError):
+        return {}
+    return summarize_spans([{"name": event["name"], "duration": event["dur"] / 1e6, "attributes": event["args"]}
+                            for event in events if event.get("ph") == "X"])
+
+def run_generate(urls: dict[str, str], panels: int, concurrency: int, kwargs: dict) -> dict:
+    """
+    Run generate once and measure it.
+
+    Args:
+        urls (dict[str, str]): root urls of the fake servers
+        panels (int): number of panels to export
+        concurrency (int): --concurrency of the run
+        kwargs (dict): benchmark options
+
+    Returns:
+        dict: measurements of the run
+    """
+    workdir = tempfile.mkdtemp(prefix="yoda-bench-")
+    try:
+        config_path, mapping_path = write_workdir(workdir, urls["grafana"], panels, kwargs["slides"])
+        csv_path = os.path.join(workdir, "out.csv")
+        command = [sys.executable, os.path.join(BENCH_DIR, "run_generate.py")]
+        if kwargs["slides"]:
+            command += ["--google-url", urls["google"]]
+        command += ["--", "--config", config_path, "--csv", csv_path, "--concurrency", str(concurrency),
+                    "--executor", kwargs["executor"], "--no-cache", "--trace"]
+        if kwargs["inference"] != "none":
+            command += ["--inference", "--inference-endpoint", urls["inference"], "--inference-model-type", kwargs["inference"], "--inference-model", "bench"]
+        if kwargs["slides"]:
+            command += ["--presentation", f"bench-{panels}", "--slidemapping", mapping_path]
+        command += shlex.split(kwargs["extra_args"])
+
+        peak_rss = 0
+        peak_processes = 0
+        with open(os.path.join(workdir, "generate.log"), "w") as log_file:
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT)
+            while process.poll() is None:
+                tree = process_tree(process.pid)
+                peak_processes = max(peak_processes, len(tree))
+                peak_rss = max(peak_rss, sum(rss_bytes(pid) for pid in tree))
+                time.sleep(SAMPLE_INTERVAL)
+            wall_time = time.perf_counter() - start
+        if process.returncode != 0:
+            with open(os.path.join(workdir, "generate.log"), "r") as log_file:
+                raise click.ClickException(f"generate exited with {process.returncode}:\n{log_file.read()[-2000:]}")
+
+        with open(csv_path, "r") as csv_file:
+            exported = max(0, sum(1 for _ in csv_file) - 1)
+        stages = load_trace(os.path.join(workdir, "out.trace.json"))
+        # Panels are queried instead of rendered with --data-mode
+        render_stage = "query" if "query" in stages else "render"
+        inference_stage = "inference request" if "inference request" in stages else "inference"
+        return {
+            "wall_time": wall_time,
+            "exported": exported,
+            "panels_per_sec": exported / wall_time,
+            "p95_render": stages.get(render_stage, {}).get("quantiles", {}).get(0.95),
+            "p95_inference": stages.get(inference_stage, {}).get("quantiles", {}).get(0.95),
+            "peak_rss_mb": peak_rss / (1024 * 1024),
+            "peak_processes": peak_processes,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def median_of(runs: list[dict], key: str) -> float | None:
+    values = [run[key] for run in runs if run[key] is not None]
+    return statistics.median(values) if values else None
+
+def result_key(result: dict) -> tuple:
+    return (result["panels"], result["concurrency"], result["executor"], result["inference"], result["slides"], result["extra_args"])
+
+def load_baseline(path: str) -> dict[tuple, dict]:
+    """
+    Load the latest result of every configuration from a results file.
+
+    Args:
+        path (str): json lines file written by --output
+
+    Returns:
+        dict[tuple, dict]: results keyed by configuration
+    """
+    baseline = {}
+    with open(path, "r") as results_file:
+        for line in results_file:
+            if line.strip():
+                result = json.loads(line)
+                baseline[result_key(result)] = result
+    return baseline
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def format_value(value: float | None, fmt: str) -> str:
+    return "n/a" if value is None else format(value, fmt)
+
+@click.command()
+@click.option("--panels", default="50,200", help="Comma separated panel counts")
+@click.option("--concurrency", default="1,8,32", help="Comma separated --concurrency values")
+@click.option("--executor", type=click.Choice(["thread", "process"]), default="thread", help="Worker pool backend of generate")
+@click.option("--inference", type=click.Choice(["none", "vllm", "ollama", "llama.cpp"]), default="vllm", help="Inference api to exercise")
+@click.option("--slides", is_flag=True, help="Also publish every panel to a fake presentation")
+@click.option("--extra-args", default="", help="Additional generate options, e.g. '--inference-batch-size 8'")
+@click.option("--repeat", type=int, default=3, help="Runs per configuration, the median is reported")
+@click.option("--render-latency", type=float, default=0.2, help="Latency of a grafana render in seconds")
+@click.option("--inference-latency", type=float, default=1.0, help="Latency of an inference request in seconds")
+@click.option("--google-latency", type=float, default=0.05, help="Latency of a slides or drive request in seconds")
+@click.option("--jitter", type=float, default=0.05, help="Maximum random latency added to every request in seconds")
+@click.option("--capacity", type=int, default=16, help="Concurrent renders and inference requests served before latencies grow, 0 for no limit")
+@click.option("--image-size", default="1280x720", help="WIDTHxHEIGHT of the rendered panels")
+@click.option("--seed", type=int, default=42, help="Random seed of the fake servers")
+@click.option("--output", default="", help="Json lines file to append the results to")
+@click.option("--baseline", default="", help="Results file to compare panels/sec against")
+def main(**kwargs):
+    """
+    Benchmark generate at different panel counts and concurrency levels.
+    """
+    common = ["--jitter", str(kwargs["jitter"]), "--seed", str(kwargs["seed"])]
+    fakes = {
+        "grafana": start_fake("grafana", common + ["--latency", str(kwargs["render_latency"]), "--capacity", str(kwargs["capacity"]), "--image-size", kwargs["image_size"]]),
+        "inference": start_fake("inference", common + ["--latency", str(kwargs["inference_latency"]), "--capacity", str(kwargs["capacity"])]),
+        "google": start_fake("google", common + ["--latency", str(kwargs["google_latency"])]),
+    }
+    urls = {kind: url for kind, (_, url) in fakes.items()}
+    baseline = load_baseline(kwargs["baseline"]) if kwargs["baseline"] else {}
+    environment = {"revision": git_revision(), "python": platform.python_version(), "cpus": os.cpu_count()}
+
+    headers = ["Panels", "Concurrency", "Wall (s)", "Panels/s", "p95 render (s)", "p95 inference (s)", "Peak RSS (MB)", "Processes"]
+    if baseline:
+        headers.append("vs baseline")
+    data = [headers]
+    try:
+        for panels in [int(value) for value in kwargs["panels"].split(",")]:
+            for concurrency in [int(value) for value in kwargs["concurrency"].split(",")]:
+                runs = [run_generate(urls, panels, concurrency, kwargs) for _ in range(max(1, kwargs["repeat"]))]
+                result = {
+                    "panels": panels,
+                    "concurrency": concurrency,
+                    "executor": kwargs["executor"],
+                    "inference": kwargs["inference"],
+                    "slides": kwargs["slides"],
+                    "extra_args": kwargs["extra_args"],
+                    "repeat": len(runs),
+                    "wall_time": median_of(runs, "wall_time"),
+                    "panels_per_sec": median_of(runs, "panels_per_sec"),
+                    "p95_render": median_of(runs, "p95_render"),
+                    "p95_inference": median_of(runs, "p95_inference"),
+                    "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+                    "peak_processes": max(run["peak_processes"] for run in runs),
+                    "exported": min(run["exported"] for run in runs),
+                    **environment,
+                }
+                row = [panels, concurrency, format_value(result["wall_time"], ".2f"), format_value(result["panels_per_sec"], ".1f"),
+                       format_value(result["p95_render"], ".3f"), format_value(result["p95_inference"], ".3f"),
+                       format_value(result["peak_rss_mb"], ".0f"), result["peak_processes"]]
+                if baseline:
+                    previous = baseline.get(result_key(result))
+                    row.append(f"{result['panels_per_sec'] / previous['panels_per_sec']:.2f}x ({previous['revision']})" if previous else "n/a")
+                data.append(row)
+                if result["exported"] < panels:
+                    click.echo(f"Only {result['exported']} of {panels} panels were exported at concurrency {concurrency}", err=True)
+                if kwargs["output"]:
+                    with open(kwargs["output"], "a") as results_file:
+                        results_file.write(json.dumps(result) + "\n")
+    finally:
+        for process, _ in fakes.values():
+            process.terminate()
+            process.wait()
+
+    print(f"Revision {environment['revision']}, python {environment['python']}, {environment['cpus']} cpus, "
+          f"executor {kwargs['executor']}, inference {kwargs['inference']}, slides {kwargs['slides']}, median of {kwargs['repeat']} runs")
+    print(tabulate(data, headers="firstrow", tablefmt="grid"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark the persistent executor in utils.utils against the legacy
+chunked mp.Process + mp.Manager implementation of multi_process.
+
+Jobs sleep for a randomized amount of time to mimic network bound work
+such as panel renders and inference calls.
+
+Usage:
+    python benchmarks/bench_multi_process.py --items 200 --concurrency 8
+"""
+import os
+import sys
+import time
+import random
+import click
+import multiprocessing as mp
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.utils import create_executor, multi_process
+
+def sleep_job(each_item: float, args: tuple) -> float:
+    """
+    Job that sleeps for the given duration.
+
+    Args:
+        each_item (float): seconds to sleep
+        args (tuple): unused job arguments
+
+    Returns:
+        float: slept duration
+    """
+    time.sleep(each_item)
+    return each_item
+
+def legacy_sleep_job(each_item: float, args: tuple, return_dict: dict, idx: int) -> None:
+    """
+    Legacy style job writing its result into a proxied dictionary.
+
+    Args:
+        each_item (float): seconds to sleep
+        args (tuple): unused job arguments
+        return_dict (dict): shared dictionary across the processes
+        idx (int): unique index to store process data
+
+    Returns:
+        None
+    """
+    return_dict[idx] = sleep_job(each_item, args)
+
+def legacy_multi_process(chunk: list, job: callable, args: tuple) -> list:
+    """
+    The previous implementation of utils.utils.multi_process.
+
+    Args:
+        chunk (list): chunk of work to process
+        job (function): job to execute
+        args (tuple): list of arguments for the job
+
+    Returns:
+        list: results of the chunk
+    """
+    manager = mp.Manager()
+    return_dict = manager.dict()
+    jobs = []
+    for idx, each_item in enumerate(chunk):
+        process = mp.Process(target=job, args=(each_item, args, return_dict, idx))
+        jobs.append(process)
+        process.start()
+    for proc in jobs:
+        proc.join()
+    return list(return_dict.values())
+
+def run_legacy(items: list, concurrency: int) -> int:
+    """
+    Run the items chunk by chunk with the legacy implementation.
+
+    Args:
+        items (list): durations to process
+        concurrency (int): chunk size
+
+    Returns:
+        int: number of results
+    """
+    results = []
+    for i in range(0, len(items), concurrency):
+        results.extend(legacy_multi_process(items[i:i + concurrency], legacy_sleep_job, ()))
+    return len(results)
+
+def run_executor(items: list, concurrency: int, backend: str) -> int:
+    """
+    Run the items as one stream on a persistent executor.
+
+    Args:
+        items (list): durations to process
+        concurrency (int): number of workers
+        backend (str): executor backend
+
+    Returns:
+        int: number of results
+    """
+    with create_executor(backend, concurrency) as executor:
+        return len(multi_process(items, sleep_job, (), executor))
+
+@click.command()
+@click.option("--items", type=int, default=200, help="Number of jobs to run")
+@click.option("--concurrency", type=int, default=8, help="Number of parallel workers")
+@click.option("--min-latency", type=float, default=0.01, help="Minimum job duration in seconds")
+@click.option("--max-latency", type=float, default=0.2, help="Maximum job duration in seconds")
+@click.option("--seed", type=int, default=42, help="Random seed for job durations")
+def main(**kwargs):
+    """
+    Compare the legacy and executor based multi_process implementations.
+    """
+    rng = random.Random(kwargs["seed"])
+    items = [rng.uniform(kwargs["min_latency"], kwargs["max_latency"]) for _ in range(kwargs["items"])]
+    concurrency = kwargs["concurrency"]
+    ideal = sum(items) / concurrency
+
+    data = [["Implementation", "Jobs", "Wall time (s)", "Jobs/s", "Overhead vs ideal"]]
+    for name, runner in [
+        ("legacy mp.Process + Manager", lambda: run_legacy(items, concurrency)),
+        ("executor (process)", lambda: run_executor(items, concurrency, "process")),
+        ("executor (thread)", lambda: run_executor(items, concurrency, "thread")),
+    ]:
+        start = time.perf_counter()
+        count = runner()
+        elapsed = time.perf_counter() - start
+        data.append([name, count, f"{elapsed:.2f}", f"{count / elapsed:.1f}", f"{elapsed / ideal:.2f}x"])
+    print(f"Ideal wall time with {concurrency} workers: {ideal:.2f}s")
+    print(tabulate(data, headers="firstrow", tablefmt="grid"))
+
+if __name__ == "__main__":
+    main()
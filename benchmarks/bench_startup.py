@@ -0,0 +1,152 @@
+"""
+Benchmark the startup cost of every yoda subcommand with `python -X importtime`.
+
+Each command is run for real in a scratch directory with inputs that make it return right after its imports:
+an empty grafana config for generate, an unreachable grafana for preview-dashboard and missing google credentials
+for the presentation commands. The import time of the run is the sum of the top level imports reported by
+-X importtime, and the median over --repeat runs is checked against the budget of the command. The heaviest
+modules of a command over its budget are listed, and the exit code is 1 so CI fails on startup regressions.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --top 15
+    python benchmarks/bench_startup.py --command preview-dashboard --budget preview-dashboard=150
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import statistics
+import subprocess
+import tempfile
+import click
+from tabulate import tabulate
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Arguments of every command, {workdir} is replaced with the scratch directory
+COMMANDS = {
+    "help": ["--help"],
+    "generate": ["generate", "--config", "{workdir}/config.yaml", "--csv", "{workdir}/out.csv", "--no-cache"],
+    "preview-dashboard": ["preview-dashboard", "--url", "http://127.0.0.1:9/d/uid/dashboard"],
+    "preview-presentation": ["preview-presentation", "--id", "presentation", "--credentials", "{workdir}/missing.json"],
+    "update-presentation": ["update-presentation", "--id", "presentation", "--credentials", "{workdir}/missing.json",
+                            "--slidemapping", "{workdir}/slides.yaml", "--no-cache"],
+}
+
+# Import time budgets in milliseconds. Help only needs click, preview-dashboard adds requests, generate adds the
+# pipeline and yaml but not numpy, and the presentation commands the google clients.
+BUDGETS = {
+    "help": 150,
+    "generate": 500,
+    "preview-dashboard": 400,
+    "preview-presentation": 750,
+    "update-presentation": 750,
+}
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+def write_workdir(workdir: str) -> None:
+    """
+    Write the inputs of the commands to the scratch directory.
+
+    Args:
+        workdir (str): scratch directory
+
+    Returns:
+        None
+    """
+    with open(os.path.join(workdir, "config.yaml"), "w", encoding="utf-8") as file:
+        file.write("grafana: []\n")
+    with open(os.path.join(workdir, "slides.yaml"), "w", encoding="utf-8") as file:
+        file.write("slide_info: {}\n")
+
+def parse_import_times(stderr: str) -> tuple[float, dict[str, float]]:
+    """
+    Parse the -X importtime report of a run.
+
+    Args:
+        stderr (str): stderr of the run
+
+    Returns:
+        tuple[float, dict[str, float]]: total import time and the cumulative time of every module, in milliseconds
+    """
+    total = 0.0
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1000
+        modules[match.group(4)] = cumulative
+        # Nested imports are included in the cumulative time of the top level import that triggered them
+        if len(match.group(3)) == 1:
+            total += cumulative
+    return total, modules
+
+def run_command(name: str, workdir: str) -> dict:
+    """
+    Run a yoda command once with -X importtime.
+
+    Args:
+        name (str): key of COMMANDS
+        workdir (str): scratch directory, also the working directory of the run
+
+    Returns:
+        dict: import time and wall time in milliseconds, and the cumulative import time of every module
+    """
+    args = [arg.replace("{workdir}", workdir) for arg in COMMANDS[name]]
+    # Bytecode must be written for the warm-up run to leave measured runs with imports only, even when the caller disabled it
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(REPO_DIR, "main.py"), *args],
+                            cwd=workdir, env=env, capture_output=True, text=True, timeout=120)
+    wall = 1000 * (time.perf_counter() - started)
+    total, modules = parse_import_times(result.stderr)
+    return {"imports": total, "wall": wall, "modules": modules}
+
+@click.command()
+@click.option("--command", "commands", multiple=True, type=click.Choice(list(COMMANDS)), help="Command to measure, repeatable. Defaults to every command")
+@click.option("--repeat", type=int, default=5, help="Runs per command, the median is reported")
+@click.option("--budget", "budgets", multiple=True, help="Override a budget as command=milliseconds, repeatable")
+@click.option("--top", type=int, default=10, help="Heaviest modules listed for a command over its budget")
+def main(**kwargs):
+    """
+    Measure the import time of every yoda subcommand against its budget.
+    """
+    budgets = dict(BUDGETS)
+    for each_budget in kwargs["budgets"]:
+        name, _, value = each_budget.partition("=")
+        if name not in COMMANDS or not value:
+            raise click.BadParameter(f"expected command=milliseconds with a command of {', '.join(COMMANDS)}", param_hint="--budget")
+        budgets[name] = float(value)
+
+    workdir = tempfile.mkdtemp(prefix="yoda-bench-startup-")
+    try:
+        write_workdir(workdir)
+        rows = [["Command", "Imports (ms)", "Wall (ms)", "Budget (ms)", "Status"]]
+        over_budget = {}
+        for name in kwargs["commands"] or COMMANDS:
+            # The first run of every command compiles its modules and warms the file system caches
+            run_command(name, workdir)
+            runs = [run_command(name, workdir) for _ in range(max(1, kwargs["repeat"]))]
+            imports = statistics.median(run["imports"] for run in runs)
+            wall = statistics.median(run["wall"] for run in runs)
+            status = "ok" if imports <= budgets[name] else "over budget"
+            rows.append([name, f"{imports:.0f}", f"{wall:.0f}", f"{budgets[name]:.0f}", status])
+            if status != "ok":
+                over_budget[name] = runs[-1]["modules"]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(tabulate(rows, headers="firstrow", tablefmt="grid"))
+    for name, modules in over_budget.items():
+        heaviest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:kwargs["top"]]
+        print(f"\nHeaviest imports of {name}:")
+        print(tabulate([["Module", "Cumulative (ms)"]] + [[module, f"{value:.1f}"] for module, value in heaviest], headers="firstrow", tablefmt="grid"))
+    sys.exit(1 if over_budget else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Local stand-ins for the services yoda talks to, used by the benchmarks.
+
+    grafana    /api/dashboards/uid/<uid>, its /versions, /render/d-solo/<uid> and /api/ds/query.
+               A dashboard uid of the form bench-<N> has N panels with ids 1..N.
+    inference  vLLM (/v1/chat/completions), Ollama (/api/generate) and llama.cpp (/completion).
+    google     Slides (presentations get and batchUpdate) and Drive (uploads, permissions and batch requests).
+               A presentation id of the form bench-<N> has N slides, slide_<i> holding image_<i> and text_<i>.
+
+Every server adds a configurable latency with jitter. When more than --capacity requests are in flight,
+latencies grow with the overload like a saturated backend.
+
+Usage:
+    python benchmarks/fakes.py grafana --port 3000 --latency 0.2 --image-size 1280x720
+    python benchmarks/fakes.py inference --port 8000 --latency 1.5
+    python benchmarks/fakes.py google --port 9000 --latency 0.1
+"""
+import io
+import re
+import sys
+import json
+import time
+import random
+import threading
+import click
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from PIL import Image
+
+class FakeBackend:
+    """
+    Latency model shared by the requests of a fake server.
+    """
+
+    def __init__(self, latency: float, jitter: float, capacity: int, seed: int) -> None:
+        """
+        Initialize the backend.
+
+        Args:
+            latency (float): base latency of a request in seconds
+            jitter (float): maximum random latency added to every request in seconds
+            capacity (int): requests served concurrently before latencies grow, 0 for no limit
+            seed (int): random seed of the jitter
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.capacity = capacity
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+
+    def serve(self, scale: float = 1.0) -> None:
+        """
+        Block for the latency of a request.
+
+        Args:
+            scale (float): multiplier of the base latency
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+            in_flight = self.in_flight
+            jitter = self.random.uniform(0, self.jitter)
+        overload = in_flight / self.capacity if self.capacity and in_flight > self.capacity else 1.0
+        try:
+            time.sleep((self.latency * scale + jitter) * overload)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+def render_png(image_size: str, seed: int) -> bytes:
+    """
+    Render a noisy chart-like png so the image has a realistic encoded size.
+
+    Args:
+        image_size (str): WIDTHxHEIGHT of the image
+        seed (int): random seed of the noise
+
+    Returns:
+        bytes: encoded png
+    """
+    width, height = (int(value) for value in image_size.lower().split("x"))
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), (24, 27, 31))
+    pixels = image.load()
+    level = height // 2
+    for x in range(width):
+        level = min(height - 1, max(0, level + rng.randint(-3, 3)))
+        for y in range(level, height, 2):
+            pixels[x, y] = (115, 191, 105)
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+def bench_dashboard(uid: str) -> dict | None:
+    """
+    Dashboard served for a bench-<N> uid.
+
+    Args:
+        uid (str): dashboard uid
+
+    Returns:
+        dict | None: dashboard json, None for unknown uids
+    """
+    match = re.fullmatch(r"bench-(\d+)", uid)
+    if match is None:
+        return None
+    datasource = {"type": "prometheus", "uid": "bench"}
+    panels = [{"id": panel_id, "title": f"Panel {panel_id}", "type": "timeseries", "datasource": datasource,
+               "targets": [{"refId": "A", "expr": f"rate(bench_panel_{panel_id}[$__interval])", "datasource": datasource}]}
+              for panel_id in range(1, int(match.group(1)) + 1)]
+    return {"dashboard": {"uid": uid, "title": uid, "version": 1, "panels": panels}}
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Base handler of the fake servers.
+    """
+    protocol_version = "HTTP/1.1"
+    backend = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send(self, body: bytes, content_type: str = "application/json", status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, payload: dict, status: int = 200) -> None:
+        self.send(json.dumps(payload).encode(), status=status)
+
+    def not_found(self) -> None:
+        self.send_json({"error": f"{self.command} {self.path} is not served by this fake"}, status=404)
+
+class FakeGrafanaHandler(FakeHandler):
+    """
+    Grafana dashboard and render api.
+    """
+    image = b""
+
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+        if path.startswith("/api/dashboards/uid/"):
+            uid = path[len("/api/dashboards/uid/"):]
+            if uid.endswith("/versions"):
+                dashboard = bench_dashboard(uid[:-len("/versions")])
+                return self.send_json([{"version": 1}]) if dashboard else self.not_found()
+            dashboard = bench_dashboard(uid)
+            if dashboard is None:
+                return self.not_found()
+            self.backend.serve(0.1)
+            return self.send_json(dashboard)
+        if path.startswith("/render/d-solo/"):
+            self.backend.serve()
+            return self.send(self.image, "image/png")
+        return self.not_found()
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path != "/api/ds/query":
+            return self.not_found()
+        body = json.loads(self.read_body())
+        self.backend.serve(0.2)
+        results = {}
+        for query in body.get("queries", []):
+            points = max(1, min(int(query.get("maxDataPoints", 100)), 10000))
+            start, end = int(body.get("from", 0)), int(body.get("to", points))
+            times = [start + (end - start) * index // points for index in range(points)]
+            rng = random.Random(f"{query.get('expr', '')}-{query['refId']}")
+            frames = []
+            for version in ("4.14", "4.15"):
+                level = rng.uniform(50, 150)
+                values = [round(level + rng.gauss(0, level / 20), 3) for _ in range(points)]
+                frames.append({
+                    "schema": {"refId": query["refId"], "fields": [
+                        {"name": "Time", "type": "time"},
+                        {"name": "Value", "type": "number", "labels": {"version": version}},
+                    ]},
+                    "data": {"values": [times, values]},
+                })
+            results[query["refId"]] = {"frames": frames}
+        return self.send_json({"results": results})
+
+class FakeInferenceHandler(FakeHandler):
+    """
+    vLLM, Ollama and llama.cpp generation api.
+    """
+
+    def do_POST(self) -> None:
+        path = urlparse(self.path).path
+        body = self.read_body()
+        # Bigger images cost more, like the vision encoder of a real model
+        self.backend.serve(1.0 + len(body) / (4 * 1024 * 1024))
+        answer = f"Fake summary of a {len(body)} bytes request"
+        if path == "/v1/chat/completions":
+            return self.send_json({"choices": [{"message": {"role": "assistant", "content": answer}}]})
+        if path == "/api/generate":
+            return self.send_json({"response": answer, "done": True})
+        if path == "/completion":
+            return self.send_json({"content": answer})
+        return self.not_found()
+
+class FakeGoogleHandler(FakeHandler):
+    """
+    Slides and Drive api, along with the Drive batch endpoint.
+    """
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def next_id(self, prefix: str) -> str:
+        with self.counter_lock:
+            FakeGoogleHandler.counter += 1
+            return f"{prefix}{FakeGoogleHandler.counter}"
+
+    def do_GET(self) -> None:
+        match = re.fullmatch(r"/v1/presentations/bench-(\d+)", urlparse(self.path).path)
+        if match is None:
+            return self.not_found()
+        self.backend.serve()
+        slides = [{
+            "objectId": f"slide_{idx}",
+            "pageElements": [
+                {"objectId": f"image_{idx}", "image": {"contentUrl": f"https://example.com/image_{idx}.png"}},
+                {"objectId": f"text_{idx}", "shape": {"text": {"textElements": [{"textRun": {"content": "placeholder\n"}}]}}},
+            ],
+        } for idx in range(int(match.group(1)))]
+        return self.send_json({"presentationId": f"bench-{match.group(1)}", "revisionId": self.next_id("revision-"), "slides": slides})
+
+    def do_POST(self) -> None:
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if re.fullmatch(r"/v1/presentations/[^/]+:batchUpdate", path):
+            self.backend.serve()
+            requests = json.loads(body).get("requests", [])
+            return self.send_json({"replies": [{} for _ in requests], "writeControl": {"requiredRevisionId": self.next_id("revision-")}})
+        if path == "/upload/drive/v3/files":
+            self.backend.serve(1.0 + len(body) / (1024 * 1024))
+            return self.send_json({"id": self.next_id("file-")})
+        if re.fullmatch(r"/drive/v3/files/[^/]+/permissions", path):
+            self.backend.serve()
+            return self.send_json({"id": self.next_id("permission-")})
+        if path == "/batch/drive/v3":
+            self.backend.serve()
+            return self.send_batch(body)
+        return self.not_found()
+
+    def do_PATCH(self) -> None:
+        match = re.fullmatch(r"/upload/drive/v3/files/([^/]+)", urlparse(self.path).path)
+        if match is None:
+            return self.not_found()
+        body = self.read_body()
+        self.backend.serve(1.0 + len(body) / (1024 * 1024))
+        return self.send_json({"id": match.group(1)})
+
+    def send_batch(self, body: bytes) -> None:
+        """
+        Answer every part of a multipart/mixed batch request with a 200.
+        """
+        boundary = "batch_fake_boundary"
+        parts = []
+        for content_id in re.findall(rb"Content-ID: <([^>]+)>", body):
+            response = f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{json.dumps({'id': self.next_id('permission-')})}"
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id.decode()}>\r\n\r\n{response}\r\n")
+        self.send((''.join(parts) + f"--{boundary}--\r\n").encode(), f"multipart/mixed; boundary={boundary}")
+
+HANDLERS = {
+    "grafana": FakeGrafanaHandler,
+    "inference": FakeInferenceHandler,
+    "google": FakeGoogleHandler,
+}
+
+def create_server(kind: str, port: int, latency: float, jitter: float, capacity: int, image_size: str, seed: int) -> ThreadingHTTPServer:
+    """
+    Create a fake server.
+
+    Args:
+        kind (str): one of HANDLERS
+        port (int): port to listen on, 0 for any free port
+        latency (float): base latency of a request in seconds
+        jitter (float): maximum random latency added to every request in seconds
+        capacity (int): requests served concurrently before latencies grow, 0 for no limit
+        image_size (str): WIDTHxHEIGHT of the rendered panels
+        seed (int): random seed
+
+    Returns:
+        ThreadingHTTPServer: server ready to serve_forever
+    """
+    handler = type(f"Bench{HANDLERS[kind].__name__}", (HANDLERS[kind],), {"backend": FakeBackend(latency, jitter, capacity, seed)})
+    if kind == "grafana":
+        handler.image = render_png(image_size, seed)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server
+
+@click.command()
+@click.argument("kind", type=click.Choice(list(HANDLERS)))
+@click.option("--port", type=int, default=0, help="Port to listen on, 0 for any free port")
+@click.option("--latency", type=float, default=0.1, help="Base latency of a request in seconds")
+@click.option("--jitter", type=float, default=0.02, help="Maximum random latency added to every request in seconds")
+@click.option("--capacity", type=int, default=0, help="Requests served concurrently before latencies grow, 0 for no limit")
+@click.option("--image-size", default="1280x720", help="WIDTHxHEIGHT of the rendered panels")
+@click.option("--seed", type=int, default=42, help="Random seed")
+def main(**kwargs):
+    """
+    Run a fake server until interrupted. The listening port is printed on the first line of stdout.
+    """
+    server = create_server(kwargs["kind"], kwargs["port"], kwargs["latency"], kwargs["jitter"], kwargs["capacity"], kwargs["image_size"], kwargs["seed"])
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Run `yoda generate` with the google apis pointed at the fake google server of benchmarks/fakes.py.
+
+The discovery documents bundled with google-api-python-client are rebased on the fake server, so slides and drive
+requests, media uploads and batch requests go through the real client code. Authentication uses the token.json of
+the working directory like a regular run.
+
+Usage:
+    python benchmarks/run_generate.py --google-url http://127.0.0.1:9000/ -- --config config.yaml --presentation bench-10
+"""
+import os
+import sys
+import json
+import googleapiclient.discovery
+from googleapiclient.discovery_cache import get_static_doc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def fake_build(google_url: str) -> callable:
+    """
+    Replacement of googleapiclient.discovery.build talking to the fake google server.
+
+    Args:
+        google_url (str): root url of the fake google server
+
+    Returns:
+        callable: build function
+    """
+    def build(service_name: str, version: str, credentials=None, **kwargs):
+        document = json.loads(get_static_doc(service_name, version))
+        document["rootUrl"] = google_url
+        document["mtlsRootUrl"] = google_url
+        return googleapiclient.discovery.build_from_document(document, credentials=credentials)
+    return build
+
+def main(argv: list[str]) -> None:
+    """
+    Patch the google client and hand the remaining arguments to the generate sub-command.
+
+    Args:
+        argv (list[str]): [--google-url URL] -- generate options
+
+    Returns:
+        None
+    """
+    if argv[:1] == ["--google-url"]:
+        googleapiclient.discovery.build = fake_build(argv[1].rstrip("/") + "/")
+        argv = argv[2:]
+    if argv[:1] == ["--"]:
+        argv = argv[1:]
+    from main import cli
+    cli(["generate", *argv])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,17 +1,25 @@
+import os
 import sys
 import click
 import csv
+import shutil
+import hashlib
 import logging
+import tempfile
 import warnings
-import multiprocessing as mp
-from googleapiclient.discovery import build
-from urllib.parse import urlparse, parse_qs
-from src.grafana import export_panels, extract_panels, preview_grafana_dashboard
-from src.inference import image_inference
-from src.slides import authenticate_google_slides, get_slide_info, replace_images_and_text
+from typing import Iterator
+from urllib.parse import urlparse
+from concurrent.futures import Executor
+from src.images import IMAGE_FORMATS
 from utils.logging import configure_logging
-from utils.yaml_parser import load_config
-from utils.utils import multi_process, flatten_list
+from utils.cache import DiskCache, make_cache_key
+from utils.concurrency import configure_limiter, get_limiter, log_limiter_stats
+from utils.pipeline import Stage, run_pipeline
+from utils.run_state import RunState
+from utils.tracing import annotate_span, configure_tracing, export_chrome_trace, export_openmetrics, load_spans, log_span_summary
+# Subcommand modules and their heavy dependencies (requests, numpy, the google clients, matplotlib) are imported
+# by the functions that need them, so every command only pays for what it uses. benchmarks/bench_startup.py
+# keeps the import time of every command within its budget.
 
 warnings.filterwarnings("ignore", message="Unverified HTTPS request.*")
 
@@ -25,33 +33,93 @@ def cli(max_content_width=120):
 @cli.command(name="generate")
 @click.option("--config", default="config/grafana_config.yaml", help="Path to the configuration file")
 @click.option("--debug", is_flag=True, help="log level")
-@click.option("--concurrency", is_flag=True, help="To enable concurrent operations")
+@click.option("--concurrency", type=int, is_flag=False, flag_value=-1, default=0, help="Ceiling on concurrent operations, each endpoint adapts its own limit below it. Without a value the ceiling is min(32, cpus + 4)")
+@click.option("--executor", type=click.Choice(["thread", "process"]), default="thread", help="Worker pool backend used for concurrent operations")
 @click.option("--inference", is_flag=True, help="Flag for inference")
 @click.option("--inference-endpoint", default="", help="Inference endpoint")
 @click.option("--inference-api-key", default="", help="Api key to access inference endpoint")
 @click.option("--inference-model", default="", help="Hosted model at the inference endpoint")
 @click.option("--inference-model-type", default="", help="Hosted model type for inference. Valid options are [vllm, ollama, llama.cpp]")
+@click.option("--inference-batch-size", type=int, default=1, help="Number of panels to group into one batch of inference requests")
+@click.option("--inference-max-in-flight", type=int, default=8, help="Maximum concurrent inference requests of a batch")
+@click.option("--image-max-size", type=int, default=1024, help="Longest side in pixels of the images sent for inference, 0 to keep the rendered size")
+@click.option("--image-format", type=click.Choice(list(IMAGE_FORMATS)), default="png", help="Format of the images sent for inference")
+@click.option("--image-quality", type=int, default=85, help="Quality of jpeg and webp images")
+@click.option("--upload-max-size", type=int, default=0, help="Longest side in pixels of the images uploaded to the presentation, 0 to keep the source size")
 @click.option("--csv", default="panel_inference.csv", help=".csv file path to output")
 @click.option("--presentation", default="", help="Presentation id to parse")
 @click.option("--credentials", default="credentials.json", help="Google oauth credentials path")
 @click.option("--slidemapping", default="config/slide_content_mapping.yaml", help="Slide content mapping file")
+@click.option("--drive-manifest", default="", help="Manifest of the images uploaded to drive. Defaults to drive_manifest.json in --cache-dir")
+@click.option("--upload-concurrency", type=int, default=8, help="Maximum concurrent image uploads to drive")
 @click.option("--fewshotfilepath", default="", help="Few shot examples file path")
-@click.option("--fewshotsamples", type=int, default=0, help="Number of few-shot examples to load")
+@click.option("--fewshotsamples", type=int, default=0, help="Number of most similar few-shot examples to use per panel")
+@click.option("--cache-dir", default=".yoda_cache", help="Directory to cache rendered panels and dashboards in")
+@click.option("--cache-size", type=int, default=1024, help="Maximum size of each cache in MB")
+@click.option("--cache-ttl", type=int, default=900, help="Seconds to reuse renders of relative time ranges such as now-7d")
+@click.option("--no-cache", is_flag=True, help="Disable caching")
+@click.option("--refresh", is_flag=True, help="Ignore cached entries and refresh them")
+@click.option("--inference-cache-max-age", type=int, default=30, help="Days to keep cached inference results")
+@click.option("--grafana-pool-size", type=int, default=10, help="Keep-alive connections to keep per grafana host")
+@click.option("--grafana-max-connections", type=int, default=0, help="Cap on concurrent connections per grafana host, 0 for no cap")
+@click.option("--http2", is_flag=True, help="Use HTTP/2 for grafana requests. Requires httpx[http2]")
+@click.option("--grafana-host-concurrency", type=int, default=0, help="Cap on concurrent renders and dashboard api calls per grafana host, 0 for the --concurrency ceiling")
+@click.option("--engine", type=click.Choice(["executor", "async"]), default="executor", help="Engine used to export grafana panels")
+@click.option("--data-mode", is_flag=True, help="Query the series of every panel from its datasources instead of rendering it, and infer a text summary of them")
+@click.option("--renderer", type=click.Choice(["grafana", "local"]), default="grafana", help="Render panels with the grafana image renderer, or draw them locally from their queried series. local requires matplotlib")
+@click.option("--max-in-flight", type=int, default=100, help="Maximum number of panel renders in flight with the async engine")
+@click.option("--analysis", is_flag=True, help="Compare the two latest release versions of every panel queried with --data-mode and add regression verdicts to the csv")
+@click.option("--compare-by", default="", help="Series label holding the release version. Defaults to the compare_by dashboard variable, else a label named like version")
+@click.option("--regression-threshold", type=float, default=5.0, help="Percent change of a panel mean reported as a regression or an improvement")
+@click.option("--resume", is_flag=True, help="Rerun only the panels missing from the run state or whose inputs changed")
+@click.option("--run-state", default="", help="Run state file recording the stage every panel reached. Defaults to the csv path with a .state.jsonl extension")
+@click.option("--trace", is_flag=True, help="Export the spans of the run as a Chrome trace (.trace.json) and OpenMetrics (.metrics.txt) next to the csv")
 def generate(**kwargs):
     """
     sub-command to generate a grafana panels and infer them. Optionally executes the default worklfow to publish those results to a presentation.
     """
     level = logging.DEBUG if kwargs["debug"] else logging.INFO
     need_inference = True if kwargs["inference"] else False
-    concurrency = (75 * mp.cpu_count())//100 if kwargs["concurrency"] else 1
+    concurrency = concurrency_ceiling(kwargs["concurrency"])
     configure_logging(level)
     global logger
     logger = logging.getLogger(__name__)
-    config_data = load_config(kwargs["config"])
-    logger.debug(config_data)
+    if kwargs["renderer"] == "local" and not kwargs["data_mode"]:
+        from src.renderer import require_matplotlib
+        require_matplotlib()
+    from utils.config_compiler import load_render_plan, plan_to_grafana_data
+    from utils.utils import configure_grafana_sessions, create_executor, log_grafana_session_stats
+    # Identical renders of the config are compiled away once per config content
+    render_plan, grafana_secrets = load_render_plan(kwargs["config"], create_cache(kwargs, "plans"))
+    logger.debug(render_plan)
+    grafana_data = plan_to_grafana_data(render_plan, grafana_secrets)
+
+    configure_grafana_sessions(kwargs["grafana_pool_size"], kwargs["grafana_max_connections"], kwargs["http2"])
+    # Spans of every process of the run are collected here and summarized once the workers are done
+    trace_dir = tempfile.mkdtemp(prefix="yoda-trace-")
+    configure_tracing(trace_dir)
+    # Every endpoint finds its own limit, --concurrency only caps them
+    host_concurrency = min(concurrency, kwargs["grafana_host_concurrency"]) if kwargs["grafana_host_concurrency"] > 0 else concurrency
+    for each_grafana in grafana_data:
+        configure_limiter(f"grafana render {grafana_host(each_grafana['url'])}", host_concurrency)
+        configure_limiter(f"grafana api {grafana_host(each_grafana['url'])}", host_concurrency)
+    configure_limiter("inference", concurrency)
+    configure_limiter("google", kwargs["upload_concurrency"])
+    render_cache = create_cache(kwargs, "renders")
+    metadata_cache = create_cache(kwargs, "dashboards")
+    inference_cache = create_cache(kwargs, "inference", kwargs["inference_cache_max_age"] * 24 * 3600) if need_inference else None
+    image_cache = create_cache(kwargs, "images")
 
     # TODO: Add support for other data sources as well
-    process_grafana_config(config_data['grafana'], concurrency, need_inference, kwargs)
+    with create_executor(kwargs["executor"], concurrency, init_worker, worker_initargs(kwargs)) as executor:
+        process_grafana_config(grafana_data, executor, concurrency, need_inference, render_cache, metadata_cache, inference_cache, image_cache, kwargs)
+
+    for cache in (render_cache, metadata_cache, inference_cache, image_cache):
+        if cache is not None:
+            cache.evict()
+    log_grafana_session_stats()
+    log_limiter_stats()
+    report_spans(trace_dir, os.path.splitext(kwargs["csv"])[0] if kwargs["trace"] else "")
 
 @cli.command(name="preview-dashboard")
 @click.option("--url", default="", help="Grafana dashboard url to preview")
@@ -65,6 +133,7 @@ def preview_dashboard(**kwargs):
     configure_logging(logging.INFO)
     global logger
     logger = logging.getLogger(__name__)
+    from src.grafana import preview_grafana_dashboard
     try:
         parsed_d_raw_url = urlparse(kwargs["url"])
         g_url = parsed_d_raw_url.scheme + "://" + parsed_d_raw_url.netloc
@@ -85,6 +154,8 @@ def preview_presentation(**kwargs):
     configure_logging(logging.INFO)
     global logger
     logger = logging.getLogger(__name__)
+    from googleapiclient.discovery import build
+    from src.slides import authenticate_google_slides, get_slide_info
     try:
         creds = authenticate_google_slides(kwargs["credentials"])
         service = build('slides', 'v1', credentials=creds)
@@ -96,6 +167,11 @@ def preview_presentation(**kwargs):
 @click.option("--id", default="", help="Presentation id to preview")
 @click.option("--credentials", default="credentials.json", help="Google oauth credentials path")
 @click.option("--slidemapping", default="config/slide_content_mapping.yaml", help="Slide content mapping file")
+@click.option("--drive-manifest", default=".yoda_cache/drive_manifest.json", help="Manifest of the images uploaded to drive, empty to upload every image again")
+@click.option("--upload-concurrency", type=int, default=8, help="Maximum concurrent image uploads to drive")
+@click.option("--cache-dir", default=".yoda_cache", help="Directory to keep the state of updated presentations in")
+@click.option("--no-cache", is_flag=True, help="Update every mapped image and text regardless of earlier updates")
+@click.option("--refresh", is_flag=True, help="Ignore the state of earlier updates and refresh it")
 def update_presentation(**kwargs):
     """
     sub-command to update a presentation. More details here: https://developers.google.com/slides/api/quickstart/python
@@ -103,119 +179,609 @@ def update_presentation(**kwargs):
     configure_logging(logging.INFO)
     global logger
     logger = logging.getLogger(__name__)
+    from googleapiclient.discovery import build
+    from src.drive import DriveManifest
+    from src.slides import apply_slide_mapping, authenticate_google_slides
+    from utils.yaml_parser import load_config
     try:
         creds = authenticate_google_slides(kwargs["credentials"])
         service = build('slides', 'v1', credentials=creds)
-        slide_info = get_slide_info(service, kwargs["id"], False)
         logger.info(f"Applying slide mapping: {kwargs["slidemapping"]}")
         slide_content_mapping = load_config(kwargs["slidemapping"])
-        response = replace_images_and_text(service, kwargs["id"], slide_info, slide_content_mapping)
+        manifest = DriveManifest(kwargs["drive_manifest"]) if kwargs["drive_manifest"] else None
+        configure_limiter("google", kwargs["upload_concurrency"])
+        response, _ = apply_slide_mapping(service, kwargs["id"], slide_content_mapping, None, manifest, kwargs["upload_concurrency"], create_cache(kwargs, "slides"))
         logger.debug(response)
-        logger.info(f"Presentation: {kwargs["id"]} has been updated successfully")
+        if response is not None:
+            logger.info(f"Presentation: {kwargs["id"]} has been updated successfully to revision {response["revisionId"]}")
+        log_limiter_stats()
     except Exception as e:
         logger.error(f"Please make sure the provided credentials are correct. Error: {e}")
 
-def process_grafana_config(grafana_data: list, concurrency: int, need_inference: bool, kwargs: dict[str, any]) -> None:
+def report_spans(trace_dir: str, trace_prefix: str) -> None:
+    """
+    Summarize the spans of the run and optionally export them.
+
+    Args:
+        trace_dir (str): directory the spans were written to, removed afterwards
+        trace_prefix (str): path prefix of the .trace.json and .metrics.txt exports, empty to skip them
+
+    Returns:
+        None
+    """
+    try:
+        spans = load_spans(trace_dir)
+        log_span_summary(spans)
+        if trace_prefix:
+            export_chrome_trace(spans, f"{trace_prefix}.trace.json")
+            export_openmetrics(spans, f"{trace_prefix}.metrics.txt")
+            logger.info(f"Trace exported to {trace_prefix}.trace.json and {trace_prefix}.metrics.txt")
+    finally:
+        shutil.rmtree(trace_dir, ignore_errors=True)
+
+def worker_initargs(kwargs: dict[str, any]) -> tuple:
+    """
+    Arguments of init_worker for the worker processes of generate.
+
+    Args:
+        kwargs (dict[str, any]): generate arguments
+
+    Returns:
+        tuple: log level and the grafana session options resolved by configure_grafana_sessions
+    """
+    from utils.utils import grafana_http2_enabled
+    return (logging.DEBUG if kwargs["debug"] else logging.INFO,
+            (kwargs["grafana_pool_size"], kwargs["grafana_max_connections"], grafana_http2_enabled()))
+
+def init_worker(log_level: int, session_options: tuple) -> None:
+    """
+    Configure a worker process the way generate configured this one, workers don't inherit it from a fork.
+
+    Args:
+        log_level (int): log level of the run
+        session_options (tuple): configure_grafana_sessions arguments
+
+    Returns:
+        None
+    """
+    configure_logging(log_level)
+    global logger
+    logger = logging.getLogger(__name__)
+    from utils.utils import configure_grafana_sessions
+    configure_grafana_sessions(*session_options)
+
+def concurrency_ceiling(concurrency: int) -> int:
+    """
+    Resolve the --concurrency option into the ceiling of the concurrent operations.
+
+    Args:
+        concurrency (int): option value, 0 when not given and negative when given without a value
+
+    Returns:
+        int: maximum number of concurrent operations
+    """
+    if concurrency == 0:
+        return 1
+    if concurrency < 0:
+        # Renders and inference wait on the network, so the default ceiling is the one of an I/O bound thread pool
+        return min(32, (os.cpu_count() or 1) + 4)
+    return concurrency
+
+def create_cache(kwargs: dict[str, any], name: str, max_age: float | None = None) -> DiskCache | None:
+    """
+    Create a named cache under the configured cache directory.
+
+    Args:
+        kwargs (dict[str, any]): Application arguments
+        name (str): name of the cache
+        max_age (float | None): maximum age of the cache entries in seconds
+
+    Returns:
+        DiskCache | None: cache or None if caching is disabled
+    """
+    if kwargs["no_cache"]:
+        return None
+    return DiskCache(os.path.join(kwargs["cache_dir"], name), kwargs.get("cache_size", 1024) * 1024 * 1024, max_age=max_age, refresh=kwargs["refresh"])
+
+def process_grafana_config(grafana_data: list, executor: Executor, concurrency: int, need_inference: bool, render_cache: DiskCache | None, metadata_cache: DiskCache | None, inference_cache: DiskCache | None, image_cache: DiskCache | None, kwargs: dict[str, any]) -> None:
     """
     Function to process the grafana config.
 
     Args:
         grafana_data (list): grafana configuration list
-        concurrency (int): concurrency to implement parallelism
+        executor (Executor): executor shared by all the jobs of this run
+        concurrency (int): ceiling of the concurrent operations
         need_inference (bool): flag to regulate inference
+        render_cache (DiskCache | None): cache of rendered panels
+        metadata_cache (DiskCache | None): cache of dashboard metadata
+        inference_cache (DiskCache | None): cache of inference results
+        image_cache (DiskCache | None): cache of optimized images
         kwargs (dict[str, any]): Additional application arguments
 
     Returns:
         None
     """
-    for each_grafana in grafana_data:
-        g_alias = each_grafana['alias']
-        g_url = each_grafana['url']
-        g_username = each_grafana['username']
-        g_password = each_grafana['password']
-
-        logger.info(f"Scraping grafana: {g_alias}")
-        if 'dashboards' not in each_grafana or not each_grafana['dashboards']:
-            logger.info("No dashboards specified in configuration for extraction. Hence skipping this grafana")
+    # Optimized images are written here first, and moved into the image cache when it is enabled
+    from utils.utils import create_executor
+    image_dir = tempfile.mkdtemp(prefix="yoda-images-")
+    try:
+        # Image jobs are CPU bound, more processes than cores would only contend with each other
+        with create_executor("process", min(concurrency, max(1, (75 * (os.cpu_count() or 1))//100)), init_worker, worker_initargs(kwargs)) as image_executor:
+            run_grafana_config(grafana_data, executor, image_executor, image_dir, concurrency, need_inference, render_cache, metadata_cache, inference_cache, image_cache, kwargs)
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+def run_grafana_config(grafana_data: list, executor: Executor, image_executor: Executor, image_dir: str, concurrency: int, need_inference: bool, render_cache: DiskCache | None, metadata_cache: DiskCache | None, inference_cache: DiskCache | None, image_cache: DiskCache | None, kwargs: dict[str, any]) -> None:
+    """
+    Export, optimize and infer the panels of the grafana config, then update the presentation.
+
+    Args:
+        grafana_data (list): grafana configuration list
+        executor (Executor): executor shared by all the jobs of this run
+        image_executor (Executor): process pool for the CPU bound image jobs
+        image_dir (str): directory to write optimized images to
+        concurrency (int): ceiling of the concurrent operations
+        need_inference (bool): flag to regulate inference
+        render_cache (DiskCache | None): cache of rendered panels
+        metadata_cache (DiskCache | None): cache of dashboard metadata
+        inference_cache (DiskCache | None): cache of inference results
+        image_cache (DiskCache | None): cache of optimized images
+        kwargs (dict[str, any]): Additional application arguments
+
+    Returns:
+        None
+    """
+    run_state = RunState(kwargs["run_state"] or os.path.splitext(kwargs["csv"])[0] + ".state.jsonl", kwargs["resume"])
+    # Panels completed by a previous run, written to the csv without going through the pipeline again
+    completed_panels = []
+    inference_inputs = None
+    if kwargs["data_mode"] and kwargs["renderer"] == "local":
+        logger.warning("--data-mode infers from the series without drawing them, ignoring --renderer local")
+    local_renderer = kwargs["renderer"] == "local" and not kwargs["data_mode"]
+    # Both data mode and the local renderer query the series of every panel from its datasources
+    query_data = kwargs["data_mode"] or local_renderer
+    if query_data and kwargs["engine"] == "async":
+        logger.warning(f"{'--data-mode' if kwargs['data_mode'] else '--renderer local'} queries panels with the executor engine, ignoring --engine async")
+    if kwargs["engine"] == "async" and not query_data:
+        if kwargs["resume"]:
+            logger.warning("--resume only skips panels with the executor engine, the async engine relies on the render cache instead")
+        # A single event loop renders every panel of every grafana instance
+        from src.grafana_async import stream_grafana_config_async
+        from utils.utils import grafana_http2_enabled
+        # The flag as resolved by configure_grafana_sessions, which falls back to HTTP/1.1 without httpx[http2]
+        source = stream_grafana_config_async(grafana_data,
+                                             kwargs["max_in_flight"],
+                                             kwargs["grafana_pool_size"],
+                                             grafana_http2_enabled(),
+                                             render_cache,
+                                             metadata_cache,
+                                             kwargs["cache_ttl"])
+        source = (mirrored for panel in source for mirrored in copy_to_mirrors(panel))
+        source = record_each(source, lambda panel: record_rendered(run_state, panel))
+        stages = []
+    else:
+        # Dashboards of every grafana instance are resolved concurrently and each one fans out into render jobs,
+        # so rendering starts as soon as the first dashboard is resolved. Every job draws from the same executor
+        # and the limiter of its grafana host.
+        # Kept out of src.datasource, which loads numpy
+        from src.grafana import DATA_EXTENSION
+        source = (dashboard_job for each_grafana in grafana_data
+                  for dashboard_job in process_grafana(each_grafana, (render_cache, metadata_cache, kwargs["cache_ttl"], query_data)))
+        stages = [Stage("dashboard",
+                        process_dashboard,
+                        None,
+                        limiter=lambda each_dashboard, args: get_limiter(f"grafana api {grafana_host(args[0])}"),
+                        expand=lambda render_jobs: resume_render_jobs(render_jobs, run_state, kwargs["resume"], inference_inputs, completed_panels,
+                                                                      query_data, DATA_EXTENSION if kwargs["data_mode"] else ".png")),
+                  # Data mode asks the datasources behind the panels for their series instead of the renderer for images
+                  Stage("query" if query_data else "render",
+                        query_data_panel if query_data else render_panel,
+                        None,
+                        on_result=None if local_renderer else lambda panel: record_rendered(run_state, panel),
+                        limiter=lambda each_panel, args: get_limiter(f"grafana {'api' if query_data else 'render'} {grafana_host(args[0])}"),
+                        outcome=lambda panel: None if panel.get("resumed") or panel.get("render_cache") == "hit" else True,
+                        expand=None if local_renderer else copy_to_mirrors)]
+        if local_renderer:
+            from src.renderer import draw_panel
+            # Drawing is CPU bound and runs on the image processes, grafana only answers the queries
+            stages.append(Stage("draw", draw_panel, (), executor=image_executor, on_result=lambda panel: record_rendered(run_state, panel), expand=copy_to_mirrors))
+    if need_inference:
+        from src.fewshot import build_few_shot_index
+        from src.images import optimize_panel
+        from src.inference import batch_image_inference, data_inference, image_inference
+        # Models get images at their target resolution instead of the full size renders
+        if not kwargs["data_mode"]:
+            stages.append(Stage("optimize",
+                                optimize_panel,
+                                (kwargs["image_max_size"], kwargs["image_format"], kwargs["image_quality"], image_cache, image_dir),
+                                executor=image_executor))
+        # The few-shot file is parsed once per run, workers memory map the resulting index
+        few_shot_index = ""
+        if kwargs["fewshotfilepath"] and kwargs["fewshotsamples"] > 0:
+            # Without the cache the index lives in the image directory, which is removed at the end of the run
+            index_root = os.path.join(image_dir, "fewshot") if kwargs["no_cache"] else os.path.join(kwargs["cache_dir"], "fewshot")
+            try:
+                few_shot_index = build_few_shot_index(kwargs["fewshotfilepath"], index_root)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not load few-shot examples, running without them: {e}")
+        inference_args = ("Can you summarize this data?" if kwargs["data_mode"] else "Can you summarize this image?",
+                          kwargs["inference_endpoint"],
+                          kwargs["inference_api_key"],
+                          kwargs["inference_model"],
+                          kwargs["inference_model_type"],
+                          few_shot_index,
+                          kwargs["fewshotsamples"],
+                          inference_cache)
+        # Everything but the cache decides the text of a panel along with its image
+        inference_inputs = inference_args[:-1] + (kwargs["image_max_size"], kwargs["image_format"], kwargs["image_quality"])
+        on_inferred = lambda panel: record_inferred(run_state, panel, inference_inputs)
+        inference_outcome = lambda panel: None if panel.get("inference_cache") == "hit" else "panel_text" in panel
+        if kwargs["data_mode"]:
+            # Summaries are short prompts without images, they go through the same limiter one panel at a time
+            stages.append(Stage("inference", data_inference, inference_args, on_result=on_inferred, limiter=lambda *_: get_limiter("inference"), outcome=inference_outcome))
+        elif kwargs["inference_batch_size"] > 1:
+            stages.append(Stage("inference",
+                                batch_image_inference,
+                                inference_args + (kwargs["inference_max_in_flight"],),
+                                batch_size=kwargs["inference_batch_size"],
+                                on_result=on_inferred,
+                                limiter=lambda *_: get_limiter("inference"),
+                                outcome=inference_outcome))
+        else:
+            stages.append(Stage("inference", image_inference, inference_args, on_result=on_inferred, limiter=lambda *_: get_limiter("inference"), outcome=inference_outcome))
+
+    analysis = kwargs["analysis"] and kwargs["data_mode"]
+    if analysis:
+        from src.analysis import ANALYSIS_COLUMNS, analyze_panels, verdict_row
+    if kwargs["analysis"] and not kwargs["data_mode"]:
+        logger.warning("--analysis compares the series queried with --data-mode, ignoring it")
+    # Each row is written as soon as its panel leaves the last stage, or once every panel is in with --analysis
+    inference_cache_stats = {"hit": 0, "miss": 0}
+    analyzed_panels = []
+    with open(kwargs["csv"], mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Panel Image", "Panel Text"] + (ANALYSIS_COLUMNS if analysis else []))
+        for panel in run_pipeline(source, stages, executor, 2 * concurrency):
+            logger.debug(f"Completed panel: {panel}")
+            if "inference_cache" in panel:
+                inference_cache_stats[panel["inference_cache"]] += 1
+            if analysis:
+                analyzed_panels.append(panel)
+                continue
+            # Without inference, panels queried in data mode are described by the summary of their series
+            panel_text = panel["panel_text"] if "panel_text" in panel else panel.get("panel_data", "")
+            writer.writerow([panel["panel_image"], panel_text])
+            file.flush()
+        if analysis:
+            analyzed_panels += completed_panels
+            verdicts = analyze_panels(analyzed_panels, kwargs["compare_by"], kwargs["regression_threshold"])
+            for panel, verdict in zip(analyzed_panels, verdicts):
+                writer.writerow([panel["panel_image"], panel.get("panel_text", panel.get("panel_data", ""))] + verdict_row(verdict))
+        else:
+            for panel in completed_panels:
+                writer.writerow([panel["panel_image"], panel.get("panel_text", panel.get("panel_data", ""))])
+    if completed_panels:
+        logger.info(f"Reused {len(completed_panels)} panels completed by the previous run")
+    logger.info(f"Panels summary exported to file: {kwargs["csv"]}")
+    if inference_cache is not None:
+        logger.info(f"Inference cache: {inference_cache_stats["hit"]} hits, {inference_cache_stats["miss"]} misses")
+
+    if kwargs["presentation"] != "" and kwargs["slidemapping"] != "":
+        logger.info(f"Presentation ID specified. Trying to apply default slide mapping at {kwargs["slidemapping"]}")
+        from googleapiclient.discovery import build
+        from src.drive import DriveManifest
+        from src.slides import apply_slide_mapping, authenticate_google_slides
+        from utils.yaml_parser import load_config
+        creds = authenticate_google_slides(kwargs["credentials"])
+        service = build('slides', 'v1', credentials=creds)
+        slide_content_mapping = load_config(kwargs["slidemapping"])
+        image_options = (kwargs["upload_max_size"], "png", kwargs["image_quality"], image_cache, image_dir)
+        manifest = None
+        if not kwargs["no_cache"]:
+            manifest = DriveManifest(kwargs["drive_manifest"] or os.path.join(kwargs["cache_dir"], "drive_manifest.json"))
+        response, applied_images = apply_slide_mapping(service, kwargs["presentation"], slide_content_mapping, image_options, manifest, kwargs["upload_concurrency"], create_cache(kwargs, "slides"))
+        logger.debug(response)
+        if response is not None:
+            logger.info(f"Presentation: {kwargs["presentation"]} has been updated successfully to revision {response["revisionId"]}")
+        # Images that failed to upload or weren't found in their slide keep their earlier stage
+        for image_path in applied_images:
+            if run_state.get(os.path.abspath(image_path)) is not None:
+                run_state.record(os.path.abspath(image_path), "uploaded")
+    run_state.close()
+
+def file_sha256(path: str) -> str:
+    """
+    Hash of a file content.
+
+    Args:
+        path (str): file path
+
+    Returns:
+        str: sha256 hex digest of the file
+    """
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def record_each(items: Iterator, callback: callable) -> Iterator:
+    """
+    Call a function with every item of an iterator as it is consumed.
+
+    Args:
+        items (Iterator): items to forward
+        callback (callable): called with every item
+
+    Returns:
+        Iterator: the same items
+    """
+    for item in items:
+        callback(item)
+        yield item
+
+def record_rendered(run_state: RunState, panel: dict) -> None:
+    """
+    Record a rendered panel along with the hashes of its render request and image.
+
+    Args:
+        run_state (RunState): run state to update
+        panel (dict): rendered panel
+
+    Returns:
+        None
+    """
+    if panel.get("resumed"):
+        return
+    run_state.record(os.path.abspath(panel["panel_image"]), "rendered", reset=True,
+                     render_hash=panel.get("render_hash"), image_hash=file_sha256(panel["panel_image"]))
+
+def record_inferred(run_state: RunState, panel: dict, inference_inputs: tuple) -> None:
+    """
+    Record an inferred panel along with the hash of its inference inputs and its text.
+
+    Args:
+        run_state (RunState): run state to update
+        panel (dict): inferred panel
+        inference_inputs (tuple): inference arguments deciding the panel text along with its image
+
+    Returns:
+        None
+    """
+    key = os.path.abspath(panel["panel_image"])
+    record = run_state.get(key)
+    if "panel_text" not in panel or record is None:
+        return
+    run_state.record(key, "inferred", inference_hash=make_cache_key("inference", inference_inputs, record["image_hash"]), panel_text=panel["panel_text"])
+
+def resume_panel(each_panel: dict, panel_image: str, run_state: RunState, resume: bool, inference_inputs: tuple | None, data_mode: bool) -> str | None:
+    """
+    Find how far a previous run got with a panel. Completed panels get the text or data summary of that run.
+
+    Args:
+        each_panel (dict): panel tagged with its render_hash
+        panel_image (str): path the panel is exported to
+        run_state (RunState): run state of the previous run
+        resume (bool): skip the work recorded in the run state
+        inference_inputs (tuple | None): inference arguments deciding the panel text, None without inference
+        data_mode (bool): panels are queried into data files instead of rendered by grafana
+
+    Returns:
+        str | None: completed, rendered, or None when the panel has to be exported again
+    """
+    from src.datasource import load_panel_data
+    record = run_state.get(os.path.abspath(panel_image)) if resume else None
+    if (record is None or record.get("render_hash") != each_panel["render_hash"]
+            or not os.path.exists(panel_image) or file_sha256(panel_image) != record["image_hash"]):
+        return None
+    each_panel["panel_image"] = panel_image
+    if inference_inputs is not None and record.get("inference_hash") != make_cache_key("inference", inference_inputs, record["image_hash"]):
+        return "rendered"
+    if "panel_text" in record:
+        each_panel["panel_text"] = record["panel_text"]
+    elif data_mode:
+        each_panel["panel_data"] = load_panel_data(each_panel)
+    return "completed"
+
+def resume_render_jobs(render_jobs: Iterator[tuple], run_state: RunState, resume: bool, inference_inputs: tuple | None, completed_panels: list, data_mode: bool = False, extension: str = ".png") -> Iterator[tuple]:
+    """
+    Tag every render job with the hash of its render request and, when resuming, skip the work a previous run already did.
+    Completed panels are moved to completed_panels, rendered ones skip their render. Mirrors of a completed panel
+    the previous run did not complete are copied from it again.
+
+    Args:
+        render_jobs (Iterator[tuple]): (panel, render arguments) pairs
+        run_state (RunState): run state of the previous run
+        resume (bool): skip the work recorded in the run state
+        inference_inputs (tuple | None): inference arguments deciding the panel text, None without inference
+        completed_panels (list): list to collect the completed panels in
+        data_mode (bool): panels are queried into data files instead of rendered by grafana
+        extension (str): extension of the files recorded in the run state
+
+    Returns:
+        Iterator[tuple]: render jobs left to run
+    """
+    from src.grafana import build_render_params, panel_image_path, render_cache_key
+    for each_panel, render_args in render_jobs:
+        g_url, d_uid, _, _, d_output, d_query_params, d_version, _, _ = render_args
+        each_panel["render_hash"] = render_cache_key(g_url, d_uid, d_version, build_render_params(each_panel, d_query_params))
+        _, panel_image = panel_image_path(each_panel, d_output, extension)
+        status = resume_panel(each_panel, panel_image, run_state, resume, inference_inputs, data_mode)
+        pending_mirrors = []
+        for mirror in each_panel["panel_mirrors"]:
+            mirrored = mirror_panel(each_panel, mirror, extension)
+            if resume_panel(mirrored, mirrored["panel_image"], run_state, resume, inference_inputs, data_mode) == "completed":
+                completed_panels.append(mirrored)
+            else:
+                pending_mirrors.append(mirror)
+        each_panel["panel_mirrors"] = pending_mirrors
+        if status == "completed":
+            completed_panels.append(each_panel)
+            for mirrored in list(copy_to_mirrors(each_panel))[1:]:
+                record_rendered(run_state, mirrored)
+                mirrored["resumed"] = True
+                yield mirrored, render_args
             continue
-        all_dashboards = each_grafana['dashboards']
-
-        all_panels = []
-        for i in range(0, len(all_dashboards), concurrency):
-            dashboard_chunk = all_dashboards[i:i + concurrency]
-            all_panels.extend(multi_process(dashboard_chunk, process_dashboard, (g_url, g_username, g_password, concurrency)))
-        updated_panels = flatten_list(all_panels)
-
-        if need_inference:
-            processed_panels = []
-            for i in range(0, len(updated_panels), concurrency):
-                panel_chunk = updated_panels[i: i + concurrency]
-                processed_panels.extend(multi_process(panel_chunk, 
-                                                      image_inference, 
-                                                      ("Can you summarize this image?", 
-                                                       kwargs["inference_endpoint"], 
-                                                       kwargs["inference_api_key"], 
-                                                       kwargs["inference_model"],
-                                                       kwargs["inference_model_type"],
-                                                       kwargs["fewshotfilepath"],
-                                                       kwargs["fewshotsamples"])
-                                                    )
-                                                )
-            processed_panels = flatten_list(processed_panels)
-            updated_panels = processed_panels
-        
-        logger.debug("Full list of exported panels")
-        logger.debug(updated_panels)
-
-        data = [["Panel Image", "Panel Text"]]
-        for panel in updated_panels:
-            panel_text = panel["panel_text"] if "panel_text" in panel else ""
-            data.append([panel["panel_image"], panel_text])
-        with open(kwargs["csv"], mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerows(data)
-        logger.info(f"Panels summary exported to file: {kwargs["csv"]}")
-
-        if kwargs["presentation"] != "" and kwargs["slidemapping"] != "":
-            logger.info(f"Presentation ID specified. Trying to apply default slide mapping at {kwargs["slidemapping"]}")
-            creds = authenticate_google_slides(kwargs["credentials"])
-            service = build('slides', 'v1', credentials=creds)
-            slide_info = get_slide_info(service, kwargs["presentation"], False)
-            slide_content_mapping = load_config(kwargs["slidemapping"])
-            response = replace_images_and_text(service, kwargs["presentation"], slide_info, slide_content_mapping)
-            logger.debug(response)
-            logger.info(f"Presentation: {kwargs["presentation"]} has been updated successfully")
-
-def process_dashboard(each_dashboard: dict, args: tuple, return_dict: dict, idx: int) -> None:
+        if status == "rendered":
+            each_panel["resumed"] = True
+        yield each_panel, render_args
+
+def mirror_panel(each_panel: dict, mirror: dict, extension: str) -> dict:
+    """
+    Panel of a config entry making the same render as another one, see utils.config_compiler.
+
+    Args:
+        each_panel (dict): panel that is rendered
+        mirror (dict): config entry of the mirror, with its output
+        extension (str): extension of the exported file
+
+    Returns:
+        dict: panel of the mirror, exported to its own output
+    """
+    from src.grafana import panel_image_path
+    mirrored = {**each_panel,
+                "panel_title": mirror.get("alias") or mirror.get("name", ""),
+                "panel_context": mirror.get("context", ""),
+                "panel_direction": mirror.get("direction", ""),
+                "panel_mirrors": []}
+    for key in ("resumed", "panel_text", "inference_cache"):
+        mirrored.pop(key, None)
+    _, mirrored["panel_image"] = panel_image_path(mirrored, mirror["output"], extension)
+    return mirrored
+
+def copy_to_mirrors(each_panel: dict) -> Iterator[dict]:
+    """
+    Copy an exported panel to the outputs of its mirrors instead of rendering them again.
+
+    Args:
+        each_panel (dict): exported panel
+
+    Returns:
+        Iterator[dict]: the panel followed by the panels of its mirrors
+    """
+    yield each_panel
+    if not each_panel.get("panel_mirrors"):
+        return
+    from src.datasource import load_panel_data, panel_data_path
+    for mirror in each_panel["panel_mirrors"]:
+        mirrored = mirror_panel(each_panel, mirror, os.path.splitext(each_panel["panel_image"])[1])
+        os.makedirs(mirror["output"], exist_ok=True)
+        shutil.copyfile(each_panel["panel_image"], mirrored["panel_image"])
+        if "panel_data" in each_panel:
+            # Panels drawn locally keep their queried series next to the image
+            if panel_data_path(each_panel) != each_panel["panel_image"]:
+                shutil.copyfile(panel_data_path(each_panel), panel_data_path(mirrored))
+            mirrored["panel_data"] = load_panel_data(mirrored)
+        logger.info(f"Copied {each_panel['panel_image']} to {mirrored['panel_image']}, the same render")
+        yield mirrored
+
+def render_panel(each_panel: dict, args: tuple) -> dict | None:
+    """
+    Render a panel unless a resumed run already rendered it.
+
+    Args:
+        each_panel (dict): panel to render
+        args (tuple): process_panel arguments
+
+    Returns:
+        dict | None: rendered panel or None if the export failed
+    """
+    if each_panel.get("resumed"):
+        logger.info(f"Reusing {each_panel['panel_image']} rendered by the previous run")
+        return each_panel
+    from src.grafana import process_panel
+    return process_panel(each_panel, args)
+
+def query_data_panel(each_panel: dict, args: tuple) -> dict | None:
+    """
+    Query the series of a panel unless a resumed run already queried them.
+
+    Args:
+        each_panel (dict): panel to query
+        args (tuple): process_panel arguments
+
+    Returns:
+        dict | None: queried panel or None if the query failed
+    """
+    from src.datasource import load_panel_data, query_panel
+    if each_panel.get("resumed"):
+        logger.info(f"Reusing {each_panel['panel_image']} queried by the previous run")
+        each_panel["panel_data"] = load_panel_data(each_panel)
+        return each_panel
+    return query_panel(each_panel, args)
+
+def grafana_host(url: str) -> str:
+    """
+    Host of a grafana url, the unit of the per host concurrency limits.
+
+    Args:
+        url (str): any url on the grafana host
+
+    Returns:
+        str: host and port of the url
+    """
+    return urlparse(url).netloc
+
+def process_grafana(each_grafana: dict, args: tuple) -> Iterator[tuple]:
+    """
+    Process grafana instance.
+
+    Args:
+        each_grafana (dict): each grafana instance to process
+        args (tuple): full list of arguments to process
+
+    Returns:
+        Iterator[tuple]: dashboard jobs of the instance as (dashboard, process_dashboard arguments) pairs
+    """
+    render_cache, metadata_cache, cache_ttl, data_mode = args
+    g_alias = each_grafana['alias']
+    g_url = each_grafana['url']
+    g_username = each_grafana['username']
+    g_password = each_grafana['password']
+
+    logger.info(f"Scraping grafana: {g_alias}")
+    if 'dashboards' not in each_grafana or not each_grafana['dashboards']:
+        logger.info("No dashboards specified in configuration for extraction. Hence skipping this grafana")
+        return
+    for each_dashboard in each_grafana['dashboards']:
+        yield each_dashboard, (g_url, g_username, g_password, render_cache, metadata_cache, cache_ttl, data_mode)
+
+def process_dashboard(each_dashboard: dict, args: tuple) -> list[tuple] | None:
     """
     Process grafana dashboard.
 
     Args:
         each_dashboard (dict): each dashboard to process
         args (tuple): full list of arguments to process
-        return_dict (dict): shared dictionary across the threads
-        idx (int): unique index to store thread data
 
     Returns:
-        None
+        list[tuple] | None: render jobs of the dashboard as (panel, process_panel arguments) pairs, None if it could not be scanned
     """
-    g_url, g_username, g_password, concurrency = args
+    from src.grafana import extract_panels, get_dashboard_metadata, parse_dashboard_url, preview_grafana_dashboard
+    from utils.utils import HTTP_ERRORS
+    g_url, g_username, g_password, render_cache, metadata_cache, cache_ttl, data_mode = args
     d_alias = each_dashboard['alias']
     d_raw_url = each_dashboard['raw_url']
     d_output = each_dashboard['output']
 
-    parsed_d_raw_url = urlparse(d_raw_url)
-    d_uid = parsed_d_raw_url.path.split('/')[2]
-    d_query_params = parse_qs(parsed_d_raw_url.query)
+    d_uid, d_query_params = parse_dashboard_url(d_raw_url)
     d_url = f"{g_url}/api/dashboards/uid/{d_uid}"
-    panel_id_to_names, panel_name_to_ids = preview_grafana_dashboard(d_url, g_username, g_password, False, "", d_alias)
+    annotate_span(host=grafana_host(g_url), dashboard=d_alias)
+    try:
+        panel_id_to_names, panel_name_to_ids, d_version = preview_grafana_dashboard(d_url, g_username, g_password, False, "", d_alias, metadata_cache)
+    except HTTP_ERRORS as e:
+        logger.error(f"Error scanning dashboard {d_alias}: {e}")
+        return None
 
     if 'panels' not in each_dashboard or not each_dashboard['panels']:
         logger.info("No panels specified in configuration for extraction. Hence skipping this dashboard")
         return []
 
     extracted_panels = extract_panels(each_dashboard['panels'], panel_id_to_names, panel_name_to_ids)
-    return_dict[idx] = export_panels(extracted_panels, g_url, d_uid, g_username, g_password, d_output, d_query_params, concurrency)
+    if data_mode:
+        from src.datasource import attach_panel_queries
+        # Already fetched by the preview above, the targets of the panels travel with them to the workers
+        attach_panel_queries(extracted_panels, get_dashboard_metadata(d_url, g_username, g_password, metadata_cache), d_query_params)
+    os.makedirs(d_output, exist_ok=True)
+    render_args = (g_url, d_uid, g_username, g_password, d_output, d_query_params, d_version, render_cache, cache_ttl)
+    return [(each_panel, render_args) for each_panel in extracted_panels]
 
 if __name__ == "__main__":
     if len(sys.argv) <= 1:
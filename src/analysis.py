@@ -0,0 +1,277 @@
+import re
+import time
+import logging
+import warnings
+import numpy as np
+from src.datasource import panel_data_path, read_series
+
+logger = logging.getLogger(__name__)
+
+# Columns added to the csv by --analysis
+ANALYSIS_COLUMNS = ["Metric", "Baseline", "Candidate", "Baseline Mean", "Candidate Mean", "Delta %", "CI Low %", "CI High %", "Change Point", "Verdict"]
+
+# Grafana units where a lower value is better, every other unit is treated as higher is better
+LOWER_IS_BETTER_UNITS = {"ns", "µs", "us", "ms", "s", "m", "h", "d", "dtdurationms", "dtdurations", "clockms", "clocks", "bytes", "decbytes", "kbytes", "mbytes", "gbytes"}
+
+# Two sided 95% critical values of the t distribution by degrees of freedom, the normal one beyond
+T_CRITICAL_DF = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 15, 20, 25, 30, 40, 60, 120, 1e9])
+T_CRITICAL_95 = np.array([12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.179, 2.131, 2.086, 2.060, 2.042, 2.021, 2.000, 1.980, 1.960])
+
+# Mean shift, in standard errors, above which a split of a version's runs is reported as a change point
+CHANGE_POINT_SCORE = 4.0
+
+# Verdicts ordered from the least to the most important, the most important one of a panel's metrics is reported
+VERDICTS = ["n/a", "no change", "improvement", "regression"]
+
+def version_key(version: str) -> tuple:
+    """
+    Sort key of a release version, so that 4.9 comes before 4.10.
+
+    Args:
+        version (str): version label such as 4.14 or 4.15.0-rc.1
+
+    Returns:
+        tuple: numeric and text parts of the version
+    """
+    return tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in re.findall(r"\d+|[^\d.\-]+", version))
+
+def series_version(each_series: dict, compare_by: str) -> str:
+    """
+    Release version a series belongs to.
+
+    Args:
+        each_series (dict): series read from the data file of a panel
+        compare_by (str): label holding the version, empty to guess it
+
+    Returns:
+        str: version of the series
+    """
+    labels = each_series["labels"]
+    if compare_by:
+        return labels.get(compare_by, each_series["name"])
+    version_labels = [key for key in labels if "version" in key.lower()]
+    if version_labels:
+        return labels[version_labels[0]]
+    if len(labels) == 1:
+        return next(iter(labels.values()))
+    return each_series["name"]
+
+def panel_compare_by(each_panel: dict, compare_by: str) -> str:
+    """
+    Label the versions of a panel are grouped by: the --compare-by option, else the compare_by dashboard variable.
+
+    Args:
+        each_panel (dict): panel queried in data mode
+        compare_by (str): --compare-by option
+
+    Returns:
+        str: label name, empty to guess it from the labels of every series
+    """
+    if compare_by:
+        return compare_by
+    values = each_panel.get("dashboard_variables", {}).get("compare_by", {}).get("values", [])
+    return values[0] if len(values) == 1 else ""
+
+def collect_groups(panels: list[dict], compare_by: str) -> list[tuple]:
+    """
+    Group the runs of every panel by metric and version.
+
+    Args:
+        panels (list[dict]): panels queried in data mode
+        compare_by (str): --compare-by option
+
+    Returns:
+        list[tuple]: (panel index, metric, version, unit, time ordered values, times) of every group
+    """
+    groups = {}
+    for panel_index, each_panel in enumerate(panels):
+        try:
+            series = read_series(panel_data_path(each_panel))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unable to read the data of {panel_data_path(each_panel)}: {e}")
+            continue
+        label = panel_compare_by(each_panel, compare_by)
+        for each_series in series:
+            times = each_series["time"] if each_series["time"] is not None else np.arange(len(each_series["values"]))
+            key = (panel_index, each_series["ref_id"], series_version(each_series, label))
+            group = groups.setdefault(key, {"unit": each_series["unit"], "values": [], "times": []})
+            group["values"].append(each_series["values"])
+            group["times"].append(times)
+    collected = []
+    for (panel_index, metric, version), group in groups.items():
+        values = np.concatenate(group["values"])
+        times = np.concatenate(group["times"])
+        finite = np.isfinite(values)
+        order = np.argsort(times[finite], kind="stable")
+        collected.append((panel_index, metric, version, group["unit"], values[finite][order], times[finite][order]))
+    return collected
+
+def pad_groups(groups: list[tuple]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pack the runs of every group into one matrix, so statistics are computed for all groups at once.
+
+    Args:
+        groups (list[tuple]): groups returned by collect_groups
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: values and times padded with NaN and -1 on the right, and run counts
+    """
+    counts = np.array([len(group[4]) for group in groups], dtype=np.int64)
+    width = max(1, counts.max(initial=0))
+    values = np.full((len(groups), width), np.nan)
+    times = np.full((len(groups), width), -1, dtype=np.int64)
+    mask = np.arange(width) < counts[:, None]
+    values[mask] = np.concatenate([group[4] for group in groups]) if groups else []
+    times[mask] = np.concatenate([group[5] for group in groups]).astype(np.int64) if groups else []
+    return values, times, counts
+
+def change_points(values: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the most likely mean shift in the runs of every group, with both sides of the split holding at least two runs.
+    Every split is scored against the pooled standard deviation within its two segments, so the shift itself doesn't
+    inflate the noise it is compared to.
+
+    Args:
+        values (np.ndarray): runs of every group, left aligned and padded with NaN
+        counts (np.ndarray): number of runs of every group
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: index of the first run after the shift and its score, in standard errors, of every group
+    """
+    rows = np.arange(len(counts))
+    last = np.maximum(counts - 1, 0)
+    # Centering every group keeps the sums of squares small enough to stay precise
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        filled = np.nan_to_num(values - np.nanmean(values, axis=1)[:, None])
+    prefix = np.cumsum(filled, axis=1)
+    prefix_squares = np.cumsum(filled ** 2, axis=1)
+    total = prefix[rows, last][:, None]
+    total_squares = prefix_squares[rows, last][:, None]
+    split = np.arange(1, values.shape[1] + 1)[None, :]
+    right = counts[:, None] - split
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left_mean = prefix / split
+        right_mean = (total - prefix) / right
+        shift = np.abs(left_mean - right_mean)
+        # Sums of squared deviations from the mean of each segment, pooled over both segments
+        left_squares = prefix_squares - prefix * left_mean
+        right_squares = (total_squares - prefix_squares) - (total - prefix) * right_mean
+        deviation = np.sqrt(np.maximum(left_squares + right_squares, 0.0) / (counts[:, None] - 2))
+        score = shift / (deviation * np.sqrt(1 / split + 1 / right))
+    # A noiseless step scores infinity and is kept, undefined splits are dropped
+    score[(split < 2) | (right < 2) | np.isnan(score)] = 0.0
+    best = np.argmax(score, axis=1)
+    return best + 1, score[rows, best]
+
+def t_critical(df: np.ndarray) -> np.ndarray:
+    """
+    Two sided 95% critical values of the t distribution.
+
+    Args:
+        df (np.ndarray): degrees of freedom
+
+    Returns:
+        np.ndarray: critical values, interpolated between the tabulated degrees of freedom
+    """
+    return np.interp(np.nan_to_num(df, nan=1.0), T_CRITICAL_DF, T_CRITICAL_95)
+
+def analyze_panels(panels: list[dict], compare_by: str = "", threshold: float = 5.0) -> list[dict]:
+    """
+    Compare the two latest release versions of every panel queried in data mode.
+    The runs of every version are aggregated, and the percent delta of their means gets a Welch confidence interval.
+    A panel regresses when the delta is worse than the threshold and its confidence interval excludes zero.
+    Every statistic is computed for all panels at once on padded matrices.
+
+    Args:
+        panels (list[dict]): panels queried in data mode
+        compare_by (str): label holding the version of a series, empty for the compare_by dashboard variable or a guess
+        threshold (float): percent delta below which a significant change is not reported
+
+    Returns:
+        list[dict]: verdict of every panel, keyed by ANALYSIS_COLUMNS
+    """
+    started = time.perf_counter()
+    verdicts = [dict.fromkeys(ANALYSIS_COLUMNS, "") | {"Verdict": "n/a"} for _ in panels]
+    groups = collect_groups(panels, compare_by)
+    if not groups:
+        return verdicts
+    values, times, counts = pad_groups(groups)
+    with warnings.catch_warnings():
+        # Versions with a single run have no variance, their interval is left empty
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        means = np.nanmean(values, axis=1)
+        variances = np.nanvar(values, axis=1, ddof=1)
+        split_indexes, split_scores = change_points(values, counts)
+
+    # Baseline and candidate are the two latest versions of every metric of a panel
+    versions = {}
+    for group_index, (panel_index, metric, version, _, _, _) in enumerate(groups):
+        versions.setdefault((panel_index, metric), []).append((version_key(version), group_index))
+    pairs = [(key, sorted(indexes)[-2][1], sorted(indexes)[-1][1]) for key, indexes in versions.items() if len(indexes) > 1]
+    if not pairs:
+        logger.info("No panel has two versions to compare")
+        return verdicts
+    baseline = np.array([pair[1] for pair in pairs])
+    candidate = np.array([pair[2] for pair in pairs])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 100 / np.abs(means[baseline])
+        delta = (means[candidate] - means[baseline]) * scale
+        variance_b = variances[baseline] / counts[baseline]
+        variance_c = variances[candidate] / counts[candidate]
+        # Welch-Satterthwaite degrees of freedom
+        df = (variance_b + variance_c) ** 2 / (variance_b ** 2 / (counts[baseline] - 1) + variance_c ** 2 / (counts[candidate] - 1))
+        margin = t_critical(df) * np.sqrt(variance_b + variance_c) * scale
+    ci_low, ci_high = delta - margin, delta + margin
+
+    lower_is_better = np.array([(panels[key[0]].get("panel_direction") or ("lower" if groups[index][3] in LOWER_IS_BETTER_UNITS else "higher")) == "lower"
+                                for key, _, index in pairs])
+    worse = np.where(lower_is_better, delta, -delta)
+    worse_low = np.where(lower_is_better, ci_low, -ci_high)
+    worse_high = np.where(lower_is_better, ci_high, -ci_low)
+    # Without several runs per version there is no interval and the threshold alone decides
+    has_interval = np.isfinite(margin)
+    regression = np.isfinite(delta) & (worse > threshold) & (~has_interval | (worse_low > 0))
+    improvement = np.isfinite(delta) & (worse < -threshold) & (~has_interval | (worse_high < 0))
+    outcome = np.where(regression, "regression", np.where(improvement, "improvement", np.where(np.isfinite(delta), "no change", "n/a")))
+
+    for pair_index, ((panel_index, metric), baseline_index, candidate_index) in enumerate(pairs):
+        current = verdicts[panel_index]
+        rank = (VERDICTS.index(outcome[pair_index]), abs(np.nan_to_num(delta[pair_index])))
+        if current["Metric"] != "" and rank <= (VERDICTS.index(current["Verdict"]), abs(current["Delta %"] or 0)):
+            continue
+        change_point = ""
+        if split_scores[candidate_index] > CHANGE_POINT_SCORE:
+            change_time = times[candidate_index, split_indexes[candidate_index]]
+            change_point = time.strftime("%Y-%m-%d %H:%M", time.gmtime(change_time / 1000)) if change_time > 10 ** 11 else f"run {change_time + 1}"
+        verdicts[panel_index] = {
+            "Metric": metric,
+            "Baseline": groups[baseline_index][2],
+            "Candidate": groups[candidate_index][2],
+            "Baseline Mean": round_value(means[baseline_index]),
+            "Candidate Mean": round_value(means[candidate_index]),
+            "Delta %": round_value(delta[pair_index]),
+            "CI Low %": round_value(ci_low[pair_index]),
+            "CI High %": round_value(ci_high[pair_index]),
+            "Change Point": change_point,
+            "Verdict": str(outcome[pair_index]),
+        }
+    logger.info(f"Compared {len(pairs)} metrics of {len(panels)} panels in {1000 * (time.perf_counter() - started):.1f}ms: "
+                f"{int(regression.sum())} regressions, {int(improvement.sum())} improvements")
+    return verdicts
+
+def round_value(value: float) -> float | str:
+    return "" if not np.isfinite(value) else float(f"{value:.4g}")
+
+def verdict_row(verdict: dict) -> list:
+    """
+    Csv cells of a verdict.
+
+    Args:
+        verdict (dict): verdict returned by analyze_panels
+
+    Returns:
+        list: values of ANALYSIS_COLUMNS
+    """
+    return [verdict[column] for column in ANALYSIS_COLUMNS]
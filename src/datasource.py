@@ -0,0 +1,526 @@
+import re
+import os
+import json
+import shutil
+import logging
+import threading
+import numpy as np
+from typing import Any
+from datetime import datetime, timezone
+from urllib.parse import quote, urlparse
+from src.grafana import DATA_EXTENSION, panel_image_path, render_cache_ttl
+from utils.cache import make_cache_key
+from utils.tracing import annotate_span
+from utils.utils import HTTP_ERRORS, get_grafana_session
+
+logger = logging.getLogger(__name__)
+
+# Series summarized per panel, the remaining ones are only counted to keep prompts compact
+MAX_SUMMARY_SERIES = 50
+
+# $var, [[var]], [[var:format]], ${var} and ${var:format}
+VARIABLE_PATTERN = re.compile(r"\$(\w+)|\[\[(\w+?)(?::(\w+))?\]\]|\$\{(\w+)(?:\.[^:}]+)?(?::([^}]+))?\}")
+
+# Format grafana applies to multi-value variables when the query doesn't name one
+DEFAULT_MULTI_FORMATS = {
+    "prometheus": "regex",
+    "loki": "regex",
+    "elasticsearch": "lucene",
+    "opensearch": "lucene",
+}
+
+# Datasources resolved by name during this run, keyed by grafana url and name
+_datasources = {}
+_datasources_lock = threading.Lock()
+
+RELATIVE_TIME_UNITS = {"s": 1000, "m": 60 * 1000, "h": 3600 * 1000, "d": 24 * 3600 * 1000, "w": 7 * 24 * 3600 * 1000, "M": 30 * 24 * 3600 * 1000, "y": 365 * 24 * 3600 * 1000}
+
+def find_panel(panels: list, panel_id: int) -> dict | None:
+    """
+    Find the json of a panel in a dashboard, including the panels nested in rows.
+
+    Args:
+        panels (list): panels of the dashboard json
+        panel_id (int): id of the panel
+
+    Returns:
+        dict | None: panel json or None if there is no such panel
+    """
+    for panel in panels:
+        if panel.get("id") == panel_id and panel.get("type") != "row":
+            return panel
+        nested_panel = find_panel(panel.get("panels", []), panel_id)
+        if nested_panel is not None:
+            return nested_panel
+    return None
+
+def dashboard_variables(templating: list) -> dict[str, dict]:
+    """
+    Current values of the template variables of a dashboard.
+
+    Args:
+        templating (list): templating list of the dashboard json
+
+    Returns:
+        dict[str, dict]: values, all value and options of every variable
+    """
+    variables = {}
+    for variable in templating:
+        current = variable.get("current") or {}
+        values = current.get("value", [])
+        variables[variable["name"]] = {
+            "values": [str(value) for value in (values if isinstance(values, list) else [values])],
+            "all_value": variable.get("allValue"),
+            "options": [str(option["value"]) for option in variable.get("options", []) if option.get("value") != "$__all"],
+        }
+    return variables
+
+def attach_panel_queries(extracted_panels: list[dict], dashboard: dict, d_query_params: dict) -> list[dict]:
+    """
+    Attach the json of every extracted panel and the dashboard variables, so panels can be queried without the dashboard.
+
+    Args:
+        extracted_panels (list[dict]): panels returned by extract_panels
+        dashboard (dict): dashboard returned by get_dashboard_metadata
+        d_query_params (dict): dashboard query parameters, including the var-* values
+
+    Returns:
+        list[dict]: the same panels
+    """
+    variables = dashboard_variables(dashboard.get("templating", []))
+    # Values in the dashboard url win over the ones saved with the dashboard
+    for key, values in d_query_params.items():
+        if key.startswith("var-"):
+            name = key[len("var-"):]
+            variables[name] = {**variables.get(name, {"all_value": None, "options": []}), "values": values}
+    for each_panel in extracted_panels:
+        each_panel["panel_json"] = find_panel(dashboard["panels"], each_panel["panel_id"]) or {}
+        each_panel["dashboard_variables"] = variables
+    return extracted_panels
+
+def time_range_ms(time_from: str, time_to: str) -> tuple[int, int] | None:
+    """
+    Resolve a dashboard time range into epoch milliseconds.
+
+    Args:
+        time_from (str): epoch milliseconds or a relative time such as now-7d
+        time_to (str): epoch milliseconds or a relative time such as now
+
+    Returns:
+        tuple[int, int] | None: start and end in epoch milliseconds, None if the range can't be resolved
+    """
+    now = int(datetime.now(timezone.utc).timestamp() * 1000)
+    resolved = []
+    for value in (str(time_from), str(time_to)):
+        if value.isdigit():
+            resolved.append(int(value))
+            continue
+        match = re.fullmatch(r"now(?:-(\d+)([smhdwMy]))?(?:/[smhdwMy])?", value)
+        if match is None:
+            return None
+        resolved.append(now - int(match.group(1) or 0) * RELATIVE_TIME_UNITS.get(match.group(2), 0))
+    return resolved[0], resolved[1]
+
+def format_variable(values: list[str], variable_format: str, multi: bool) -> str:
+    """
+    Format the values of a template variable the way grafana interpolates them.
+
+    Args:
+        values (list[str]): values of the variable
+        variable_format (str): grafana format such as csv, pipe, regex, lucene, glob, json, doublequote, singlequote or raw
+        multi (bool): whether the variable has several values or is set to all
+
+    Returns:
+        str: interpolated text
+    """
+    match variable_format:
+        case "csv" | "text":
+            return ",".join(values)
+        case "pipe":
+            return "|".join(values)
+        case "json":
+            return json.dumps(values)
+        case "doublequote":
+            return ",".join(f'"{value}"' for value in values)
+        case "singlequote" | "sqlstring":
+            return ",".join("'" + value.replace("'", "''") + "'" for value in values)
+        case "percentencode":
+            return quote(",".join(values) if len(values) > 1 else values[0], safe="")
+        case "regex":
+            escaped = [re.escape(value) for value in values]
+            return f"({'|'.join(escaped)})" if multi else escaped[0]
+        case "lucene":
+            escaped = [re.sub(r'([\\+\-!(){}\[\]^"~*?:/ ]|&&|\|\|)', r"\\\1", value) for value in values]
+            return "(" + " OR ".join(f'"{value}"' for value in escaped) + ")" if multi else escaped[0]
+        case "glob":
+            return "{" + ",".join(values) + "}" if multi else values[0]
+        case _:
+            return ",".join(values)
+
+def substitute_variables(value: Any, variables: dict[str, dict], datasource_type: str) -> Any:
+    """
+    Substitute the template variables of every string in a query.
+
+    Args:
+        value (Any): query json or a part of it
+        variables (dict[str, dict]): values, all value and options of every variable, as returned by dashboard_variables
+        datasource_type (str): type of the queried datasource, deciding the default format of multi-value variables
+
+    Returns:
+        Any: a copy with the variables substituted, unknown variables are left as they are
+    """
+    if isinstance(value, dict):
+        return {key: substitute_variables(each_value, variables, datasource_type) for key, each_value in value.items()}
+    if isinstance(value, list):
+        return [substitute_variables(each_value, variables, datasource_type) for each_value in value]
+    if not isinstance(value, str) or ("$" not in value and "[[" not in value):
+        return value
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1) or match.group(2) or match.group(4)
+        variable_format = match.group(3) or match.group(5)
+        variable = variables.get(name)
+        if variable is None or not variable["values"]:
+            return match.group(0)
+        values = variable["values"]
+        multi = len(values) > 1
+        if values in (["$__all"], ["All"]):
+            if variable["all_value"]:
+                return variable["all_value"]
+            multi = True
+            # Without options the whole range of the variable is matched with a wildcard
+            values = variable["options"] or None
+            if values is None:
+                return ".*" if (variable_format or DEFAULT_MULTI_FORMATS.get(datasource_type)) == "regex" else "*"
+        if variable_format is None:
+            variable_format = DEFAULT_MULTI_FORMATS.get(datasource_type, "glob") if multi else "raw"
+        return format_variable(values, variable_format, multi)
+
+    return VARIABLE_PATTERN.sub(replace, value)
+
+def resolve_datasource(session: Any, g_url: str, datasource: Any) -> dict | None:
+    """
+    Resolve the datasource reference of a panel or target into its uid and type.
+    References by name, used by older dashboards, are looked up once per run.
+
+    Args:
+        session (Any): grafana session
+        g_url (str): grafana url
+        datasource (Any): datasource reference, a {uid, type} object or a datasource name
+
+    Returns:
+        dict | None: uid and type of the datasource, None if the panel has no datasource
+    """
+    if isinstance(datasource, dict) and datasource.get("uid"):
+        return {"uid": datasource["uid"], "type": datasource.get("type", "")}
+    name = datasource if isinstance(datasource, str) else None
+    if not name:
+        return None
+    with _datasources_lock:
+        if (g_url, name) in _datasources:
+            return _datasources[(g_url, name)]
+    response = session.get(f"{g_url}/api/datasources/name/{quote(name, safe='')}")
+    if response.status_code == 404:
+        # Newer grafana releases accept the uid wherever the name used to be
+        resolved = {"uid": name, "type": ""}
+    else:
+        response.raise_for_status()
+        resolved = {"uid": response.json()["uid"], "type": response.json().get("type", "")}
+    with _datasources_lock:
+        _datasources[(g_url, name)] = resolved
+    return resolved
+
+def build_panel_query(session: Any, g_url: str, each_panel: dict, d_query_params: dict) -> dict:
+    """
+    Build the /api/ds/query request of a panel out of its targets.
+
+    Args:
+        session (Any): grafana session
+        g_url (str): grafana url
+        each_panel (dict): panel with the panel_json and dashboard_variables attached by attach_panel_queries
+        d_query_params (dict): dashboard query parameters
+
+    Returns:
+        dict: request body, with no queries if the panel has no target to query
+    """
+    panel_json = each_panel["panel_json"]
+    time_from = d_query_params.get("from", ["now-6h"])[0]
+    time_to = d_query_params.get("to", ["now"])[0]
+    max_data_points = int(panel_json.get("maxDataPoints") or each_panel["panel_width"])
+    time_range = time_range_ms(time_from, time_to)
+    interval_ms = max(1, (time_range[1] - time_range[0]) // max_data_points) if time_range else 60 * 1000
+
+    variables = dict(each_panel["dashboard_variables"])
+    builtins = {"__interval_ms": str(interval_ms), "__interval": f"{max(1, interval_ms // 1000)}s"}
+    if time_range:
+        builtins.update({"__from": str(time_range[0]), "__to": str(time_range[1]), "__range_s": str((time_range[1] - time_range[0]) // 1000)})
+    variables.update({name: {"values": [value], "all_value": None, "options": []} for name, value in builtins.items()})
+
+    queries = []
+    for target in panel_json.get("targets", []):
+        if target.get("hide"):
+            continue
+        datasource = target.get("datasource") or panel_json.get("datasource")
+        if isinstance(datasource, dict) and datasource.get("uid") == "-- Mixed --":
+            datasource = None
+        datasource = resolve_datasource(session, g_url, substitute_variables(datasource, variables, ""))
+        if datasource is None:
+            logger.warning(f"Target {target.get('refId', '')} of panel {each_panel['panel_id']} has no datasource, skipping it")
+            continue
+        query = substitute_variables(target, variables, datasource["type"])
+        query.update({"datasource": datasource, "maxDataPoints": max_data_points, "intervalMs": interval_ms})
+        queries.append(query)
+    return {"queries": queries, "from": str(time_range[0]) if time_range else time_from, "to": str(time_range[1]) if time_range else time_to}
+
+def field_values(values: list, entities: dict | None) -> np.ndarray:
+    """
+    Load the values of a numeric field, restoring the NaN and infinite values grafana encodes separately.
+
+    Args:
+        values (list): values of the field, null where there is no value
+        entities (dict | None): indexes of the NaN, Inf and NegInf values of the field
+
+    Returns:
+        np.ndarray: float64 values, NaN where there is no value
+    """
+    array = np.array(values, dtype=np.float64)
+    for entity, replacement in (("NaN", np.nan), ("Inf", np.inf), ("NegInf", -np.inf)):
+        indexes = (entities or {}).get(entity)
+        if indexes:
+            array[indexes] = replacement
+    return array
+
+def series_name(frame: dict, field: dict, value_fields: int) -> str:
+    """
+    Display name of a series, following the order grafana picks it in.
+
+    Args:
+        frame (dict): data frame of the series
+        field (dict): value field of the series
+        value_fields (int): number of value fields in the frame
+
+    Returns:
+        str: name of the series
+    """
+    config = field.get("config") or {}
+    if config.get("displayNameFromDS") or config.get("displayName"):
+        return config.get("displayNameFromDS") or config.get("displayName")
+    frame_name = frame["schema"].get("name", "")
+    if frame_name and value_fields == 1:
+        return frame_name
+    labels = field.get("labels") or {}
+    if labels:
+        return f"{field.get('name', '')} {', '.join(f'{key}={value}' for key, value in sorted(labels.items()))}".strip()
+    return field.get("name", "") or frame_name
+
+def frames_to_series(response_json: dict, default_unit: str = "") -> list[dict]:
+    """
+    Load the data frames of a /api/ds/query response into one numpy series per numeric field.
+
+    Args:
+        response_json (dict): json response of /api/ds/query
+        default_unit (str): unit of the panel, used for fields without one
+
+    Returns:
+        list[dict]: ref_id, name, labels, unit, time (epoch milliseconds or None) and values of every series
+    """
+    series = []
+    for ref_id, result in response_json.get("results", {}).items():
+        if result.get("error"):
+            logger.warning(f"Query {ref_id} failed: {result['error']}")
+        for frame in result.get("frames", []):
+            fields = frame["schema"].get("fields", [])
+            data = frame.get("data", {})
+            columns = data.get("values", [])
+            entities = data.get("entities") or [None] * len(columns)
+            time_index = next((index for index, field in enumerate(fields) if field.get("type") == "time"), None)
+            times = rows = None
+            if time_index is not None and time_index < len(columns):
+                # Sparse series can have null timestamps, their rows are dropped from every field of the frame
+                times = np.array(columns[time_index], dtype=np.float64)
+                rows = np.isfinite(times)
+                times = times[rows].astype(np.int64)
+            value_indexes = [index for index, field in enumerate(fields) if field.get("type") == "number" and index < len(columns)]
+            for index in value_indexes:
+                field = fields[index]
+                values = field_values(columns[index], entities[index] if index < len(entities) else None)
+                if rows is not None and len(values) == len(rows):
+                    values = values[rows]
+                series.append({
+                    "ref_id": ref_id,
+                    "name": series_name(frame, field, len(value_indexes)),
+                    "labels": field.get("labels") or {},
+                    "unit": (field.get("config") or {}).get("unit", default_unit),
+                    "time": times,
+                    "values": values,
+                })
+    return series
+
+def write_series(series: list[dict], path: str) -> int:
+    """
+    Write series to a json file, with null where there is no finite value.
+
+    Args:
+        series (list[dict]): series returned by frames_to_series
+        path (str): file to write
+
+    Returns:
+        int: bytes written
+    """
+    payload = []
+    for each_series in series:
+        values = each_series["values"].astype(object)
+        values[~np.isfinite(each_series["values"])] = None
+        payload.append({
+            **{key: each_series[key] for key in ("ref_id", "name", "labels", "unit")},
+            "time": None if each_series["time"] is None else each_series["time"].tolist(),
+            "values": values.tolist(),
+        })
+    content = json.dumps(payload)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
+    return len(content)
+
+def read_series(path: str) -> list[dict]:
+    """
+    Read series written by write_series.
+
+    Args:
+        path (str): json file of the series
+
+    Returns:
+        list[dict]: series with numpy time and values
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        payload = json.load(file)
+    for each_series in payload:
+        each_series["time"] = None if each_series["time"] is None else np.array(each_series["time"], dtype=np.int64)
+        each_series["values"] = np.array(each_series["values"], dtype=np.float64)
+    return payload
+
+def format_number(value: float) -> str:
+    return "n/a" if np.isnan(value) else f"{value:.4g}"
+
+def summarize_series(series: list[dict], panel_title: str, max_series: int = MAX_SUMMARY_SERIES) -> str:
+    """
+    Summarize the series of a panel as compact text: one line of exact statistics per series.
+
+    Args:
+        series (list[dict]): series returned by frames_to_series
+        panel_title (str): title of the panel
+        max_series (int): maximum number of series to describe
+
+    Returns:
+        str: summary of the panel data
+    """
+    if not series:
+        return f"Panel {panel_title}: no data"
+    lines = []
+    times = [each_series["time"] for each_series in series if each_series["time"] is not None and len(each_series["time"])]
+    if times:
+        start = datetime.fromtimestamp(min(each_time.min() for each_time in times) / 1000, timezone.utc)
+        end = datetime.fromtimestamp(max(each_time.max() for each_time in times) / 1000, timezone.utc)
+        lines.append(f"Panel {panel_title} from {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M} UTC")
+    else:
+        lines.append(f"Panel {panel_title}")
+    for each_series in series[:max_series]:
+        values = each_series["values"]
+        finite = values[np.isfinite(values)]
+        unit = f" [{each_series['unit']}]" if each_series["unit"] else ""
+        if finite.size == 0:
+            lines.append(f"- {each_series['name']}{unit}: no values")
+            continue
+        first, last = finite[0], finite[-1]
+        change = f", change {100 * (last - first) / abs(first):+.1f}%" if first != 0 and finite.size > 1 else ""
+        p95 = np.percentile(finite, 95)
+        lines.append(f"- {each_series['name']}{unit}: {finite.size} points, first {format_number(first)}, last {format_number(last)}, "
+                     f"min {format_number(finite.min())}, mean {format_number(finite.mean())}, max {format_number(finite.max())}, "
+                     f"p95 {format_number(p95)}{change}")
+    if len(series) > max_series:
+        lines.append(f"- and {len(series) - max_series} more series")
+    return "\n".join(lines)
+
+def panel_data_path(each_panel: dict) -> str:
+    """
+    Data file of a queried panel, which sits next to its image when the panel is drawn locally.
+
+    Args:
+        each_panel (dict): panel queried by query_panel
+
+    Returns:
+        str: path of the data file
+    """
+    return os.path.splitext(each_panel["panel_image"])[0] + DATA_EXTENSION
+
+def load_panel_data(each_panel: dict) -> str:
+    """
+    Summarize the series a panel was queried into.
+
+    Args:
+        each_panel (dict): panel queried by query_panel
+
+    Returns:
+        str: summary of the panel data
+    """
+    return summarize_series(read_series(panel_data_path(each_panel)), each_panel["panel_title"] or f"panel_{each_panel['panel_id']}")
+
+def data_cache_key(g_url: str, each_panel: dict, d_query_params: dict) -> str:
+    """
+    Cache key identifying a panel data query. It is built from the inputs of the query rather than the query itself,
+    whose time range moves with relative ranges such as now-7d, so render_cache_ttl applies like for renders.
+
+    Args:
+        g_url (str): grafana url
+        each_panel (dict): panel with the panel_json and dashboard_variables attached by attach_panel_queries
+        d_query_params (dict): dashboard query parameters
+
+    Returns:
+        str: cache key of the query
+    """
+    panel_json = each_panel["panel_json"]
+    return make_cache_key("data", g_url, panel_json.get("datasource"), panel_json.get("targets"), panel_json.get("maxDataPoints"),
+                          each_panel["panel_width"], each_panel["dashboard_variables"], sorted(d_query_params.items()))
+
+def query_panel(each_panel: dict, args: tuple) -> dict | None:
+    """
+    Query the data of a panel from its datasources instead of rendering it.
+    The series are written to a json file in place of the panel image and summarized into panel_data.
+
+    Args:
+        each_panel (dict): panel with the panel_json and dashboard_variables attached by attach_panel_queries
+        args (tuple): process_panel arguments
+
+    Returns:
+        dict | None: queried panel or None if the query failed
+    """
+    g_url, d_uid, g_username, g_password, d_output, d_query_params, d_version, render_cache, cache_ttl = args
+    panel_name, data_path = panel_image_path(each_panel, d_output, DATA_EXTENSION)
+    each_panel["panel_image"] = data_path
+    annotate_span(host=urlparse(g_url).netloc, panel=panel_name)
+    try:
+        cache_key = data_cache_key(g_url, each_panel, d_query_params) if render_cache is not None else None
+        cached_data = render_cache.get_file(cache_key, render_cache_ttl(d_query_params, cache_ttl)) if cache_key is not None else None
+        if cached_data is not None:
+            shutil.copyfile(cached_data, data_path)
+            each_panel["render_cache"] = "hit"
+            annotate_span(status="cached")
+            logger.info(f"Queried {panel_name} to {data_path} from render cache")
+        else:
+            d_session = get_grafana_session(g_url, g_username, g_password)
+            query = build_panel_query(d_session, g_url, each_panel, d_query_params)
+            if not query["queries"]:
+                logger.warning(f"Panel {panel_name} has no query to run. Hence skipping it")
+                return None
+            response = d_session.post(f"{g_url}/api/ds/query", json=query)
+            response.raise_for_status()
+            default_unit = ((each_panel["panel_json"].get("fieldConfig") or {}).get("defaults") or {}).get("unit", "")
+            series = frames_to_series(response.json(), default_unit)
+            annotate_span(bytes=write_series(series, data_path))
+            if cache_key is not None:
+                render_cache.put_file(cache_key, data_path)
+            logger.info(f"Queried {panel_name} to {data_path}")
+        each_panel["panel_data"] = load_panel_data(each_panel)
+        return each_panel
+    except (*HTTP_ERRORS, ValueError, KeyError, TypeError) as e:
+        logger.error(f"Error querying panel {each_panel['panel_id']}: {e}")
+        return None
@@ -1,41 +1,302 @@
 import os
+import json
+import hashlib
 import logging
+import tempfile
+import threading
 from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+from filelock import FileLock
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
+from src.images import image_mime_type
+from utils.concurrency import get_limiter
+from utils.tracing import annotate_span, span
 
 logger = logging.getLogger(__name__)
 
-def upload_image_to_drive(service: Any, image_path: str) -> str:
+# Drive accepts up to 100 calls in a single batch request
+DRIVE_BATCH_SIZE = 100
+
+# Permission making uploaded images publicly readable
+PUBLIC_PERMISSION = {
+    'type': 'anyone',
+    'role': 'reader'
+}
+
+class DriveManifest:
+    """
+    Local record of the images uploaded to drive, keyed by their source and by their content hash.
+    Every read-modify-write holds a file lock, so a manifest can be shared by concurrent workers and runs.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Initialize the manifest.
+
+        Args:
+            path (str): manifest json file path
+        """
+        self.path = path
+        self.lock = FileLock(f"{path}.lock")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {"files": {}, "hashes": {}}
+        except ValueError as e:
+            logger.warning(f"Ignoring unreadable drive manifest {self.path}: {e}")
+            return {"files": {}, "hashes": {}}
+
+    def _write(self, manifest: dict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".tmp-")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, key: str, content_hash: str) -> tuple[str | None, str | None]:
+        """
+        Look up the drive files of an image.
+
+        Args:
+            key (str): source image identifier
+            content_hash (str): sha256 of the image to upload
+
+        Returns:
+            tuple[str | None, str | None]: file id already holding this content, and the file id of key that can be updated in place
+        """
+        with self.lock:
+            manifest = self._read()
+        previous = manifest["files"].get(key)
+        if previous is not None and previous["sha256"] == content_hash:
+            return previous["file_id"], previous["file_id"]
+        updatable_file_id = None
+        if previous is not None:
+            # A file shared with other images must keep its content
+            shared = any(entry["file_id"] == previous["file_id"] for other_key, entry in manifest["files"].items() if other_key != key)
+            updatable_file_id = None if shared else previous["file_id"]
+        return manifest["hashes"].get(content_hash), updatable_file_id
+
+    def record(self, key: str, content_hash: str, file_id: str) -> None:
+        """
+        Record the drive file holding an image.
+
+        Args:
+            key (str): source image identifier
+            content_hash (str): sha256 of the uploaded image
+            file_id (str): drive file id
+
+        Returns:
+            None
+        """
+        with self.lock:
+            manifest = self._read()
+            previous = manifest["files"].get(key)
+            if previous is not None and previous["file_id"] == file_id and manifest["hashes"].get(previous["sha256"]) == file_id:
+                # The file was updated in place and no longer holds its previous content
+                del manifest["hashes"][previous["sha256"]]
+            manifest["files"][key] = {"file_id": file_id, "sha256": content_hash}
+            manifest["hashes"][content_hash] = file_id
+            self._write(manifest)
+
+    def forget(self, key: str) -> None:
+        """
+        Drop an image from the manifest, so it is uploaded again on the next run.
+
+        Args:
+            key (str): source image identifier
+
+        Returns:
+            None
+        """
+        with self.lock:
+            manifest = self._read()
+            previous = manifest["files"].pop(key, None)
+            if previous is None:
+                return
+            if manifest["hashes"].get(previous["sha256"]) == previous["file_id"]:
+                del manifest["hashes"][previous["sha256"]]
+            self._write(manifest)
+
+def execute_drive_request(request: Any, http: Any = None) -> Any:
+    """
+    Execute a drive request within the adaptive concurrency limit of the google apis.
+
+    Args:
+        request (Any): drive api request
+        http (Any): http object to execute the request with
+
+    Returns:
+        Any: response of the request
+    """
+    with span(f"google {getattr(request, 'methodId', 'batch')}"), get_limiter("google").slot():
+        return request.execute(http=http)
+
+def drive_image_url(file_id: str) -> str:
+    """
+    Public url of a drive file.
+
+    Args:
+        file_id (str): drive file id
+
+    Returns:
+        str: url of the file
+    """
+    return f'https://drive.google.com/uc?id={file_id}'
+
+def create_drive_service(credentials: Any) -> Any:
+    """
+    Build the drive client once per run.
+
+    Args:
+        credentials (Any): google credentials
+
+    Returns:
+        Any: drive v3 service
+    """
+    return build('drive', 'v3', credentials=credentials)
+
+def upload_image_to_drive(drive_service: Any, image_path: str, file_name: str = "", manifest: DriveManifest | None = None, manifest_key: str = "", http: Any = None, share: bool = True) -> tuple[str, bool]:
     """
     Function to upload an image to drive.
+    With a manifest, unchanged images reuse their drive file without any api call and changed images replace the content of their previous file.
 
     Args:
-        service (Any): google client service object
+        drive_service (Any): drive service object
         image_path (int): source image_path that needs to be uploaded in drive
+        file_name (str): name of the file in drive, defaults to the image file name
+        manifest (DriveManifest | None): manifest of the images already uploaded
+        manifest_key (str): identifier of the image in the manifest, defaults to its absolute path
+        http (Any): http object to execute the requests with, required when uploading from several threads
+        share (bool): make newly created files publicly readable. When False the caller has to share them
+
+    Returns:
+        tuple[str, bool]: drive file id holding the image and whether a new file was created
+    """
+    content_hash = None
+    updatable_file_id = None
+    if manifest is not None:
+        manifest_key = manifest_key or os.path.abspath(image_path)
+        with open(image_path, "rb") as image_file:
+            content_hash = hashlib.sha256(image_file.read()).hexdigest()
+        file_id, updatable_file_id = manifest.lookup(manifest_key, content_hash)
+        if file_id is not None:
+            if file_id != updatable_file_id:
+                manifest.record(manifest_key, content_hash, file_id)
+            logger.info(f"Image:{image_path} is unchanged, reusing url:{drive_image_url(file_id)}")
+            annotate_span(status="cached")
+            return file_id, False
+
+    mime_type = image_mime_type(image_path)
+    annotate_span(bytes=os.path.getsize(image_path))
+
+    uploaded_file = None
+    created = False
+    if updatable_file_id is not None:
+        # Updating the content in place keeps the file id, its url and its public permission
+        try:
+            media = MediaFileUpload(image_path, mimetype=mime_type)
+            uploaded_file = execute_drive_request(drive_service.files().update(fileId=updatable_file_id, media_body=media, fields='id'), http)
+        except HttpError as e:
+            if e.resp.status not in (403, 404):
+                raise
+            logger.info(f"Drive file {updatable_file_id} of image:{image_path} is no longer available, uploading a new one")
+
+    if uploaded_file is None:
+        # File metadata
+        file_metadata = {
+            'name': file_name or os.path.basename(image_path),
+            'mimeType': mime_type
+        }
+        media = MediaFileUpload(image_path, mimetype=mime_type)
+
+        # Upload the file
+        uploaded_file = execute_drive_request(drive_service.files().create(body=file_metadata, media_body=media, fields='id'), http)
+        created = True
+
+        if share:
+            # Set the permissions to make the file publicly accessible
+            execute_drive_request(drive_service.permissions().create(fileId=uploaded_file['id'], body=PUBLIC_PERMISSION), http)
+
+    if manifest is not None:
+        manifest.record(manifest_key, content_hash, uploaded_file['id'])
+    logger.info(f"Uploaded image:{image_path} to url:{drive_image_url(uploaded_file['id'])}")
+    return uploaded_file['id'], created
+
+def share_drive_files(drive_service: Any, file_ids: list[str]) -> set[str]:
+    """
+    Make drive files publicly readable, grouping the permission calls into batch requests.
+
+    Args:
+        drive_service (Any): drive service object
+        file_ids (list[str]): files to share
+
+    Returns:
+        set[str]: files that could not be shared
+    """
+    failed = set()
+
+    def on_response(request_id: str, response: Any, exception: Exception) -> None:
+        if exception is not None:
+            logger.error(f"Unable to share drive file {request_id}: {exception}")
+            failed.add(request_id)
+
+    for start in range(0, len(file_ids), DRIVE_BATCH_SIZE):
+        batch = drive_service.new_batch_http_request(callback=on_response)
+        for file_id in file_ids[start:start + DRIVE_BATCH_SIZE]:
+            batch.add(drive_service.permissions().create(fileId=file_id, body=PUBLIC_PERMISSION), request_id=file_id)
+        execute_drive_request(batch)
+    return failed
+
+def upload_images_to_drive(drive_service: Any, credentials: Any, images: list[tuple[str, str, str]], manifest: DriveManifest | None, max_workers: int) -> list[str | None]:
+    """
+    Upload images to drive concurrently, then share all the new files with batched permission calls.
+
+    Args:
+        drive_service (Any): drive service object
+        credentials (Any): google credentials, used to authorize the http object of every upload thread
+        images (list[tuple[str, str, str]]): (image path, drive file name, manifest key) of every image
+        manifest (DriveManifest | None): manifest of the images already uploaded
+        max_workers (int): maximum concurrent uploads
 
     Returns:
-        image_url (str): url where the image is uploaded in google drive
-    """
-    drive_service = build('drive', 'v3', credentials=service._http.credentials)
-
-    # File metadata
-    file_metadata = {
-        'name': os.path.basename(image_path),
-        'mimeType': 'image/png'
-    }
-    media = MediaFileUpload(image_path, mimetype='image/png')
-
-    # Upload the file
-    uploaded_file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-
-    # Set the permissions to make the file publicly accessible
-    permission = {
-        'type': 'anyone',
-        'role': 'reader'
-    }
-    drive_service.permissions().create(fileId=uploaded_file['id'], body=permission).execute()
-
-    image_url = f'https://drive.google.com/uc?id={uploaded_file["id"]}'
-    logger.info(f"Uploaded image:{image_path} to url:{image_url}")
-    return image_url
+        list[str | None]: url of every image, None for the ones that failed
+    """
+    # httplib2 objects are not thread safe, every upload thread gets its own
+    local = threading.local()
+
+    def upload(image: tuple[str, str, str]) -> tuple[str, bool] | None:
+        image_path, file_name, manifest_key = image
+        if not hasattr(local, "http"):
+            local.http = AuthorizedHttp(credentials, http=httplib2.Http())
+        with span("drive upload", image=image_path) as attributes:
+            try:
+                return upload_image_to_drive(drive_service, image_path, file_name, manifest, manifest_key, local.http, share=False)
+            except (HttpError, OSError) as e:
+                attributes["status"] = "error"
+                logger.error(f"Unable to upload image:{image_path}: {e}")
+                return None
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        uploads = list(pool.map(upload, images))
+
+    failed = share_drive_files(drive_service, [upload[0] for upload in uploads if upload is not None and upload[1]])
+    image_urls = []
+    for (image_path, _, manifest_key), upload in zip(images, uploads):
+        if upload is None:
+            image_urls.append(None)
+        elif upload[0] in failed:
+            if manifest is not None:
+                manifest.forget(manifest_key or os.path.abspath(image_path))
+            image_urls.append(None)
+        else:
+            image_urls.append(drive_image_url(upload[0]))
+    return image_urls
@@ -0,0 +1,214 @@
+import io
+import os
+import re
+import json
+import mmap
+import zlib
+import base64
+import logging
+import threading
+import numpy as np
+from PIL import Image
+from utils.cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FEATURE_SIZE = (32, 32)
+TEXT_FEATURE_DIMS = 256
+
+# Indexes opened by this process, keyed by index directory
+_few_shot_indexes = {}
+_few_shot_indexes_lock = threading.Lock()
+
+def image_features(image_bytes: bytes) -> np.ndarray:
+    """
+    Cheap visual fingerprint of an image: a normalized thumbnail of its grayscale pixels.
+
+    Args:
+        image_bytes (bytes): encoded image
+
+    Returns:
+        np.ndarray: unit length feature vector
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        thumbnail = np.asarray(image.convert("L").resize(IMAGE_FEATURE_SIZE), dtype=np.float32).ravel()
+    thumbnail -= thumbnail.mean()
+    norm = np.linalg.norm(thumbnail)
+    return thumbnail / norm if norm else thumbnail
+
+def text_features(text: str) -> np.ndarray:
+    """
+    Hashed bag of words of a text.
+
+    Args:
+        text (str): text to fingerprint
+
+    Returns:
+        np.ndarray: unit length feature vector
+    """
+    features = np.zeros(TEXT_FEATURE_DIMS, dtype=np.float32)
+    for token in re.findall(r"[a-z0-9_.]+", text.lower()):
+        # crc32 is stable across processes unlike hash()
+        features[zlib.crc32(token.encode("utf-8")) % TEXT_FEATURE_DIMS] += 1
+    norm = np.linalg.norm(features)
+    return features / norm if norm else features
+
+def build_few_shot_index(few_shot_file_path: str, index_root: str) -> str:
+    """
+    Parse the few-shot examples file once and write a pre-indexed copy of it.
+    The index holds one example per line with their byte offsets and the similarity features of every example,
+    so workers can memory map it and decode only the examples they select.
+
+    Args:
+        few_shot_file_path (str): few-shot examples file path
+        index_root (str): directory to keep the indexes in
+
+    Returns:
+        str: index directory
+    """
+    stat = os.stat(few_shot_file_path)
+    index_dir = os.path.join(index_root, make_cache_key("fewshot", os.path.abspath(few_shot_file_path), stat.st_size, stat.st_mtime_ns))
+    if os.path.exists(os.path.join(index_dir, "text_features.npy")):
+        logger.debug(f"Reusing few-shot index at {index_dir}")
+        return index_dir
+
+    with open(few_shot_file_path, "r") as f:
+        all_examples = json.load(f).get("examples", [])
+    os.makedirs(index_dir, exist_ok=True)
+
+    offsets = [0]
+    all_image_features = []
+    all_text_features = []
+    with open(os.path.join(index_dir, "examples.jsonl"), "wb") as examples_file:
+        for ex in all_examples:
+            line = (json.dumps(ex) + "\n").encode("utf-8")
+            examples_file.write(line)
+            offsets.append(offsets[-1] + len(line))
+            try:
+                all_image_features.append(image_features(base64.b64decode(ex["image_b64"])))
+            except Exception as e:
+                logger.warning(f"Could not decode few-shot example image: {e}")
+                all_image_features.append(np.zeros(IMAGE_FEATURE_SIZE[0] * IMAGE_FEATURE_SIZE[1], dtype=np.float32))
+            all_text_features.append(text_features(f"{ex.get('query', '')} {ex.get('answer', '')} {ex.get('explanation', '')}"))
+
+    np.save(os.path.join(index_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(index_dir, "image_features.npy"), np.asarray(all_image_features, dtype=np.float32).reshape(len(all_examples), -1))
+    # Written last, its presence marks a complete index
+    np.save(os.path.join(index_dir, "text_features.npy"), np.asarray(all_text_features, dtype=np.float32).reshape(len(all_examples), -1))
+    logger.info(f"Indexed {len(all_examples)} few-shot examples from {few_shot_file_path}")
+    return index_dir
+
+def open_few_shot_index(index_dir: str) -> dict:
+    """
+    Memory map a few-shot index, once per process.
+
+    Args:
+        index_dir (str): index directory
+
+    Returns:
+        dict: offsets, features and the memory mapped examples
+    """
+    with _few_shot_indexes_lock:
+        if index_dir not in _few_shot_indexes:
+            examples_file = open(os.path.join(index_dir, "examples.jsonl"), "rb")
+            size = os.fstat(examples_file.fileno()).st_size
+            _few_shot_indexes[index_dir] = {
+                "offsets": np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r"),
+                "image_features": np.load(os.path.join(index_dir, "image_features.npy"), mmap_mode="r"),
+                "text_features": np.load(os.path.join(index_dir, "text_features.npy"), mmap_mode="r"),
+                "examples": mmap.mmap(examples_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b"",
+            }
+        return _few_shot_indexes[index_dir]
+
+def score_few_shot_examples(index: dict, image_bytes: bytes, context: str) -> np.ndarray:
+    """
+    Similarity of every indexed example to a panel.
+
+    Args:
+        index (dict): index returned by open_few_shot_index
+        image_bytes (bytes): panel image
+        context (str): panel context
+
+    Returns:
+        np.ndarray: similarity score of every example
+    """
+    scores = np.asarray(index["image_features"]) @ image_features(image_bytes)
+    if context:
+        scores = scores + np.asarray(index["text_features"]) @ text_features(context)
+    return scores
+
+def read_few_shot_examples(index: dict, scores: np.ndarray, samples_count: int) -> list[tuple[int, dict]]:
+    """
+    Decode the best scoring examples of an index.
+
+    Args:
+        index (dict): index returned by open_few_shot_index
+        scores (np.ndarray): similarity score of every example
+        samples_count (int): number of examples to select
+
+    Returns:
+        list[tuple[int, dict]]: selected example ids and examples, most similar first
+    """
+    examples = []
+    for example_id in np.argsort(-scores, kind="stable")[:samples_count]:
+        start, end = int(index["offsets"][example_id]), int(index["offsets"][example_id + 1])
+        examples.append((int(example_id), json.loads(index["examples"][start:end])))
+    return examples
+
+def select_few_shot_examples(index_dir: str, image_bytes: bytes, context: str, samples_count: int) -> list[tuple[int, dict]]:
+    """
+    Select the few-shot examples most similar to a panel.
+
+    Args:
+        index_dir (str): index directory
+        image_bytes (bytes): panel image
+        context (str): panel context
+        samples_count (int): number of examples to select
+
+    Returns:
+        list[tuple[int, dict]]: selected example ids and examples, most similar first
+    """
+    index = open_few_shot_index(index_dir)
+    if samples_count <= 0 or len(index["offsets"]) <= 1:
+        return []
+    return read_few_shot_examples(index, score_few_shot_examples(index, image_bytes, context), samples_count)
+
+def select_shared_few_shot_examples(index_dir: str, all_image_bytes: list[bytes], contexts: list[str], samples_count: int) -> list[tuple[int, dict]]:
+    """
+    Select the few-shot examples most similar to a group of panels on average.
+
+    Args:
+        index_dir (str): index directory
+        all_image_bytes (list[bytes]): panel images
+        contexts (list[str]): panel contexts
+        samples_count (int): number of examples to select
+
+    Returns:
+        list[tuple[int, dict]]: selected example ids and examples, most similar first
+    """
+    index = open_few_shot_index(index_dir)
+    if samples_count <= 0 or len(index["offsets"]) <= 1 or not all_image_bytes:
+        return []
+    scores = sum(score_few_shot_examples(index, image_bytes, context) for image_bytes, context in zip(all_image_bytes, contexts))
+    return read_few_shot_examples(index, scores, samples_count)
+
+def format_few_shot_examples(examples: list[tuple[int, dict]]) -> str:
+    """
+    Format the selected few-shot examples for a prompt.
+
+    Args:
+        examples (list[tuple[int, dict]]): selected example ids and examples
+
+    Returns:
+        str: few-shot prompt text
+    """
+    formatted_examples = []
+    for _, ex in examples:
+        formatted = (
+            f"[Image (base64)]: {ex['image_b64']}\n"
+            f"[Query]: {ex['query']}\n"
+            f"[Answer]: {ex['answer']}\n"
+            f"[Explanation]: {ex['explanation']}"
+        )
+        formatted_examples.append(formatted)
+    return "\n\n".join(formatted_examples)
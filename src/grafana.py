@@ -1,15 +1,149 @@
 import os
 import csv
-import requests
+import shutil
 import logging
-import multiprocessing as mp
+import threading
+from typing import Any
 from tabulate import tabulate
-from urllib.parse import urlencode
-from utils.utils import create_grafana_session, multi_process
+from concurrent.futures import Executor
+from urllib.parse import parse_qs, urlencode, urlparse
+from utils.cache import DiskCache, make_cache_key
+from utils.tracing import annotate_span
+from utils.utils import HTTP_ERRORS, download_to_file, get_grafana_session, multi_process
 
 logger = logging.getLogger(__name__)
 
-def preview_grafana_dashboard(d_url: str, g_username: str, g_password: str, expand: bool, csv_path:str, d_alias=None) -> None:
+# Extension of the files the series of a panel are written to in data mode
+DATA_EXTENSION = ".json"
+
+# Dashboard metadata resolved during this run, shared by every entry pointing at the same dashboard
+_dashboard_metadata = {}
+_dashboard_metadata_locks = {}
+_dashboard_metadata_lock = threading.Lock()
+
+def parse_dashboard_url(d_raw_url: str) -> tuple[str, dict]:
+    """
+    Parse the uid and query parameters out of a dashboard url.
+
+    Args:
+        d_raw_url (str): grafana dashboard url as configured
+
+    Returns:
+        tuple[str, dict]: dashboard uid and its query parameters
+    """
+    parsed_d_raw_url = urlparse(d_raw_url)
+    d_uid = parsed_d_raw_url.path.split('/')[2]
+    d_query_params = parse_qs(parsed_d_raw_url.query)
+    return d_uid, d_query_params
+
+def fetch_dashboard_version(d_session: Any, d_url: str) -> int | None:
+    """
+    Fetch the latest version of a dashboard without downloading the dashboard itself.
+
+    Args:
+        d_session (Any): grafana session
+        d_url (str): grafana dashboard url
+
+    Returns:
+        int | None: latest dashboard version or None if it couldn't be determined
+    """
+    try:
+        response = d_session.get(f"{d_url}/versions", params={"limit": 1})
+        response.raise_for_status()
+        return parse_dashboard_versions(response.json())
+    except (*HTTP_ERRORS, ValueError) as e:
+        logger.debug(f"Unable to fetch versions of {d_url}: {e}")
+        return None
+
+def parse_dashboard_versions(versions: Any) -> int | None:
+    """
+    Parse the latest version out of a dashboard versions response.
+
+    Args:
+        versions (Any): json response of /api/dashboards/uid/<uid>/versions
+
+    Returns:
+        int | None: latest dashboard version or None if there is none
+    """
+    # Newer grafana releases wrap the list in an object
+    if isinstance(versions, dict):
+        versions = versions.get("versions", [])
+    if not versions:
+        return None
+    return versions[0].get("version")
+
+def parse_dashboard(dashboard_json: dict) -> dict:
+    """
+    Keep the parts of a dashboard response that are needed to export its panels.
+
+    Args:
+        dashboard_json (dict): json response of /api/dashboards/uid/<uid>
+
+    Returns:
+        dict: dashboard title, version, panels and template variables
+    """
+    dashboard_data = dashboard_json["dashboard"]
+    return {
+        "title": dashboard_data.get("title", ""),
+        "version": dashboard_data.get("version", 0),
+        "panels": dashboard_data.get("panels", []),
+        "templating": dashboard_data.get("templating", {}).get("list", []),
+    }
+
+def index_dashboard(dashboard: dict) -> dict:
+    """
+    Add the panel_id_to_names and panel_name_to_ids maps to a parsed dashboard.
+
+    Args:
+        dashboard (dict): dashboard returned by parse_dashboard
+
+    Returns:
+        dict: the same dashboard with its panel maps
+    """
+    panel_id_to_names, panel_name_to_ids = dict(), dict()
+    recurse_panels(dashboard["panels"], panel_id_to_names, panel_name_to_ids)
+    dashboard["panel_id_to_names"] = panel_id_to_names
+    dashboard["panel_name_to_ids"] = panel_name_to_ids
+    return dashboard
+
+def get_dashboard_metadata(d_url: str, g_username: str, g_password: str, metadata_cache: DiskCache | None = None) -> dict:
+    """
+    Get the metadata of a dashboard, fetching it at most once per run.
+    Dashboards persisted in the metadata cache are revalidated against their latest version instead of downloaded again.
+
+    Args:
+        d_url (str): grafana dashboard url
+        g_username (str): username for the dashboard
+        g_password (str): password for the dashboard
+        metadata_cache (DiskCache | None): cache to persist dashboards across runs
+
+    Returns:
+        dict: dashboard title, version, panels and the panel_id_to_names and panel_name_to_ids maps
+    """
+    with _dashboard_metadata_lock:
+        d_lock = _dashboard_metadata_locks.setdefault(d_url, threading.Lock())
+    with d_lock:
+        if d_url in _dashboard_metadata:
+            return _dashboard_metadata[d_url]
+
+        d_session = get_grafana_session(d_url, g_username, g_password)
+        cache_key = make_cache_key("dashboard", d_url)
+        dashboard = metadata_cache.get_json(cache_key) if metadata_cache is not None else None
+        if dashboard is not None and fetch_dashboard_version(d_session, d_url) != dashboard["version"]:
+            dashboard = None
+        if dashboard is None:
+            response = d_session.get(d_url)
+            response.raise_for_status()
+            dashboard = parse_dashboard(response.json())
+            if metadata_cache is not None:
+                metadata_cache.put_json(cache_key, dashboard)
+        else:
+            logger.debug(f"Dashboard {d_url} is unchanged at version {dashboard['version']}, using cached copy")
+
+        _dashboard_metadata[d_url] = index_dashboard(dashboard)
+        return dashboard
+
+def preview_grafana_dashboard(d_url: str, g_username: str, g_password: str, expand: bool, csv_path:str, d_alias=None, metadata_cache: DiskCache | None = None) -> tuple[dict, dict, int]:
     """
     Preview grafana dashboard.
 
@@ -20,21 +154,17 @@ def preview_grafana_dashboard(d_url: str, g_username: str, g_password: str, expa
         expand (bool): flag to tabulate the output
         csv_path (str): csv file path to store the results
         d_alias (alias): dashboard alias if any to be logged
+        metadata_cache (DiskCache | None): cache to persist dashboards across runs
 
     Returns:
-        None
+        tuple[dict, dict, int]: panel id to names, panel name to ids and the dashboard version
     """
-    d_session = create_grafana_session(g_username, g_password)
-    response = d_session.get(d_url)
-    response.raise_for_status()
-
-    dashboard_data = response.json()
-    dashboard_title = d_alias if d_alias else dashboard_data["dashboard"]["title"]
+    dashboard = get_dashboard_metadata(d_url, g_username, g_password, metadata_cache)
+    dashboard_title = d_alias if d_alias else dashboard["title"]
+    dashboard_version = dashboard["version"]
 
     logger.info(f"Scanning dashboard: {dashboard_title}")
-    panels = dashboard_data["dashboard"]["panels"]
-    panel_id_to_names, panel_name_to_ids = dict(), dict()
-    recurse_panels(panels, panel_id_to_names, panel_name_to_ids)
+    panel_id_to_names, panel_name_to_ids = dashboard["panel_id_to_names"], dashboard["panel_name_to_ids"]
 
     if csv_path != "" or expand:
         data = [["Panel ID", "Panel Name"]]
@@ -51,7 +181,7 @@ def preview_grafana_dashboard(d_url: str, g_username: str, g_password: str, expa
             table = tabulate(full_table, headers="firstrow", tablefmt="grid")
             logger.info("\n" + table)
 
-    return panel_id_to_names, panel_name_to_ids
+    return panel_id_to_names, panel_name_to_ids, dashboard_version
 
 def recurse_panels(panels: dict, panel_id_to_names: dict, panel_name_to_ids: dict) -> None:
     """
@@ -102,6 +232,7 @@ def extract_panels(panels: list, panel_id_to_names: dict, panel_name_to_ids: dic
         panel_width = panel.get("width", "1280")
         panel_height = panel.get("height", "720")
         panel_context = panel.get("context", "")
+        panel_direction = panel.get("direction", "")
 
         if panel_id not in panel_id_to_names and panel_name not in panel_name_to_ids:
             logger.info(f"Panel with id:{panel_id} or name:{panel_name} not found. Hence skipping it")
@@ -116,62 +247,131 @@ def extract_panels(panels: list, panel_id_to_names: dict, panel_name_to_ids: dic
             "panel_width": panel_width,
             "panel_height": panel_height,
             "panel_context": panel_context,
+            "panel_direction": panel_direction,
+            "panel_mirrors": panel.get("mirrors", []),
         })
 
     return extracted_panels
 
-def process_panel(each_panel: dict, args: tuple, return_dict: dict, idx: int) -> None:
+def build_render_params(each_panel: dict, d_query_params: dict) -> list[tuple]:
+    """
+    Build the query parameters of a panel render request.
+
+    Args:
+        each_panel (dict): Each single panel
+        d_query_params (dict): dashboard query parameters
+
+    Returns:
+        list[tuple]: render query parameters, redundant keys allowed
+    """
+    # Start with fixed parameters as a list of tuples
+    render_query_params = [
+        ("panelId", each_panel["panel_id"]),
+        ("orgId", d_query_params.get("orgId", ["1"])[0]),
+        ("width", each_panel["panel_width"]),
+        ("height", each_panel["panel_height"]),
+        ("tz", "UTC")
+    ]
+
+    # Add additional parameters as tuples, allowing redundant keys
+    additional_params = [(k, v) for k, vals in d_query_params.items() for v in vals]
+    render_query_params.extend(additional_params)
+    return render_query_params
+
+def render_cache_key(g_url: str, d_uid: str, d_version: int, render_query_params: list[tuple]) -> str:
+    """
+    Cache key identifying a panel render request.
+
+    Args:
+        g_url (str): Grafana url
+        d_uid (str): dashboard uid
+        d_version (int): dashboard version
+        render_query_params (list[tuple]): render query parameters
+
+    Returns:
+        str: cache key of the render
+    """
+    return make_cache_key("render", g_url, d_uid, d_version, sorted((str(k), str(v)) for k, v in render_query_params))
+
+def render_cache_ttl(d_query_params: dict, ttl: float) -> float | None:
+    """
+    Cache ttl of a render. Absolute time ranges never change and are cached until evicted,
+    relative ones such as now-7d are only reused for ttl seconds.
+
+    Args:
+        d_query_params (dict): dashboard query parameters
+        ttl (float): ttl for relative time ranges in seconds
+
+    Returns:
+        float | None: ttl of the render or None if it doesn't expire
+    """
+    time_range = [d_query_params.get("from", ["now"])[0], d_query_params.get("to", ["now"])[0]]
+    if any(not str(value).isdigit() for value in time_range):
+        return ttl
+    return None
+
+def panel_image_path(each_panel: dict, d_output: str, extension: str = ".png") -> tuple[str, str]:
+    """
+    Name and image path of an exported panel.
+
+    Args:
+        each_panel (dict): Each single panel
+        d_output (str): dashboard output path
+        extension (str): extension of the exported file
+
+    Returns:
+        tuple[str, str]: panel name and the path of its image
+    """
+    panel_name = f"panel_{each_panel["panel_id"]}" if each_panel["panel_title"] == "" else f"panel_{each_panel["panel_id"]}_{each_panel["panel_title"]}"
+    return panel_name, os.path.join(d_output, f"{panel_name}{extension}")
+
+def process_panel(each_panel: dict, args: tuple) -> dict | None:
     """
     Function to process each panel at the lowest atomic level.
 
     Args:
         each_panel (dict)): Each single panel
         args (tuple): full list of arguments to process
-        return_dict (dict): shared dictionary across the threads
-        idx (int): unique index to store thread data
 
     Returns:
-        None
+        dict | None: exported panel or None if the export failed
     """
-    g_url, d_uid, g_username, g_password, d_output, d_query_params = args
+    g_url, d_uid, g_username, g_password, d_output, d_query_params, d_version, render_cache, cache_ttl = args
     try:
-        # Create new session for each thread.
-        d_session = create_grafana_session(g_username, g_password)
-
-        # Start with fixed parameters as a list of tuples
-        render_query_params = [
-            ("panelId", each_panel["panel_id"]),
-            ("orgId", d_query_params.get("orgId", ["1"])[0]),
-            ("width", each_panel["panel_width"]),
-            ("height", each_panel["panel_height"]),
-            ("tz", "UTC")
-        ]
-
-        # Add additional parameters as tuples, allowing redundant keys
-        additional_params = [(k, v) for k, vals in d_query_params.items() for v in vals]
-        render_query_params.extend(additional_params)
-        
+        render_query_params = build_render_params(each_panel, d_query_params)
+        panel_name, panel_image = panel_image_path(each_panel, d_output)
+        each_panel["panel_image"] = panel_image
+        annotate_span(host=urlparse(g_url).netloc, panel=panel_name)
+
+        cache_key = None
+        if render_cache is not None:
+            cache_key = render_cache_key(g_url, d_uid, d_version, render_query_params)
+            cached_image = render_cache.get_file(cache_key, render_cache_ttl(d_query_params, cache_ttl))
+            if cached_image is not None:
+                shutil.copyfile(cached_image, panel_image)
+                each_panel["render_cache"] = "hit"
+                annotate_span(status="cached")
+                logger.info(f"Exported {panel_name} to {panel_image} from render cache")
+                return each_panel
+
+        # Keep-alive session shared with every other render against this grafana
+        d_session = get_grafana_session(g_url, g_username, g_password)
+
         # render url of the panel
         render_url = f"{g_url}/render/d-solo/{d_uid}?{urlencode(render_query_params, doseq=True)}"
 
-        # Download the image
-        image_response = d_session.get(render_url, stream=True)
-        image_response.raise_for_status()
-
-        # Save the image
-        panel_name = f"panel_{each_panel["panel_id"]}" if each_panel["panel_title"] == "" else f"panel_{each_panel["panel_id"]}_{each_panel["panel_title"]}"
-        panel_image = os.path.join(d_output, f"{panel_name}.png")
-        each_panel["panel_image"] = panel_image
-        with open(panel_image, "wb") as image_file:
-            for chunk in image_response.iter_content(1024):
-                image_file.write(chunk)
+        # Download and save the image
+        annotate_span(bytes=download_to_file(d_session, render_url, panel_image))
+        if cache_key is not None:
+            render_cache.put_file(cache_key, panel_image)
 
         logger.info(f"Exported {panel_name} to {panel_image}")
-        return_dict[idx] = each_panel
-    except requests.RequestException as e:
+        return each_panel
+    except HTTP_ERRORS as e:
         logger.error(f"Error exporting panel {each_panel['panel_id']}: {e}")
+        return None
 
-def export_panels(extracted_panels: list, g_url: str, d_uid: str, g_username: str, g_password: str, d_output: str, d_query_params: dict, concurrency: int) -> None:
+def export_panels(extracted_panels: list, g_url: str, d_uid: str, g_username: str, g_password: str, d_output: str, d_query_params: dict, executor: Executor, d_version: int = 0, render_cache: DiskCache | None = None, cache_ttl: float = 0) -> list[dict]:
     """
     Export all the extracted panels to the configured output directory.
 
@@ -183,17 +383,13 @@ def export_panels(extracted_panels: list, g_url: str, d_uid: str, g_username: st
         g_password (str): grafana password
         d_output (str): dashboard output path
         d_query_params (dict): dashboard query parameters
-        concurrency (int): concurrency to apply for multiprocessing
+        executor (Executor): executor to run the exports on
+        d_version (int): dashboard version
+        render_cache (DiskCache | None): cache of rendered panels, None to always render
+        cache_ttl (float): render cache ttl for relative time ranges in seconds
 
     Returns:
-        None
+        list[dict]: exported panels
     """
     os.makedirs(d_output, exist_ok=True)
-
-    chunk_size = concurrency
-    updated_panels = []
-    for i in range(0, len(extracted_panels), chunk_size):
-        panels_chunk = extracted_panels[i:i + chunk_size]
-        updated_panels.extend(multi_process(panels_chunk, process_panel, (g_url, d_uid, g_username, g_password, d_output, d_query_params)))
-
-    return updated_panels
+    return multi_process(extracted_panels, process_panel, (g_url, d_uid, g_username, g_password, d_output, d_query_params, d_version, render_cache, cache_ttl), executor)
@@ -0,0 +1,264 @@
+import os
+import queue
+import shutil
+import asyncio
+import logging
+import threading
+from typing import Any, Iterator
+from urllib.parse import urlencode, urlparse
+from src.grafana import build_render_params, extract_panels, index_dashboard, panel_image_path, parse_dashboard, parse_dashboard_url, parse_dashboard_versions, render_cache_key, render_cache_ttl
+from utils.cache import DiskCache, make_cache_key
+from utils.tracing import annotate_span, span
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+# Body chunks are buffered and written in blocks of this size, most panel images fit in a single write
+_WRITE_BLOCK_SIZE = 1024 * 1024
+
+async def fetch_dashboard_async(client: Any, d_url: str, metadata_cache: DiskCache | None) -> dict:
+    """
+    Fetch the metadata of a dashboard, revalidating the cached copy against its latest version.
+
+    Args:
+        client (Any): httpx.AsyncClient of the grafana host
+        d_url (str): grafana dashboard url
+        metadata_cache (DiskCache | None): cache to persist dashboards across runs
+
+    Returns:
+        dict: dashboard title, version, panels and the panel_id_to_names and panel_name_to_ids maps
+    """
+    cache_key = make_cache_key("dashboard", d_url)
+    dashboard = await asyncio.to_thread(metadata_cache.get_json, cache_key) if metadata_cache is not None else None
+    if dashboard is not None:
+        try:
+            response = await client.get(f"{d_url}/versions", params={"limit": 1})
+            response.raise_for_status()
+            latest_version = parse_dashboard_versions(response.json())
+        except (httpx.HTTPError, ValueError) as e:
+            logger.debug(f"Unable to fetch versions of {d_url}: {e}")
+            latest_version = None
+        if latest_version != dashboard["version"]:
+            dashboard = None
+    if dashboard is None:
+        response = await client.get(d_url)
+        response.raise_for_status()
+        dashboard = parse_dashboard(response.json())
+        if metadata_cache is not None:
+            await asyncio.to_thread(metadata_cache.put_json, cache_key, dashboard)
+    return index_dashboard(dashboard)
+
+async def render_panel_async(client: Any, semaphore: asyncio.Semaphore, each_panel: dict, args: tuple) -> dict | None:
+    """
+    Render a single panel and stream its image to disk.
+
+    Args:
+        client (Any): httpx.AsyncClient of the grafana host
+        semaphore (asyncio.Semaphore): semaphore bounding the renders in flight
+        each_panel (dict): Each single panel
+        args (tuple): full list of arguments to process
+
+    Returns:
+        dict | None: exported panel or None if the export failed
+    """
+    g_url, d_uid, d_output, d_query_params, d_version, render_cache, cache_ttl = args
+    render_query_params = build_render_params(each_panel, d_query_params)
+    panel_name, panel_image = panel_image_path(each_panel, d_output)
+    each_panel["panel_image"] = panel_image
+    annotate_span(panel=panel_name)
+
+    cache_key = None
+    if render_cache is not None:
+        cache_key = render_cache_key(g_url, d_uid, d_version, render_query_params)
+        cached_image = await asyncio.to_thread(render_cache.get_file, cache_key, render_cache_ttl(d_query_params, cache_ttl))
+        if cached_image is not None:
+            await asyncio.to_thread(shutil.copyfile, cached_image, panel_image)
+            annotate_span(status="cached")
+            logger.info(f"Exported {panel_name} to {panel_image} from render cache")
+            return each_panel
+
+    render_url = f"{g_url}/render/d-solo/{d_uid}?{urlencode(render_query_params, doseq=True)}"
+    try:
+        async with semaphore:
+            async with client.stream("GET", render_url) as response:
+                response.raise_for_status()
+                # File writes run on worker threads so the event loop keeps serving other renders
+                image_file = await asyncio.to_thread(open, panel_image, "wb")
+                written = 0
+                block = bytearray()
+                try:
+                    async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                        block += chunk
+                        written += len(chunk)
+                        if len(block) >= _WRITE_BLOCK_SIZE:
+                            await asyncio.to_thread(image_file.write, block)
+                            block.clear()
+                    if block:
+                        await asyncio.to_thread(image_file.write, block)
+                finally:
+                    await asyncio.to_thread(image_file.close)
+                annotate_span(bytes=written)
+        if cache_key is not None:
+            await asyncio.to_thread(render_cache.put_file, cache_key, panel_image)
+    except (httpx.HTTPError, OSError) as e:
+        logger.error(f"Error exporting panel {each_panel['panel_id']}: {e}")
+        return None
+
+    logger.info(f"Exported {panel_name} to {panel_image}")
+    return each_panel
+
+async def export_grafana_config_async(grafana_data: list, max_in_flight: int, pool_size: int, http2: bool, render_cache: DiskCache | None, metadata_cache: DiskCache | None, cache_ttl: float, on_panel: callable) -> None:
+    """
+    Export the panels of every grafana instance and dashboard in the config on a single event loop.
+
+    Args:
+        grafana_data (list): grafana configuration list
+        max_in_flight (int): maximum number of renders in flight across all grafana instances
+        pool_size (int): keep-alive connections to keep per grafana host
+        http2 (bool): use HTTP/2 for grafana requests
+        render_cache (DiskCache | None): cache of rendered panels
+        metadata_cache (DiskCache | None): cache of dashboard metadata
+        cache_ttl (float): render cache ttl for relative time ranges in seconds
+        on_panel (callable): coroutine awaited with every exported panel as soon as it is written, it may wait for the consumer to catch up
+
+    Returns:
+        None
+    """
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+    clients = {}
+    dashboards = {}
+    render_tasks = []
+
+    async def export_panel(client: Any, each_panel: dict, args: tuple) -> None:
+        # Every task runs in its own context, so concurrent renders annotate their own span
+        with span("render", host=urlparse(args[0]).netloc) as attributes:
+            panel = await render_panel_async(client, semaphore, each_panel, args)
+            if panel is None:
+                attributes["status"] = "error"
+        if panel is not None:
+            await on_panel(panel)
+
+    async def export_dashboard(client: Any, g_url: str, each_dashboard: dict) -> None:
+        d_alias = each_dashboard['alias']
+        d_uid, d_query_params = parse_dashboard_url(each_dashboard['raw_url'])
+        d_url = f"{g_url}/api/dashboards/uid/{d_uid}"
+        # Entries pointing at the same dashboard share a single fetch
+        if d_url not in dashboards:
+            dashboards[d_url] = asyncio.ensure_future(fetch_dashboard_async(client, d_url, metadata_cache))
+        with span("dashboard", host=urlparse(g_url).netloc, dashboard=d_alias) as attributes:
+            try:
+                dashboard = await dashboards[d_url]
+            except (httpx.HTTPError, ValueError) as e:
+                attributes["status"] = "error"
+                logger.error(f"Error scanning dashboard {d_alias}: {e}")
+                return
+        logger.info(f"Scanning dashboard: {d_alias}")
+
+        if 'panels' not in each_dashboard or not each_dashboard['panels']:
+            logger.info("No panels specified in configuration for extraction. Hence skipping this dashboard")
+            return
+        extracted_panels = extract_panels(each_dashboard['panels'], dashboard["panel_id_to_names"], dashboard["panel_name_to_ids"])
+        d_output = each_dashboard['output']
+        os.makedirs(d_output, exist_ok=True)
+        args = (g_url, d_uid, d_output, d_query_params, dashboard["version"], render_cache, cache_ttl)
+        for each_panel in extracted_panels:
+            render_tasks.append(asyncio.ensure_future(export_panel(client, each_panel, args)))
+
+    try:
+        dashboard_tasks = []
+        for each_grafana in grafana_data:
+            g_url = each_grafana['url']
+            logger.info(f"Scraping grafana: {each_grafana['alias']}")
+            if 'dashboards' not in each_grafana or not each_grafana['dashboards']:
+                logger.info("No dashboards specified in configuration for extraction. Hence skipping this grafana")
+                continue
+            parsed_g_url = urlparse(g_url)
+            client_key = (parsed_g_url.scheme, parsed_g_url.netloc, each_grafana['username'])
+            if client_key not in clients:
+                clients[client_key] = httpx.AsyncClient(
+                    http2=http2,
+                    verify=False,
+                    auth=(each_grafana['username'], each_grafana['password']),
+                    timeout=None,
+                    limits=httpx.Limits(max_connections=max(1, max_in_flight), max_keepalive_connections=pool_size),
+                )
+            for each_dashboard in each_grafana['dashboards']:
+                dashboard_tasks.append(export_dashboard(clients[client_key], g_url, each_dashboard))
+        await asyncio.gather(*dashboard_tasks)
+        await asyncio.gather(*render_tasks)
+    finally:
+        for client in clients.values():
+            await client.aclose()
+
+def stream_grafana_config_async(grafana_data: list, max_in_flight: int, pool_size: int, http2: bool, render_cache: DiskCache | None, metadata_cache: DiskCache | None, cache_ttl: float) -> Iterator[dict]:
+    """
+    Run the async export engine on a background event loop and yield the panels as they are exported.
+
+    Args:
+        grafana_data (list): grafana configuration list
+        max_in_flight (int): maximum number of renders in flight across all grafana instances
+        pool_size (int): keep-alive connections to keep per grafana host
+        http2 (bool): use HTTP/2 for grafana requests
+        render_cache (DiskCache | None): cache of rendered panels
+        metadata_cache (DiskCache | None): cache of dashboard metadata
+        cache_ttl (float): render cache ttl for relative time ranges in seconds
+
+    Returns:
+        Iterator[dict]: exported panels in completion order
+    """
+    if httpx is None:
+        raise RuntimeError("The async engine requires httpx to be installed")
+    panels = queue.Queue()
+    done = object()
+    engine = {}
+    engine_lock = threading.Lock()
+
+    async def export() -> None:
+        # Slots bound the panels handed off but not taken yet, renders pause while the downstream stages are behind
+        slots = asyncio.Semaphore(max(1, max_in_flight))
+        with engine_lock:
+            if engine.get("stopped"):
+                return
+            engine.update(loop=asyncio.get_running_loop(), task=asyncio.current_task(), slots=slots)
+
+        async def hand_off(panel: dict) -> None:
+            await slots.acquire()
+            panels.put(panel)
+
+        await export_grafana_config_async(grafana_data, max_in_flight, pool_size, http2, render_cache, metadata_cache, cache_ttl, hand_off)
+
+    def run_loop() -> None:
+        try:
+            asyncio.run(export())
+        except asyncio.CancelledError:
+            logger.debug("Async export engine stopped before every panel was exported")
+        except Exception as e:
+            logger.error(f"Async export engine failed: {e}")
+        finally:
+            panels.put(done)
+
+    thread = threading.Thread(target=run_loop, daemon=True, name="yoda-async-export")
+    thread.start()
+    finished = False
+    try:
+        while (panel := panels.get()) is not done:
+            engine["loop"].call_soon_threadsafe(engine["slots"].release)
+            yield panel
+        finished = True
+    finally:
+        if not finished:
+            # The consumer stopped early, the engine is cancelled instead of waiting on slots forever
+            with engine_lock:
+                engine["stopped"] = True
+            if "task" in engine:
+                try:
+                    engine["loop"].call_soon_threadsafe(engine["task"].cancel)
+                except RuntimeError:
+                    # The loop already finished on its own
+                    pass
+        thread.join()
@@ -0,0 +1,114 @@
+import io
+import os
+import hashlib
+import logging
+import mimetypes
+from utils.cache import make_cache_key
+from utils.tracing import annotate_span
+
+logger = logging.getLogger(__name__)
+
+# Target formats and their PIL names
+IMAGE_FORMATS = {
+    "png": "PNG",
+    "jpeg": "JPEG",
+    "webp": "WEBP",
+}
+
+# Not registered by every python version
+mimetypes.add_type("image/webp", ".webp")
+
+def image_mime_type(image_path: str) -> str:
+    """
+    Mime type of an image file, based on its extension.
+
+    Args:
+        image_path (str): image file path
+
+    Returns:
+        str: mime type, image/png when unknown since grafana renders png
+    """
+    mime_type, _ = mimetypes.guess_type(image_path)
+    return mime_type if mime_type and mime_type.startswith("image/") else "image/png"
+
+def encode_image(image_bytes: bytes, max_size: int, image_format: str, quality: int) -> bytes:
+    """
+    Downscale an image so that its longest side fits in max_size and re-encode it.
+
+    Args:
+        image_bytes (bytes): encoded source image
+        max_size (int): longest side in pixels, 0 to keep the source size
+        image_format (str): target format, one of IMAGE_FORMATS
+        quality (int): jpeg/webp quality
+
+    Returns:
+        bytes: encoded image
+    """
+    # Pillow is only loaded by the processes encoding images, not by every command importing IMAGE_FORMATS
+    from PIL import Image
+    pil_format = IMAGE_FORMATS[image_format]
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        if max_size > 0 and max(image.size) > max_size:
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+        output = io.BytesIO()
+        if pil_format == "JPEG":
+            image.convert("RGB").save(output, format=pil_format, quality=quality, optimize=True, progressive=True)
+        elif pil_format == "WEBP":
+            image.save(output, format=pil_format, quality=quality, method=6)
+        else:
+            image.save(output, format=pil_format, optimize=True)
+    return output.getvalue()
+
+def optimize_image(image_path: str, args: tuple) -> str:
+    """
+    Produce an optimized variant of an image, once per source content and options.
+
+    Args:
+        image_path (str): source image path
+        args (tuple): (max_size, image_format, quality, image_cache, output_dir)
+
+    Returns:
+        str: path of the optimized image
+    """
+    max_size, image_format, quality, image_cache, output_dir = args
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    cache_key = make_cache_key("image", hashlib.sha256(image_bytes).hexdigest(), max_size, image_format, quality)
+    if image_cache is not None:
+        cached_image = image_cache.get_file(cache_key)
+        if cached_image is not None:
+            logger.debug(f"Using cached {image_format} variant of {image_path}")
+            annotate_span(status="cached")
+            return cached_image
+
+    optimized_bytes = encode_image(image_bytes, max_size, image_format, quality)
+    annotate_span(bytes=len(optimized_bytes))
+    os.makedirs(output_dir, exist_ok=True)
+    optimized_path = os.path.join(output_dir, f"{cache_key}.{image_format}")
+    with open(optimized_path, "wb") as optimized_file:
+        optimized_file.write(optimized_bytes)
+    logger.info(f"Optimized {image_path} from {len(image_bytes)} to {len(optimized_bytes)} bytes")
+    if image_cache is not None:
+        cached_image = image_cache.put_file(cache_key, optimized_path)
+        os.remove(optimized_path)
+        return cached_image
+    return optimized_path
+
+def optimize_panel(each_panel: dict, args: tuple) -> dict:
+    """
+    Attach an optimized variant of the panel image for inference. The rendered image is left untouched.
+
+    Args:
+        each_panel (dict): panel reference to update
+        args (tuple): arguments of optimize_image
+
+    Returns:
+        dict: panel with its inference_image, or unchanged if the image could not be optimized
+    """
+    from PIL import Image
+    try:
+        each_panel["inference_image"] = optimize_image(each_panel["panel_image"], args)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Could not optimize {each_panel['panel_image']}, using it as is: {e}")
+    return each_panel
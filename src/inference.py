@@ -1,75 +1,182 @@
-import json
+import os
 import base64
+import hashlib
 import requests
 import logging
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from src.images import image_mime_type
+from src.fewshot import format_few_shot_examples, select_few_shot_examples, select_shared_few_shot_examples
+from utils.cache import make_cache_key
+from utils.tracing import annotate_span, span
 
 logger = logging.getLogger(__name__)
 
-def image_inference(each_panel: dict, args: tuple, return_dict: dict, idx: int) -> None:
+SYSTEM_PROMPT = """
+    You are a Kubernetes/OpenShift performance engineer focussed on finding performance differences and regressions in new releases compared to older ones.
+    """
+
+SAMPLING_PARAMS = {
+    "top_p": 0.95,
+    "frequency_penalty": 1.03,
+    "temperature": 0.01,
+    "max_tokens": 512,
+}
+
+def inference_cache_key(image_bytes: bytes, system_prompt: str, context: str, query: str, inference_endpoint: str, inference_model: str, inference_model_type: str) -> str:
+    """
+    Cache key identifying an inference request. The query already embeds the selected few-shot examples.
+
+    Args:
+        image_bytes (bytes): panel image
+        system_prompt (str): system prompt
+        context (str): panel context
+        query (str): query including the few-shot examples
+        inference_endpoint (str): inference endpoint
+        inference_model (str): hosted model at the inference endpoint
+        inference_model_type (str): hosted model type
+
+    Returns:
+        str: cache key of the inference
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    return make_cache_key("inference", image_hash, system_prompt, context, query, inference_endpoint, inference_model, inference_model_type, SAMPLING_PARAMS)
+
+def parse_inference_response(response_json: dict) -> str | None:
+    """
+    Extract the generated text out of an ollama, llama.cpp or OpenAI compatible response.
+
+    Args:
+        response_json (dict): json response of the inference endpoint
+
+    Returns:
+        str | None: generated text or None if there is none
+    """
+    if "response" in response_json.keys():
+        return response_json["response"]
+    elif "content" in response_json.keys():
+        return response_json["content"]
+    elif "choices" in response_json.keys() and len(response_json["choices"]) > 0:
+        return response_json["choices"][0]["message"]["content"]
+    return None
+
+def image_inference(each_panel: dict, args: tuple) -> dict | None:
     """
     Deplots the image and generates its underlying table.
 
     Args:
         each_panel (dict): panel reference to update
         args (tuple): arguments to read
-        return_dict (dict): shared dictionary across the threads
-        idx (int): unique index to store thread data
 
     Returns:
-        None
-    """
-    query, inference_endpoint, inference_api_key, inference_model, inference_model_type, few_shot_file_path, samples_count = args
-    system_prompt = """
-    You are a Kubernetes/OpenShift performance engineer focussed on finding performance differences and regressions in new releases compared to older ones.
+        dict | None: panel updated with its text or None if the inference failed
     """
+    query, inference_endpoint, inference_api_key, inference_model, inference_model_type, few_shot_index, samples_count, inference_cache = args
+    system_prompt = SYSTEM_PROMPT
     context = each_panel['panel_context'] if 'panel_context' in each_panel else ""
-    if few_shot_file_path:
+    default_inference_endpoint = "http://q42-h03-dgx.rdu3.labs.perfscale.redhat.com:30080/v1/chat/completions"
+    inference_endpoint = inference_endpoint or default_inference_endpoint
+
+    # Optimized variant attached by the image stage, if any
+    image_path = each_panel.get("inference_image", each_panel["panel_image"])
+    with open(image_path, "rb") as img_file:
+        image_bytes = img_file.read()
+    image_mime = image_mime_type(image_path)
+    annotate_span(panel=each_panel["panel_image"], host=urlparse(inference_endpoint).netloc, bytes=len(image_bytes))
+
+    few_shot_text = ""
+    if few_shot_index:
         try:
-            with open(few_shot_file_path, "r") as f:
-                data = json.load(f)
-                all_examples = data.get("examples", [])
-                selected_examples = all_examples[:samples_count]
-                formatted_examples = []
-                for ex in selected_examples:
-                    formatted = (
-                        f"[Image (base64)]: {ex['image_b64']}\n"
-                        f"[Query]: {ex['query']}\n"
-                        f"[Answer]: {ex['answer']}\n"
-                        f"[Explanation]: {ex['explanation']}"
-                    )
-                    formatted_examples.append(formatted)
-                few_shot_text = "\n\n".join(formatted_examples)
-                logger.info(f"Loaded {len(selected_examples)} few-shot examples from {few_shot_file_path}")
+            selected_examples = select_few_shot_examples(few_shot_index, image_bytes, context, samples_count)
+            few_shot_text = format_few_shot_examples(selected_examples)
+            logger.info(f"Selected few-shot examples {[example_id for example_id, _ in selected_examples]} for image: {each_panel["panel_image"]}")
         except Exception as e:
             logger.warning(f"Could not load few-shot examples: {e}")
-        query = f"{few_shot_text}\n\n{query}"
-    default_inference_endpoint = "http://q42-h03-dgx.rdu3.labs.perfscale.redhat.com:30080/v1/chat/completions"
-    inference_endpoint = inference_endpoint or default_inference_endpoint
+
+    cache_key = None
+    if inference_cache is not None:
+        cache_key = inference_cache_key(image_bytes, system_prompt, context, few_shot_query(few_shot_text, query), inference_endpoint, inference_model, inference_model_type)
+        cached = inference_cache.get_json(cache_key)
+        if cached is not None:
+            logger.info(f"Using cached inference for image: {each_panel["panel_image"]}")
+            each_panel['panel_text'] = cached["panel_text"]
+            each_panel['inference_cache'] = "hit"
+            annotate_span(status="cached")
+            return each_panel
+        each_panel['inference_cache'] = "miss"
 
     if inference_endpoint == default_inference_endpoint:
         files = {
-            'image': open(each_panel["panel_image"], 'rb')
+            'image': (os.path.basename(image_path), image_bytes, image_mime)
         }
         data = {
             'context': context,
-            'query': query,
+            'query': few_shot_query(few_shot_text, query),
         }
         try:
             logger.info(f"Running default inference for image: {each_panel["panel_image"]}")
             response = requests.post(inference_endpoint, files=files, data=data)
             response.raise_for_status()
             each_panel['panel_text'] = response.text
-            return_dict[idx] = each_panel
-            files['image'].close()
-            return
+            if cache_key is not None:
+                inference_cache.put_json(cache_key, {"panel_text": each_panel['panel_text']})
+            return each_panel
         except Exception as err:
             logger.info(f"Unexpected error from default inference: {err}")
-        finally:
-            files['image'].close()
-    
-    with open(each_panel["panel_image"], "rb") as img_file:
-        image_b64 = base64.b64encode(img_file.read()).decode("utf-8")
 
+    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+    request = build_inference_request(inference_endpoint, inference_model, inference_model_type, system_prompt, context, query, image_b64, image_mime, few_shot_text)
+    if request is None:
+        logger.info(f"Unsupported model_type: {inference_model_type}")
+        return None
+    url, payload = request
+
+    try:
+
+        logger.info(f"Running inference for image: {each_panel["panel_image"]}")
+        panel_text = send_inference_request(url, payload, inference_api_key)
+        if panel_text is not None:
+            each_panel['panel_text'] = panel_text
+        if cache_key is not None and 'panel_text' in each_panel:
+            inference_cache.put_json(cache_key, {"panel_text": each_panel['panel_text']})
+        return each_panel
+    except Exception as err:
+        logger.info(f"Unexpected error from inference: {err}")
+        return None
+
+def few_shot_query(few_shot_text: str, query: str) -> str:
+    """
+    Query with the few-shot examples ahead of it, the form inference caches and the default endpoint use.
+
+    Args:
+        few_shot_text (str): formatted few-shot examples, empty when there are none
+        query (str): query
+
+    Returns:
+        str: query including the few-shot examples
+    """
+    return f"{few_shot_text}\n\n{query}" if few_shot_text else query
+
+def build_inference_request(inference_endpoint: str, inference_model: str, inference_model_type: str, system_prompt: str, context: str, query: str, image_b64: str = "", image_mime: str = "", few_shot_text: str = "") -> tuple[str, dict] | None:
+    """
+    Build the url and payload of a generation request for the hosted model type.
+    The few-shot examples come right after the system prompt, so requests sharing them share their prompt prefix.
+
+    Args:
+        inference_endpoint (str): inference endpoint
+        inference_model (str): hosted model at the inference endpoint
+        inference_model_type (str): hosted model type, one of vllm, ollama or llama.cpp
+        system_prompt (str): system prompt
+        context (str): panel context
+        query (str): query
+        image_b64 (str): base64 encoded image, empty for text only requests
+        image_mime (str): mime type of the image
+        few_shot_text (str): formatted few-shot examples, empty when there are none
+
+    Returns:
+        tuple[str, dict] | None: request url and payload or None if the model type is not supported
+    """
     payload = {}
     url = f""    
     match inference_model_type:
@@ -79,16 +186,18 @@ def image_inference(each_panel: dict, args: tuple, return_dict: dict, idx: int)
                 "messages": [
                     {"role": "system", "content": system_prompt} if system_prompt else {},
                     {"role": "user", "content": [
+                        {"type": "text", "text": few_shot_text} if few_shot_text else {},
                         {"type": "text", "text": f"{context}\n\n{query}" if context else query},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}} if image_b64 else {}
+                        {"type": "image_url", "image_url": {"url": f"data:{image_mime};base64,{image_b64}"}} if image_b64 else {}
                     ]}
                 ],
             }
             payload["messages"] = [msg for msg in payload["messages"] if msg]
+            payload["messages"][-1]["content"] = [part for part in payload["messages"][-1]["content"] if part]
             url = f"{inference_endpoint}/v1/chat/completions"
 
         case "ollama":
-            prompt = f"{system_prompt}\n\n{context}\n\n{query}" if system_prompt else f"{context}\n\n{query}" if context else query
+            prompt = "\n\n".join(part for part in (system_prompt, few_shot_text, context, query) if part)
             payload = {
                 "model": inference_model,
                 "prompt": prompt,
@@ -99,7 +208,7 @@ def image_inference(each_panel: dict, args: tuple, return_dict: dict, idx: int)
             url = f"{inference_endpoint}/api/generate"
 
         case "llama.cpp":
-            prompt = f"{system_prompt}\n\n{context}\n\n{query}" if system_prompt else f"{context}\n\n{query}" if context else query
+            prompt = "\n\n".join(part for part in (system_prompt, few_shot_text, context, query) if part)
             payload = {
                 "prompt": prompt,
                 "stream": False,
@@ -109,31 +218,171 @@ def image_inference(each_panel: dict, args: tuple, return_dict: dict, idx: int)
             url = f"{inference_endpoint}/completion"
 
         case _:
-            logger.info(f"Unsupported model_type: {inference_model_type}")
-            return
+            return None
+    return url, payload
 
-    try:
+def send_inference_request(url: str, payload: dict, inference_api_key: str, session: requests.Session | None = None) -> str | None:
+    """
+    Send a generation request built by build_inference_request.
 
-        logger.info(f"Running inference for image: {each_panel["panel_image"]}")
-        payload["top_p"] = 0.95
-        payload["frequency_penalty"] = 1.03
-        payload["temperature"] = 0.01
-        payload["max_tokens"] = 512
-        payload["verbose"] = True
-        logger.debug(f"Sending payload: {payload}")
-        headers = {"Content-Type": "application/json"}
-        if inference_api_key:
-            headers["Authorization"] = f"Bearer {inference_api_key}"
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_json = response.json()
-        if "response" in response_json.keys():
-            each_panel['panel_text'] = response_json["response"]
-        elif "content" in response_json.keys():
-            each_panel['panel_text'] = response_json["content"]
-        elif "choices" in response_json.keys() and len(response_json["choices"]) > 0:
-            each_panel['panel_text'] = response_json["choices"][0]["message"]["content"]
-        return_dict[idx] = each_panel
-        return
+    Args:
+        url (str): request url
+        payload (dict): request payload, the sampling parameters are added to it
+        inference_api_key (str): api key to access the inference endpoint
+        session (requests.Session | None): keep-alive session to send the request over, None for a new connection
+
+    Returns:
+        str | None: generated text or None if there is none
+    """
+    payload.update(SAMPLING_PARAMS)
+    payload["verbose"] = True
+    logger.debug(f"Sending payload: {payload}")
+    headers = {"Content-Type": "application/json"}
+    if inference_api_key:
+        headers["Authorization"] = f"Bearer {inference_api_key}"
+    response = (session or requests).post(url, json=payload, headers=headers)
+    response.raise_for_status()
+    return parse_inference_response(response.json())
+
+def data_inference(each_panel: dict, args: tuple) -> dict | None:
+    """
+    Summarizes the queried data of a panel. The exact values are sent as text instead of an image.
+
+    Args:
+        each_panel (dict): panel reference to update, with the panel_data summary of its series
+        args (tuple): arguments to read, the same as image_inference
+
+    Returns:
+        dict | None: panel updated with its text or None if the inference failed
+    """
+    query, inference_endpoint, inference_api_key, inference_model, inference_model_type, _, _, inference_cache = args
+    system_prompt = SYSTEM_PROMPT
+    # The data takes the place of the image, next to the optional panel context
+    context = "\n\n".join(part for part in (each_panel.get('panel_context', ""), each_panel["panel_data"]) if part)
+    annotate_span(panel=each_panel["panel_image"], host=urlparse(inference_endpoint).netloc, bytes=len(each_panel["panel_data"]))
+    if not inference_endpoint:
+        logger.error(f"Inference of panel data requires --inference-endpoint and --inference-model-type, skipping {each_panel["panel_image"]}")
+        return None
+
+    cache_key = None
+    if inference_cache is not None:
+        cache_key = inference_cache_key(each_panel["panel_data"].encode("utf-8"), system_prompt, context, query, inference_endpoint, inference_model, inference_model_type)
+        cached = inference_cache.get_json(cache_key)
+        if cached is not None:
+            logger.info(f"Using cached inference for data: {each_panel["panel_image"]}")
+            each_panel['panel_text'] = cached["panel_text"]
+            each_panel['inference_cache'] = "hit"
+            annotate_span(status="cached")
+            return each_panel
+        each_panel['inference_cache'] = "miss"
+
+    request = build_inference_request(inference_endpoint, inference_model, inference_model_type, system_prompt, context, query)
+    if request is None:
+        logger.info(f"Unsupported model_type: {inference_model_type}")
+        return None
+    url, payload = request
+    try:
+        logger.info(f"Running inference for data: {each_panel["panel_image"]}")
+        panel_text = send_inference_request(url, payload, inference_api_key)
+        if panel_text is not None:
+            each_panel['panel_text'] = panel_text
+            if cache_key is not None:
+                inference_cache.put_json(cache_key, {"panel_text": panel_text})
+        return each_panel
     except Exception as err:
         logger.info(f"Unexpected error from inference: {err}")
+        return None
+
+def traced_request(each_panel: dict, request: callable) -> dict | None:
+    """
+    Record a span for a single inference request of a batch.
+
+    Args:
+        each_panel (dict): panel of the request
+        request (callable): sends the request and returns the updated panel, None if it failed
+
+    Returns:
+        dict | None: result of the request
+    """
+    with span("inference request", panel=each_panel["panel_image"]) as attributes:
+        result = request()
+        if result is None:
+            attributes["status"] = "error"
+        elif result.get("inference_cache") == "hit":
+            attributes["status"] = "cached"
+        return result
+
+def batch_image_inference(panels: list[dict], args: tuple) -> list[dict | None]:
+    """
+    Infer a batch of panels against a vLLM/OpenAI compatible endpoint.
+    Every request of the batch starts with the same system prompt and few-shot examples, so the server can reuse
+    its prefix cache, and up to max_in_flight requests of the batch are sent concurrently over one keep-alive session.
+    Other model types fall back to concurrent image_inference calls.
+
+    Args:
+        panels (list[dict]): panels to update
+        args (tuple): arguments to read
+
+    Returns:
+        list[dict | None]: panels updated with their text, None for the ones that failed
+    """
+    query, inference_endpoint, inference_api_key, inference_model, inference_model_type, few_shot_index, samples_count, inference_cache, max_in_flight = args
+    max_in_flight = max(1, max_in_flight)
+    if inference_model_type != "vllm" or not inference_endpoint:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            return list(pool.map(lambda each_panel: traced_request(each_panel, lambda: image_inference(each_panel, args[:-1])), panels))
+
+    system_prompt = SYSTEM_PROMPT
+    all_image_bytes = []
+    for each_panel in panels:
+        with open(each_panel.get("inference_image", each_panel["panel_image"]), "rb") as img_file:
+            all_image_bytes.append(img_file.read())
+    contexts = [each_panel.get('panel_context', "") for each_panel in panels]
+
+    # One few-shot selection for the whole batch keeps the prompt prefix identical across its requests
+    few_shot_text = ""
+    if few_shot_index:
+        try:
+            selected_examples = select_shared_few_shot_examples(few_shot_index, all_image_bytes, contexts, samples_count)
+            few_shot_text = format_few_shot_examples(selected_examples)
+            logger.info(f"Selected few-shot examples {[example_id for example_id, _ in selected_examples]} for a batch of {len(panels)} panels")
+        except Exception as e:
+            logger.warning(f"Could not load few-shot examples: {e}")
+
+    session = requests.Session()
+    session.mount(inference_endpoint, HTTPAdapter(pool_maxsize=max_in_flight))
+
+    def infer(each_panel: dict, image_bytes: bytes, context: str) -> dict | None:
+        annotate_span(host=urlparse(inference_endpoint).netloc, bytes=len(image_bytes))
+        cache_key = None
+        if inference_cache is not None:
+            cache_key = inference_cache_key(image_bytes, system_prompt, context, few_shot_query(few_shot_text, query), inference_endpoint, inference_model, inference_model_type)
+            cached = inference_cache.get_json(cache_key)
+            if cached is not None:
+                logger.info(f"Using cached inference for image: {each_panel["panel_image"]}")
+                each_panel['panel_text'] = cached["panel_text"]
+                each_panel['inference_cache'] = "hit"
+                return each_panel
+            each_panel['inference_cache'] = "miss"
+
+        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+        image_mime = image_mime_type(each_panel.get("inference_image", each_panel["panel_image"]))
+        url, payload = build_inference_request(inference_endpoint, inference_model, inference_model_type, system_prompt, context, query, image_b64, image_mime, few_shot_text)
+        try:
+            logger.info(f"Running batched inference for image: {each_panel["panel_image"]}")
+            panel_text = send_inference_request(url, payload, inference_api_key, session)
+            if panel_text is not None:
+                each_panel['panel_text'] = panel_text
+                if cache_key is not None:
+                    inference_cache.put_json(cache_key, {"panel_text": panel_text})
+            return each_panel
+        except Exception as err:
+            logger.info(f"Unexpected error from inference: {err}")
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            return list(pool.map(lambda each_panel, image_bytes, context: traced_request(each_panel, lambda: infer(each_panel, image_bytes, context)),
+                                 panels, all_image_bytes, contexts))
+    finally:
+        session.close()
@@ -0,0 +1,320 @@
+import os
+import click
+import logging
+import numpy as np
+from datetime import datetime, timezone
+from src.datasource import read_series
+from utils.tracing import annotate_span
+
+try:
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import FuncFormatter
+    import matplotlib.dates as mdates
+except ImportError:
+    Figure = None
+
+logger = logging.getLogger(__name__)
+
+# Colors of grafana's dark theme
+BACKGROUND_COLOR = "#181b1f"
+TEXT_COLOR = "#ccccdc"
+GRID_COLOR = "#2f3237"
+PALETTE = ["#73bf69", "#f2cc0c", "#8ab8ff", "#ff780a", "#f2495c", "#5794f2", "#b877d9", "#705da0", "#37872d", "#fade2a"]
+NAMED_COLORS = {
+    "green": "#73bf69",
+    "semi-dark-green": "#56a64b",
+    "red": "#f2495c",
+    "semi-dark-red": "#e02f44",
+    "yellow": "#fade2a",
+    "orange": "#ff9830",
+    "blue": "#5794f2",
+    "purple": "#b877d9",
+    "text": TEXT_COLOR,
+    "transparent": "none",
+}
+
+# Unit suffixes and scaling steps of the grafana units drawn on axes and legends
+TIME_UNITS = {"ns": 1e-9, "µs": 1e-6, "us": 1e-6, "ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0}
+TIME_STEPS = [(86400.0, "d"), (3600.0, "h"), (60.0, "min"), (1.0, "s"), (1e-3, "ms"), (1e-6, "µs"), (1e-9, "ns")]
+BYTE_UNITS = {"bytes": 1, "decbytes": 1, "kbytes": 1024, "deckbytes": 1000, "mbytes": 1024 ** 2, "decmbytes": 1000 ** 2, "gbytes": 1024 ** 3, "decgbytes": 1000 ** 3}
+DECIMAL_BYTE_SUFFIXES = ["B", "kB", "MB", "GB", "TB", "PB"]
+BINARY_BYTE_SUFFIXES = ["B", "KiB", "MiB", "GiB", "TiB", "PiB"]
+RATE_UNITS = {"reqps": " req/s", "rps": " req/s", "ops": " ops/s", "wps": " wr/s", "iops": " io/s", "Bps": "B/s", "bps": "b/s", "hertz": "Hz"}
+SI_PREFIXES = [(1e12, "T"), (1e9, "G"), (1e6, "M"), (1e3, "k")]
+
+# Reducers grafana applies to bar panels and legend values
+REDUCERS = {
+    "lastNotNull": lambda values: values[-1],
+    "last": lambda values: values[-1],
+    "firstNotNull": lambda values: values[0],
+    "first": lambda values: values[0],
+    "mean": np.mean,
+    "max": np.max,
+    "min": np.min,
+    "sum": np.sum,
+    "count": len,
+}
+
+def require_matplotlib() -> None:
+    """
+    Make sure the local renderer can be used, failing the command with a usage error when matplotlib is missing.
+
+    Returns:
+        None
+    """
+    if Figure is None:
+        raise click.UsageError("--renderer local requires matplotlib, install it with pip install -r requirements.txt or pip install matplotlib")
+
+def format_value(value: float, unit: str) -> str:
+    """
+    Format a value with its grafana unit, scaling it like grafana does.
+
+    Args:
+        value (float): value to format
+        unit (str): grafana unit id such as ms, percent, bytes or reqps
+
+    Returns:
+        str: formatted value
+    """
+    if not np.isfinite(value):
+        return ""
+    if unit == "percent":
+        return f"{value:.3g}%"
+    if unit == "percentunit":
+        return f"{100 * value:.3g}%"
+    if unit in TIME_UNITS:
+        seconds = value * TIME_UNITS[unit]
+        for step, suffix in TIME_STEPS:
+            if abs(seconds) >= step or step == 1e-9:
+                return f"{seconds / step:.3g} {suffix}" if seconds else "0"
+    if unit in BYTE_UNITS:
+        scaled = value * BYTE_UNITS[unit]
+        base, suffixes = (1000, DECIMAL_BYTE_SUFFIXES) if unit.startswith("dec") else (1024, BINARY_BYTE_SUFFIXES)
+        power = min(len(suffixes) - 1, int(np.log(abs(scaled)) // np.log(base))) if abs(scaled) >= 1 else 0
+        return f"{scaled / base ** power:.3g} {suffixes[power]}"
+    suffix = RATE_UNITS.get(unit, "")
+    if unit.startswith("suffix:"):
+        suffix = unit[len("suffix:"):]
+    for step, prefix in SI_PREFIXES:
+        if abs(value) >= step:
+            return f"{value / step:.3g}{prefix}{suffix}"
+    return f"{value:.3g}{suffix}"
+
+def threshold_steps(field_config: dict) -> list[tuple[float, str]]:
+    """
+    Absolute threshold steps of a panel.
+
+    Args:
+        field_config (dict): fieldConfig defaults of the panel
+
+    Returns:
+        list[tuple[float, str]]: value and color of every step, the base step has a value of -inf
+    """
+    thresholds = field_config.get("thresholds") or {}
+    if thresholds.get("mode", "absolute") != "absolute":
+        return []
+    steps = []
+    for step in thresholds.get("steps", []):
+        value = -np.inf if step.get("value") is None else float(step["value"])
+        steps.append((value, NAMED_COLORS.get(step.get("color", ""), step.get("color", PALETTE[0]))))
+    return sorted(steps)
+
+def threshold_color(value: float, steps: list[tuple[float, str]], default: str) -> str:
+    """
+    Color of the threshold step a value falls in.
+
+    Args:
+        value (float): value to color
+        steps (list[tuple[float, str]]): steps returned by threshold_steps
+        default (str): color when there are no thresholds
+
+    Returns:
+        str: color of the value
+    """
+    color = default
+    for step_value, step_color in steps:
+        if value >= step_value:
+            color = step_color
+    return color
+
+def reduce_series(values: np.ndarray, calc: str) -> float:
+    """
+    Reduce the values of a series to one value with a grafana reducer.
+
+    Args:
+        values (np.ndarray): values of the series
+        calc (str): reducer id such as lastNotNull, mean or max
+
+    Returns:
+        float: reduced value, NaN for a series without values
+    """
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return np.nan
+    return float(REDUCERS.get(calc, REDUCERS["lastNotNull"])(finite))
+
+def style_axes(axes, unit: str) -> None:
+    """
+    Apply grafana's dark theme to the axes of a panel.
+
+    Args:
+        axes: matplotlib axes to style
+        unit (str): grafana unit of the values on the y axis
+
+    Returns:
+        None
+    """
+    axes.set_facecolor(BACKGROUND_COLOR)
+    axes.tick_params(colors=TEXT_COLOR, labelsize=8)
+    axes.grid(True, color=GRID_COLOR, linewidth=0.8)
+    axes.set_axisbelow(True)
+    for spine in axes.spines.values():
+        spine.set_visible(False)
+    axes.yaxis.set_major_formatter(FuncFormatter(lambda value, _: format_value(value, unit)))
+
+def draw_timeseries(axes, series: list[dict], panel_json: dict, field_config: dict, unit: str) -> None:
+    """
+    Draw the series of a timeseries or graph panel as lines, with their threshold lines or areas.
+
+    Args:
+        axes: matplotlib axes to draw on
+        series (list[dict]): series of the panel
+        panel_json (dict): panel json
+        field_config (dict): fieldConfig defaults of the panel
+        unit (str): grafana unit of the values
+
+    Returns:
+        None
+    """
+    custom = field_config.get("custom") or {}
+    legend = (panel_json.get("options") or {}).get("legend") or {}
+    calcs = legend.get("calcs", [])
+    for index, each_series in enumerate(series):
+        x = each_series["time"].astype("datetime64[ms]") if each_series["time"] is not None else np.arange(len(each_series["values"]))
+        label = each_series["name"]
+        if calcs:
+            label += "  " + "  ".join(f"{calc}: {format_value(reduce_series(each_series['values'], calc), unit)}" for calc in calcs)
+        color = PALETTE[index % len(PALETTE)]
+        axes.plot(x, each_series["values"], color=color, linewidth=custom.get("lineWidth", 1), label=label)
+        if custom.get("fillOpacity"):
+            axes.fill_between(x, each_series["values"], color=color, alpha=custom["fillOpacity"] / 100, linewidth=0)
+    if any(each_series["time"] is not None for each_series in series):
+        axes.xaxis.set_major_formatter(mdates.DateFormatter("%m/%d %H:%M", tz=timezone.utc))
+        axes.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=8))
+
+    mode = (custom.get("thresholdsStyle") or {}).get("mode", "off")
+    if mode != "off":
+        steps = threshold_steps(field_config)
+        top = axes.get_ylim()[1]
+        for index, (value, color) in enumerate(steps):
+            if "area" in mode:
+                upper = steps[index + 1][0] if index + 1 < len(steps) else max(top, value)
+                axes.axhspan(max(value, axes.get_ylim()[0]), upper, color=color, alpha=0.15, linewidth=0)
+            if np.isfinite(value) and ("line" in mode or "dashed" in mode):
+                axes.axhline(value, color=color, linewidth=1, linestyle="--" if "dashed" in mode else "-")
+
+def draw_bars(axes, series: list[dict], panel_json: dict, field_config: dict, unit: str, horizontal: bool) -> None:
+    """
+    Draw the series of a bar chart or bar gauge panel as one bar each, colored by threshold for bar gauges.
+
+    Args:
+        axes: matplotlib axes to draw on
+        series (list[dict]): series of the panel
+        panel_json (dict): panel json
+        field_config (dict): fieldConfig defaults of the panel
+        unit (str): grafana unit of the values
+        horizontal (bool): draw horizontal bars
+
+    Returns:
+        None
+    """
+    options = panel_json.get("options") or {}
+    calcs = (options.get("reduceOptions") or {}).get("calcs") or ["lastNotNull"]
+    values = np.array([reduce_series(each_series["values"], calcs[0]) for each_series in series])
+    names = [each_series["name"] for each_series in series]
+    steps = threshold_steps(field_config) if panel_json.get("type") == "bargauge" else []
+    colors = [threshold_color(value, steps, PALETTE[index % len(PALETTE)]) for index, value in enumerate(values)]
+    positions = np.arange(len(series))
+    bars = axes.barh(positions, np.nan_to_num(values), color=colors) if horizontal else axes.bar(positions, np.nan_to_num(values), color=colors)
+    axes.bar_label(bars, labels=[format_value(value, unit) for value in values], color=TEXT_COLOR, fontsize=8, padding=2)
+    if horizontal:
+        axes.set_yticks(positions, names)
+        axes.invert_yaxis()
+        axes.xaxis.set_major_formatter(FuncFormatter(lambda value, _: format_value(value, unit)))
+    else:
+        axes.set_xticks(positions, names, rotation=30 if len(series) > 6 else 0, ha="right" if len(series) > 6 else "center")
+
+def render_series(series: list[dict], panel_json: dict, title: str, width: int, height: int, image_path: str) -> int:
+    """
+    Draw the series of a panel into a png the size grafana would render it.
+
+    Args:
+        series (list[dict]): series of the panel
+        panel_json (dict): panel json, its type, field config and options decide how it is drawn
+        title (str): title drawn on top of the panel
+        width (int): width of the image in pixels
+        height (int): height of the image in pixels
+        image_path (str): png file to write
+
+    Returns:
+        int: bytes written
+    """
+    require_matplotlib()
+    field_config = (panel_json.get("fieldConfig") or {}).get("defaults") or {}
+    unit = field_config.get("unit", "") or next((each_series["unit"] for each_series in series if each_series["unit"]), "")
+    figure = Figure(figsize=(width / 100, height / 100), dpi=100, facecolor=BACKGROUND_COLOR)
+    axes = figure.add_subplot()
+    style_axes(axes, unit)
+    figure.suptitle(title, color=TEXT_COLOR, fontsize=10, x=0.01, ha="left")
+
+    panel_type = panel_json.get("type", "timeseries")
+    horizontal = (panel_json.get("options") or {}).get("orientation", "horizontal" if panel_type == "bargauge" else "vertical") == "horizontal"
+    if not series:
+        axes.text(0.5, 0.5, "No data", color=TEXT_COLOR, ha="center", va="center", transform=axes.transAxes)
+    elif panel_type in ("barchart", "bargauge"):
+        draw_bars(axes, series, panel_json, field_config, unit, horizontal)
+    else:
+        draw_timeseries(axes, series, panel_json, field_config, unit)
+    if panel_type not in ("barchart", "bargauge") and (field_config.get("min") is not None or field_config.get("max") is not None):
+        axes.set_ylim(field_config.get("min"), field_config.get("max"))
+
+    legend = (panel_json.get("options") or {}).get("legend") or {}
+    if series and panel_type not in ("barchart", "bargauge") and legend.get("showLegend", True) and legend.get("displayMode") != "hidden":
+        placement = {"loc": "center left", "bbox_to_anchor": (1.01, 0.5)} if legend.get("placement") == "right" else {"loc": "upper left", "bbox_to_anchor": (0, -0.12), "ncols": 3}
+        axes.legend(frameon=False, labelcolor=TEXT_COLOR, fontsize=8, **placement)
+    figure.tight_layout()
+    figure.savefig(image_path, format="png", facecolor=BACKGROUND_COLOR)
+    return os.path.getsize(image_path)
+
+def draw_panel(each_panel: dict, args: tuple) -> dict | None:
+    """
+    Draw a panel from the series query_panel fetched, in place of a grafana render.
+    Runs on the image process pool, the png is written where process_panel writes renders.
+
+    Args:
+        each_panel (dict): queried panel, its panel_image is the data file of its series
+        args (tuple): unused, the panel carries everything it is drawn from
+
+    Returns:
+        dict | None: panel with panel_image pointing at the png or None if it could not be drawn
+    """
+    if each_panel.get("resumed"):
+        return each_panel
+    data_path = each_panel["panel_image"]
+    image_path = os.path.splitext(data_path)[0] + ".png"
+    annotate_span(panel=os.path.basename(image_path))
+    try:
+        started = datetime.now(timezone.utc)
+        size = render_series(read_series(data_path),
+                             each_panel["panel_json"],
+                             each_panel["panel_title"] or each_panel["panel_json"].get("title", ""),
+                             int(each_panel["panel_width"]),
+                             int(each_panel["panel_height"]),
+                             image_path)
+        annotate_span(bytes=size)
+        each_panel["panel_image"] = image_path
+        logger.info(f"Drew {os.path.basename(image_path)} to {image_path} in {(datetime.now(timezone.utc) - started).total_seconds():.2f}s")
+        return each_panel
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Error drawing panel {each_panel['panel_id']}: {e}")
+        return None
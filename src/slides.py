@@ -1,13 +1,23 @@
 import os
 import csv
 import json
+import time
+import random
+import hashlib
 import logging
 from typing import Any
 from tabulate import tabulate
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from src.drive import upload_image_to_drive
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor
+from src.drive import create_drive_service, upload_images_to_drive
+from src.images import optimize_image
+from utils.cache import DiskCache, make_cache_key
+from utils.concurrency import get_limiter
+from utils.logging import log_duration
+from utils.tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +27,18 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive.file'
 ]
 
+# Only the parts of a presentation yoda reads
+PRESENTATION_FIELDS = "revisionId,slides(objectId,pageElements(objectId,image(contentUrl,sourceUrl),shape(text(textElements(textRun(content))))))"
+
+# Bounds of a single batchUpdate call
+BATCH_MAX_REQUESTS = 200
+BATCH_MAX_BYTES = 512 * 1024
+
+# Rate limited and transient google api errors are retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+RETRY_MAX_DELAY = 32
+
 def authenticate_google_slides(credentials_file: str) -> Any:
     """
     Function authenticate goole slides.
@@ -45,32 +67,38 @@ def authenticate_google_slides(credentials_file: str) -> Any:
             token.write(creds.to_json())
     return creds
 
-def get_slide_info(service: Any, presentation_id: str, expand: bool, csv_path="") -> dict:
+def fetch_presentation(service: Any, presentation_id: str, fields: str = PRESENTATION_FIELDS) -> dict:
     """
-    Function to process a presentation and fetch slides information.
+    Function to fetch the parts of a presentation yoda works with.
 
     Args:
         service (Any): service object for google apps
-        presentation_id (str): presentation id to process
-        expand (bool): flag to log the slides information into console
-        csv_path (Optional[str]): csv path to store the slides preview
+        presentation_id (str): presentation id to fetch
+        fields (str): fields mask of the presentation
 
     Returns:
-        slide_info (dict): dictionary that has all the slide information
+        presentation (dict): masked presentation
+    """
+    return execute_with_retry(service.presentations().get(presentationId=presentation_id, fields=fields))
+
+def parse_slides(presentation: dict) -> dict:
     """
-    presentation = service.presentations().get(presentationId=presentation_id).execute()
-    slides = presentation.get('slides')
+    Function to extract the images and texts of every slide.
+
+    Args:
+        presentation (dict): presentation to parse
 
+    Returns:
+        slide_info (dict): dictionary that has all the slide information
+    """
     slide_info = {}
-    data = [['Slide Number', 'Slide ID', 'Slide Data']]
-    for idx, slide in enumerate(slides):
-        slide_id = slide.get('objectId')
+    for slide in presentation.get('slides', []):
         slide_data = {'images': {}, 'texts': {}}
-        for element in slide.get('pageElements'):
+        for element in slide.get('pageElements', []):
             # Extract image information
             if element.get('image'):
                 slide_data['images'][element['objectId']] = element['image'].get('contentUrl', None)
-            
+
             # Extract text information
             if 'shape' in element and 'text' in element['shape']:
                 text_elements = element['shape']['text'].get('textElements', [])
@@ -80,8 +108,41 @@ def get_slide_info(service: Any, presentation_id: str, expand: bool, csv_path=""
                         text_runs.append(text_element['textRun']['content'])
                 if text_runs:
                     slide_data['texts'][element['objectId']] = ''.join(text_runs)
-        
-        slide_info[slide_id] = slide_data
+        slide_info[slide.get('objectId')] = slide_data
+    return slide_info
+
+def image_source_urls(presentation: dict) -> dict:
+    """
+    Function to map every image of a presentation to the url it was inserted from.
+
+    Args:
+        presentation (dict): presentation to parse
+
+    Returns:
+        dict: source url of every image object id
+    """
+    return {element['objectId']: element['image'].get('sourceUrl')
+            for slide in presentation.get('slides', [])
+            for element in slide.get('pageElements', [])
+            if element.get('image')}
+
+def get_slide_info(service: Any, presentation_id: str, expand: bool, csv_path="") -> dict:
+    """
+    Function to process a presentation and fetch slides information.
+
+    Args:
+        service (Any): service object for google apps
+        presentation_id (str): presentation id to process
+        expand (bool): flag to log the slides information into console
+        csv_path (Optional[str]): csv path to store the slides preview
+
+    Returns:
+        slide_info (dict): dictionary that has all the slide information
+    """
+    slide_info = parse_slides(fetch_presentation(service, presentation_id))
+
+    data = [['Slide Number', 'Slide ID', 'Slide Data']]
+    for idx, (slide_id, slide_data) in enumerate(slide_info.items()):
         data.append([idx + 1, slide_id, json.dumps(slide_data, indent=2)])
     if csv_path != "":
         with open(csv_path, mode='w', newline='', encoding='utf-8') as file:
@@ -95,23 +156,148 @@ def get_slide_info(service: Any, presentation_id: str, expand: bool, csv_path=""
         logger.info("\n" + table)
     return slide_info
 
-def replace_images_and_text(service, presentation_id, slide_info, slide_mapping) -> Any:
+def execute_with_retry(request: Any) -> Any:
+    """
+    Function to execute a google api request, retrying rate limited and failed calls with exponential backoff.
+
+    Args:
+        request (Any): google api request
+
+    Returns:
+        response (Any): response of the request
+    """
+    with span(f"google {getattr(request, 'methodId', 'request')}") as attributes:
+        for attempt in range(MAX_RETRIES + 1):
+            attributes["retries"] = attempt
+            try:
+                with get_limiter("google").slot():
+                    return request.execute()
+            except HttpError as e:
+                if e.resp.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    raise
+                retry_after = e.resp.get('retry-after')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else min(RETRY_MAX_DELAY, 2 ** attempt) + random.random()
+                logger.info(f"Google api returned {e.resp.status}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+def chunk_requests(units: list[list[dict]]) -> list[list[dict]]:
     """
-    Function to replace images and text in the slides.
+    Function to split requests into size bounded batches. Requests of a unit always end up in the same batch.
+
+    Args:
+        units (list[list[dict]]): groups of requests that must be applied together
+
+    Returns:
+        list[list[dict]]: batches of requests
+    """
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for unit in units:
+        unit_bytes = len(json.dumps(unit))
+        if chunk and (len(chunk) + len(unit) > BATCH_MAX_REQUESTS or chunk_bytes + unit_bytes > BATCH_MAX_BYTES):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.extend(unit)
+        chunk_bytes += unit_bytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def batch_update_presentation(service: Any, presentation_id: str, units: list[list[dict]]) -> dict:
+    """
+    Function to apply requests to a presentation in size bounded batchUpdate calls.
+
+    Args:
+        service (Any): service object for google apps
+        presentation_id (str): presentation id to update
+        units (list[list[dict]]): groups of requests that must be applied together
+
+    Returns:
+        response (dict): replies of every batch and the writeControl holding the revisionId after the last one
+    """
+    response = {'presentationId': presentation_id, 'replies': [], 'writeControl': {}}
+    chunks = chunk_requests(units)
+    for idx, chunk in enumerate(chunks):
+        logger.info(f"Sending batch {idx + 1}/{len(chunks)} with {len(chunk)} requests to presentation: {presentation_id}")
+        chunk_response = execute_with_retry(service.presentations().batchUpdate(presentationId=presentation_id, body={'requests': chunk}))
+        response['replies'].extend(chunk_response.get('replies', []))
+        response['writeControl'] = chunk_response.get('writeControl', {})
+    return response
+
+def slide_mapping_hash(slide_mapping: dict, image_options: tuple | None) -> str:
+    """
+    Function to fingerprint the content a slide mapping puts in a presentation.
+
+    Args:
+        slide_mapping (dict): slide content mapping from the user provided input
+        image_options (tuple | None): optimize_image arguments applied to the images
+
+    Returns:
+        str: hash of the texts, the image contents and the image options
+    """
+    content = {}
+    for slide, slide_content in slide_mapping.get("slide_info", {}).items():
+        images = {}
+        for each_image, image_path in slide_content.get("images", {}).items():
+            try:
+                with open(image_path, "rb") as image_file:
+                    images[each_image] = hashlib.sha256(image_file.read()).hexdigest()
+            except OSError:
+                images[each_image] = None
+        content[slide] = {"images": images, "texts": slide_content.get("texts", {})}
+    options = list(image_options[:3]) if image_options is not None else None
+    return make_cache_key("slide_mapping", content, options)
+
+def prepare_image_upload(source_path: str, image_options: tuple | None) -> tuple[str, str, str]:
+    """
+    Optimize an image mapped to a slide before its upload.
+
+    Args:
+        source_path (str): image path from the slide mapping
+        image_options (tuple | None): optimize_image arguments, None to upload the image as is
+
+    Returns:
+        tuple[str, str, str]: image path to upload, its file name in drive and its manifest key
+    """
+    image_path = source_path
+    if image_options is not None:
+        try:
+            image_path = optimize_image(source_path, image_options)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not optimize {source_path}, uploading it as is: {e}")
+    # Optimized variants are named after their content, drive keeps the source name
+    file_name = os.path.splitext(os.path.basename(source_path))[0] + os.path.splitext(image_path)[1]
+    return image_path, file_name, os.path.abspath(source_path)
+
+def replace_images_and_text(service, presentation_id, slide_info, slide_mapping, image_options=None, manifest=None, max_workers=8, image_sources=None, image_state=None) -> Any:
+    """
+    Function to replace images and text in the slides. Only the images and texts that differ from the presentation are sent.
 
     Args:
         service (Any): service object for google apps
         presentation_id (str): presentation id to process
         slide_info (dict): dictionary containing existing slides information
         slide_mapping (dict): slide content mapping from the user provided input
+        image_options (Optional[tuple]): optimize_image arguments to shrink images before uploading them
+        manifest (Optional[DriveManifest]): manifest of the images already uploaded to drive
+        max_workers (Optional[int]): maximum concurrent image uploads
+        image_sources (Optional[dict]): source url of every image in the presentation
+        image_state (Optional[dict]): content hash and url of the images set by earlier runs, updated in place
 
     Returns:
-        response (Any): consolidated object storing response for multiple requests
+        tuple[Any, list[str]]: consolidated object storing response for multiple requests, and the source paths of
+        the mapped images the presentation shows once it is applied
     """
-    requests = []
+    units = []
+    image_requests = []
+    applied_images = []
+    image_sources = image_sources or {}
+    image_state = image_state if image_state is not None else {}
     if "slide_info" not in slide_mapping:
         logger.info("Slide information not present in the mapping provided")
-        return
+        return None, applied_images
     slide_content_mapping = slide_mapping["slide_info"]
     for slide in slide_content_mapping:
         if slide not in slide_info:
@@ -124,22 +310,22 @@ def replace_images_and_text(service, presentation_id, slide_info, slide_mapping)
                         logger.info(f"Image: {each_image} is not found in slide: {slide}. Hence skipping it")
                         continue
                     else:
-                        image_url = upload_image_to_drive(service, slide_content_mapping[slide]["images"][each_image])
-                        requests.append({
-                            'replaceImage': {
-                                'imageObjectId': each_image,
-                                'url': image_url,
-                                'imageReplaceMethod': 'CENTER_INSIDE'
-                            }
-                        })
+                        image_requests.append((each_image, slide_content_mapping[slide]["images"][each_image]))
             if "texts" in slide_content_mapping[slide]:
                 for each_text in slide_content_mapping[slide]["texts"]:
                     if each_text not in slide_info[slide]["texts"]:
                         logger.info(f"Text: {each_text} is not found in slide: {slide}. Hence skipping it")
                         continue
-                    else:
+                    new_text = str(slide_content_mapping[slide]["texts"][each_text])
+                    current_text = slide_info[slide]["texts"][each_text]
+                    # Slides always ends a text with a newline
+                    if current_text.rstrip("\n") == new_text.rstrip("\n"):
+                        logger.debug(f"Text: {each_text} is unchanged. Hence skipping it")
+                        continue
+                    unit = []
+                    if current_text.rstrip("\n"):
                         # Create a request to delete the existing text
-                        requests.append({
+                        unit.append({
                             'deleteText': {
                                 'objectId': each_text,
                                 'textRange': {
@@ -147,17 +333,90 @@ def replace_images_and_text(service, presentation_id, slide_info, slide_mapping)
                                 }
                             }
                         })
+                    if new_text:
                         # Create a request to insert new text
-                        requests.append({
+                        unit.append({
                             'insertText': {
                                 'objectId': each_text,
                                 'insertionIndex': 0,
-                                'text': slide_content_mapping[slide]["texts"][each_text]
+                                'text': new_text
                             }
                         })
+                    units.append(unit)
 
-    body = {
-        'requests': requests
-    }
-    response = service.presentations().batchUpdate(presentationId=presentation_id, body=body).execute()
-    return response
+    if image_requests:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            images = list(pool.map(lambda image_request: prepare_image_upload(image_request[1], image_options), image_requests))
+        changed = []
+        for (each_image, source_path), image in zip(image_requests, images):
+            with open(image[0], "rb") as image_file:
+                content_hash = hashlib.sha256(image_file.read()).hexdigest()
+            previous = image_state.get(each_image)
+            if previous is not None and previous["sha256"] == content_hash and image_sources.get(each_image) == previous["url"]:
+                logger.debug(f"Image: {each_image} is unchanged. Hence skipping it")
+                applied_images.append(source_path)
+                continue
+            changed.append((each_image, source_path, image, content_hash))
+
+        if changed:
+            with log_duration(logger, f"Uploading {len(changed)} images to drive"):
+                credentials = service._http.credentials
+                drive_service = create_drive_service(credentials)
+                image_urls = upload_images_to_drive(drive_service, credentials, [image for _, _, image, _ in changed], manifest, max_workers)
+            for (each_image, source_path, _, content_hash), image_url in zip(changed, image_urls):
+                if image_url is None:
+                    logger.info(f"Image: {source_path} could not be uploaded. Hence skipping it")
+                    continue
+                image_state[each_image] = {"sha256": content_hash, "url": image_url}
+                applied_images.append(source_path)
+                units.append([{
+                    'replaceImage': {
+                        'imageObjectId': each_image,
+                        'url': image_url,
+                        'imageReplaceMethod': 'CENTER_INSIDE'
+                    }
+                }])
+
+    if not units:
+        logger.info(f"Presentation: {presentation_id} is already up to date")
+        return {'presentationId': presentation_id, 'replies': [], 'writeControl': {}}, applied_images
+    return batch_update_presentation(service, presentation_id, units), applied_images
+
+def apply_slide_mapping(service: Any, presentation_id: str, slide_mapping: dict, image_options: tuple | None = None, manifest: Any = None, max_workers: int = 8, state_cache: DiskCache | None = None) -> Any:
+    """
+    Function to update a presentation with a slide mapping, skipping it entirely when neither has changed since the last update.
+
+    Args:
+        service (Any): service object for google apps
+        presentation_id (str): presentation id to update
+        slide_mapping (dict): slide content mapping from the user provided input
+        image_options (tuple | None): optimize_image arguments to shrink images before uploading them
+        manifest (Any): manifest of the images already uploaded to drive
+        max_workers (int): maximum concurrent image uploads
+        state_cache (DiskCache | None): cache keeping the state of the presentation after every update
+
+    Returns:
+        tuple[Any, list[str]]: batchUpdate replies and the revisionId of the presentation, None when it was skipped,
+        and the source paths of the mapped images the presentation shows
+    """
+    content_hash = slide_mapping_hash(slide_mapping, image_options)
+    state_key = make_cache_key("presentation", presentation_id)
+    state = state_cache.get_json(state_key) if state_cache is not None else None
+    if state is not None:
+        revision_id = fetch_presentation(service, presentation_id, "revisionId").get("revisionId")
+        if revision_id == state["revision_id"] and content_hash == state["content_hash"]:
+            logger.info(f"Presentation: {presentation_id} and its slide mapping are unchanged since the last update. Hence skipping it")
+            # Images set by the last update are still in place
+            applied_images = [source_path for slide_content in slide_mapping.get("slide_info", {}).values()
+                              for each_image, source_path in slide_content.get("images", {}).items() if each_image in state["images"]]
+            return None, applied_images
+
+    presentation = fetch_presentation(service, presentation_id)
+    image_state = state["images"] if state is not None else {}
+    response, applied_images = replace_images_and_text(service, presentation_id, parse_slides(presentation), slide_mapping, image_options, manifest, max_workers, image_source_urls(presentation), image_state)
+    if response is None:
+        return None, applied_images
+    response['revisionId'] = response['writeControl'].get('requiredRevisionId', presentation.get('revisionId'))
+    if state_cache is not None:
+        state_cache.put_json(state_key, {"revision_id": response['revisionId'], "content_hash": content_hash, "images": image_state})
+    return response, applied_images
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from src.analysis import CHANGE_POINT_SCORE, analyze_panels, change_points
+from src.datasource import write_series
+
+# Epoch milliseconds of the first run, one run per hour after it
+START = 1_700_000_000_000
+HOUR = 3_600_000
+
+def step(runs: int, before: float, after: float, noise: float = 1.0, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    values = np.where(np.arange(runs) < runs // 2, before, after)
+    return values + rng.normal(0, noise, runs)
+
+def pad(rows: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    counts = np.array([len(row) for row in rows])
+    values = np.full((len(rows), max(1, counts.max())), np.nan)
+    for index, row in enumerate(rows):
+        values[index, :len(row)] = row
+    return values, counts
+
+def write_panel(tmp_path, name: str, versions: dict[str, list], unit: str = "ms") -> dict:
+    panel_image = str(tmp_path / f"{name}.png")
+    series = []
+    for version, values in versions.items():
+        values = np.array(values, dtype=np.float64)
+        series.append({"ref_id": "A", "name": version, "labels": {"version": version}, "unit": unit,
+                       "time": START + HOUR * np.arange(len(values), dtype=np.int64), "values": values})
+    write_series(series, str(tmp_path / f"{name}.json"))
+    return {"panel_image": panel_image}
+
+@pytest.mark.parametrize("runs", [8, 12, 16, 20, 24])
+def test_change_points_detects_step(runs):
+    values, counts = pad([step(runs, 100, 140)])
+    split, score = change_points(values, counts)
+    assert split[0] == runs // 2
+    assert score[0] > CHANGE_POINT_SCORE
+
+def test_change_points_noiseless_step():
+    values, counts = pad([np.array([1.0, 1.0, 5.0, 5.0])])
+    split, score = change_points(values, counts)
+    assert split[0] == 2
+    assert score[0] > CHANGE_POINT_SCORE
+
+def test_change_points_no_change():
+    values, counts = pad([step(24, 100, 100, seed=seed) for seed in range(50)])
+    _, score = change_points(values, counts)
+    assert (score <= CHANGE_POINT_SCORE).mean() > 0.9
+
+def test_change_points_mixed_lengths():
+    values, counts = pad([step(12, 100, 140), np.array([100.0]), np.array([]), step(6, 10, 20, noise=0.1)])
+    split, score = change_points(values, counts)
+    assert split[0] == 6 and split[3] == 3
+    assert score[1] == 0.0 and score[2] == 0.0
+
+def test_change_points_all_nan():
+    values = np.full((2, 4), np.nan)
+    _, score = change_points(values, np.array([0, 0]))
+    assert np.all(score == 0.0)
+
+def test_analyze_panels_step_regression(tmp_path):
+    panel = write_panel(tmp_path, "step", {"4.14": step(12, 100, 100), "4.15": step(12, 100, 140, seed=1)})
+    verdict = analyze_panels([panel])[0]
+    assert verdict["Baseline"] == "4.14" and verdict["Candidate"] == "4.15"
+    assert verdict["Verdict"] == "regression"
+    assert verdict["Delta %"] == pytest.approx(20, abs=2)
+    assert verdict["CI Low %"] > 0
+    assert verdict["Change Point"] == "2023-11-15 04:13"
+
+def test_analyze_panels_higher_is_better(tmp_path):
+    panel = write_panel(tmp_path, "throughput", {"4.14": step(8, 100, 100), "4.15": step(8, 140, 140, seed=1)}, unit="reqps")
+    assert analyze_panels([panel])[0]["Verdict"] == "improvement"
+
+def test_analyze_panels_no_change(tmp_path):
+    panel = write_panel(tmp_path, "flat", {"4.14": step(12, 100, 100), "4.15": step(12, 100, 100, seed=1)})
+    verdict = analyze_panels([panel])[0]
+    assert verdict["Verdict"] == "no change"
+    assert verdict["CI Low %"] < 0 < verdict["CI High %"]
+    assert verdict["Change Point"] == ""
+
+def test_analyze_panels_single_run(tmp_path):
+    panel = write_panel(tmp_path, "single", {"4.14": [100.0], "4.15": [120.0]})
+    verdict = analyze_panels([panel], threshold=5.0)[0]
+    # Without several runs there is no interval and the threshold alone decides
+    assert verdict["Verdict"] == "regression"
+    assert verdict["Delta %"] == 20
+    assert verdict["CI Low %"] == "" and verdict["CI High %"] == ""
+
+def test_analyze_panels_all_nan(tmp_path):
+    panel = write_panel(tmp_path, "empty", {"4.14": [np.nan, np.nan], "4.15": [np.nan, np.nan]})
+    assert analyze_panels([panel])[0]["Verdict"] == "n/a"
+
+def test_analyze_panels_missing_data(tmp_path):
+    verdicts = analyze_panels([{"panel_image": str(tmp_path / "missing.png")}])
+    assert verdicts[0]["Verdict"] == "n/a"
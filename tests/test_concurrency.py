@@ -0,0 +1,89 @@
+import threading
+from utils.concurrency import AdaptiveLimiter
+
+def grow(limiter: AdaptiveLimiter, samples: int, latency: float = 0.01) -> None:
+    for _ in range(samples):
+        limiter.observe(latency, True, limiter.limit)
+
+def test_slow_start_grows_to_the_ceiling():
+    limiter = AdaptiveLimiter("test", 16)
+    assert limiter.limit == 2
+    grow(limiter, 2)
+    assert limiter.limit == 4
+    grow(limiter, 4)
+    assert limiter.limit == 8
+    grow(limiter, 100)
+    assert limiter.limit == 16
+
+def test_idle_limit_does_not_grow():
+    limiter = AdaptiveLimiter("test", 16, initial_limit=8)
+    for _ in range(20):
+        limiter.observe(0.01, True, 1)
+    assert limiter.limit == 8
+
+def test_failure_halves_the_limit_and_ends_slow_start():
+    limiter = AdaptiveLimiter("test", 64, initial_limit=32)
+    limiter.observe(0.0, False, 32)
+    assert limiter.limit == 16
+    assert limiter.failures == 1
+    # Additive increase after the first backoff, about one per round trip of the limit
+    grow(limiter, 8)
+    assert limiter.limit == 16
+    grow(limiter, 9)
+    assert limiter.limit == 17
+
+def test_queueing_backs_off_once_per_round_trip():
+    limiter = AdaptiveLimiter("test", 64, initial_limit=20)
+    limiter.observe(0.01, True, 1)
+    limiter.observe(1.0, True, 20)
+    assert limiter.limit == 18
+    # Further slow samples within the same round trip are the same signal
+    limiter.observe(1.0, True, 20)
+    assert limiter.limit == 18
+
+def test_backoff_stops_at_the_floor():
+    limiter = AdaptiveLimiter("test", 32, min_limit=3, initial_limit=32)
+    for _ in range(10):
+        limiter.observe(0.0, False, limiter.limit)
+    assert limiter.limit == 3
+    assert min(limit for _, limit in limiter.history) == 3
+
+def test_limits_are_clamped():
+    limiter = AdaptiveLimiter("test", 4, min_limit=10, initial_limit=50)
+    assert limiter.min_limit == 4
+    assert limiter.limit == 4
+
+def test_slot_bounds_concurrent_requests():
+    limiter = AdaptiveLimiter("test", 2, initial_limit=2)
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def request() -> None:
+        with limiter.slot():
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            release.wait(1)
+            with lock:
+                in_flight.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 2
+    assert limiter.samples == 6
+
+def test_slot_counts_exceptions_as_failures():
+    limiter = AdaptiveLimiter("test", 8, initial_limit=8)
+    try:
+        with limiter.slot():
+            raise RuntimeError("endpoint down")
+    except RuntimeError:
+        pass
+    assert limiter.failures == 1
+    assert limiter.limit == 4
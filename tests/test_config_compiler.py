@@ -0,0 +1,82 @@
+import json
+from urllib.parse import parse_qs, urlparse
+from utils.cache import DiskCache
+from utils.config_compiler import compile_config, expand_matrix, load_render_plan, plan_to_grafana_data
+
+RAW_URL = "https://grafana/d/uid1/ingress?orgId=1&var-x=&from=now-7d"
+
+def query(url: str) -> dict:
+    return parse_qs(urlparse(url).query, keep_blank_values=True)
+
+def grafana_config(*dashboards: dict) -> dict:
+    return {"grafana": [{"alias": "dev", "url": "https://grafana", "username": "user", "password": "secret", "dashboards": list(dashboards)}]}
+
+def test_expand_matrix_without_matrix():
+    entry = {"alias": "d", "raw_url": RAW_URL, "output": "out"}
+    assert expand_matrix(entry) == [entry]
+
+def test_expand_matrix_combinations():
+    entry = {"alias": "{termination} {platform}", "raw_url": RAW_URL, "output": "out_{termination}_{platform}",
+             "matrix": {"termination": ["edge", "http"], "platform": ["AWS", ["GCP", "Azure"]]},
+             "panels": [{"id": 1, "alias": "RPS {termination}", "context": "{unknown} stays"}]}
+    expanded = expand_matrix(entry)
+    assert [each["alias"] for each in expanded] == ["edge AWS", "edge GCP,Azure", "http AWS", "http GCP,Azure"]
+    assert expanded[1]["output"] == "out_edge_GCP,Azure"
+    assert query(expanded[1]["raw_url"])["var-platform"] == ["GCP", "Azure"]
+    assert query(expanded[3]["raw_url"])["var-termination"] == ["http"]
+    assert expanded[2]["panels"] == [{"id": 1, "alias": "RPS http", "context": "{unknown} stays"}]
+    assert all("matrix" not in each for each in expanded)
+
+def test_expand_matrix_keeps_blank_parameters():
+    expanded = expand_matrix({"raw_url": RAW_URL, "output": "out", "matrix": {"termination": ["edge"]}})
+    params = query(expanded[0]["raw_url"])
+    assert params["var-x"] == [""]
+    assert params["from"] == ["now-7d"]
+
+def test_compile_config_removes_duplicates_and_mirrors_copies():
+    config = grafana_config(
+        {"alias": "a", "raw_url": RAW_URL, "output": "out_a", "panels": [{"id": 1, "alias": "rps"}, {"id": 1, "alias": "rps"}, {"id": 2}]},
+        {"alias": "b", "raw_url": RAW_URL, "output": "out_b", "panels": [{"id": 1, "alias": "rps"}]},
+        {"alias": "c", "raw_url": RAW_URL, "output": "out_c", "panels": [{"id": 1, "width": 600}]},
+    )
+    plan = compile_config(config)
+    # The repeated panel of a is dropped, the one of b is copied from a, the narrower render of c is its own job
+    assert [(job["dashboard"]["output"], job["panel"]["id"]) for job in plan] == [("out_a", 1), ("out_a", 2), ("out_c", 1)]
+    assert plan[0]["panel"]["mirrors"] == [{"output": "out_b", "id": 1, "alias": "rps"}]
+    assert len({job["render_key"] for job in plan}) == 3
+
+def test_compile_config_keeps_credentials_out_of_the_plan():
+    config = grafana_config({"alias": "a", "raw_url": RAW_URL, "output": "out", "panels": [{"id": 1}]})
+    plan = compile_config(config)
+    assert plan[0]["grafana"] == {"alias": "dev", "url": "https://grafana", "index": 0}
+    grafana_data = plan_to_grafana_data(plan, {0: {"username": "user", "password": "secret"}})
+    assert grafana_data[0]["username"] == "user" and grafana_data[0]["password"] == "secret"
+    assert grafana_data[0]["dashboards"][0]["panels"][0]["id"] == 1
+
+def test_compile_config_skips_dashboards_without_panels():
+    assert compile_config(grafana_config({"alias": "a", "raw_url": RAW_URL, "output": "out"})) == []
+    assert compile_config({}) == []
+
+def test_load_render_plan_caches_without_credentials(tmp_path):
+    config = tmp_path / "config.yaml"
+    config.write_text("""grafana:
+  - alias: dev
+    url: https://grafana
+    username: 'user'
+    password: "p#ss: word"
+    dashboards:
+      - alias: a
+        raw_url: https://grafana/d/uid1/ingress?orgId=1
+        output: out
+        panels:
+          - id: 1
+""", encoding="utf-8")
+    cache = DiskCache(str(tmp_path / "plans"), 1 << 20)
+    plan, secrets = load_render_plan(str(config), cache)
+    assert secrets == {0: {"username": "user", "password": "p#ss: word"}}
+    cached = "".join(path.read_text(encoding="utf-8") for path in (tmp_path / "plans").rglob("*") if path.is_file())
+    assert "p#ss" not in cached and "user" not in json.dumps(json.loads(cached)["jobs"])
+
+    cached_plan, cached_secrets = load_render_plan(str(config), cache)
+    assert cached_plan == plan
+    assert cached_secrets == secrets
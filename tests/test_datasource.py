@@ -0,0 +1,61 @@
+import numpy as np
+from src.datasource import frames_to_series, read_series, write_series
+
+def response(fields: list[dict], values: list[list], entities: list | None = None, name: str = "") -> dict:
+    data = {"values": values}
+    if entities is not None:
+        data["entities"] = entities
+    return {"results": {"A": {"frames": [{"schema": {"name": name, "fields": fields}, "data": data}]}}}
+
+TIME = {"name": "Time", "type": "time"}
+
+def test_numeric_fields_become_float_series():
+    series = frames_to_series(response([TIME, {"name": "rps", "type": "number", "config": {"unit": "reqps"}}],
+                                       [[1000, 2000, 3000], [1, 2, 3]]))
+    assert len(series) == 1
+    assert series[0]["ref_id"] == "A"
+    assert series[0]["unit"] == "reqps"
+    assert series[0]["time"].dtype == np.int64
+    assert series[0]["time"].tolist() == [1000, 2000, 3000]
+    assert series[0]["values"].dtype == np.float64
+    assert series[0]["values"].tolist() == [1.0, 2.0, 3.0]
+
+def test_null_timestamps_drop_their_rows():
+    series = frames_to_series(response([TIME, {"name": "a", "type": "number"}, {"name": "b", "type": "number"}],
+                                       [[1000, None, 3000, None], [1, 2, None, 4], [5, 6, 7, 8]]))
+    assert [each_series["time"].tolist() for each_series in series] == [[1000, 3000], [1000, 3000]]
+    assert np.array_equal(series[0]["values"], [1.0, np.nan], equal_nan=True)
+    assert series[1]["values"].tolist() == [5.0, 7.0]
+
+def test_null_values_and_entities():
+    series = frames_to_series(response([TIME, {"name": "v", "type": "number"}],
+                                       [[1, 2, 3, 4], [None, 0, 0, 1]],
+                                       entities=[None, {"Inf": [1], "NegInf": [2]}]))
+    values = series[0]["values"]
+    assert np.isnan(values[0]) and values[1] == np.inf and values[2] == -np.inf and values[3] == 1.0
+
+def test_frames_without_time_and_non_numeric_fields():
+    series = frames_to_series(response([{"name": "host", "type": "string"}, {"name": "v", "type": "number"}],
+                                       [["a", "b"], [1, 2]]), default_unit="ms")
+    assert len(series) == 1
+    assert series[0]["time"] is None
+    assert series[0]["unit"] == "ms"
+
+def test_series_names_and_labels():
+    fields = [TIME,
+              {"name": "Value", "type": "number", "labels": {"version": "4.15"}},
+              {"name": "Value", "type": "number", "config": {"displayName": "p99"}}]
+    series = frames_to_series(response(fields, [[1], [1], [2]], name="latency"))
+    assert [each_series["name"] for each_series in series] == ["Value version=4.15", "p99"]
+    assert series[0]["labels"] == {"version": "4.15"}
+
+def test_failed_queries_are_skipped():
+    assert frames_to_series({"results": {"A": {"error": "bad query"}}}) == []
+
+def test_series_round_trip(tmp_path):
+    series = frames_to_series(response([TIME, {"name": "v", "type": "number"}], [[1000, 2000], [None, 2.5]]))
+    path = str(tmp_path / "panel.json")
+    write_series(series, path)
+    loaded = read_series(path)
+    assert loaded[0]["time"].tolist() == [1000, 2000]
+    assert np.array_equal(loaded[0]["values"], [np.nan, 2.5], equal_nan=True)
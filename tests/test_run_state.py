@@ -0,0 +1,71 @@
+import json
+from utils.run_state import RunState
+
+def read_lines(path) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+def test_record_appends_every_stage(tmp_path):
+    path = tmp_path / "run.state.jsonl"
+    state = RunState(str(path), resume=False)
+    state.record("a.png", "rendered", render_hash="r1")
+    state.record("a.png", "inferred", inference_hash="i1")
+    state.record("b.png", "rendered", render_hash="r2")
+    # Records are on disk before the run ends
+    assert [line["stage"] for line in read_lines(path)] == ["rendered", "inferred", "rendered"]
+    assert state.get("a.png") == {"render_hash": "r1", "inference_hash": "i1", "stage": "inferred"}
+    assert state.get("missing.png") is None
+    state.close()
+
+def test_reset_drops_earlier_fields(tmp_path):
+    state = RunState(str(tmp_path / "run.state.jsonl"), resume=False)
+    state.record("a.png", "inferred", render_hash="r1", inference_hash="i1")
+    state.record("a.png", "rendered", reset=True, render_hash="r2")
+    assert state.get("a.png") == {"render_hash": "r2", "stage": "rendered"}
+    state.close()
+
+def test_close_compacts_to_one_record_per_panel(tmp_path):
+    path = tmp_path / "run.state.jsonl"
+    state = RunState(str(path), resume=False)
+    for stage in ("rendered", "inferred", "uploaded"):
+        state.record("a.png", stage)
+    state.record("b.png", "rendered")
+    state.close()
+    assert read_lines(path) == [{"key": "a.png", "stage": "uploaded"}, {"key": "b.png", "stage": "rendered"}]
+    assert [entry.name for entry in tmp_path.iterdir()] == ["run.state.jsonl"]
+
+def test_resume_loads_the_last_record_of_every_panel(tmp_path):
+    path = tmp_path / "state" / "run.state.jsonl"
+    state = RunState(str(path), resume=False)
+    state.record("a.png", "rendered", render_hash="r1")
+    state.record("a.png", "inferred", inference_hash="i1")
+    state.record("b.png", "rendered", render_hash="r2")
+    state.close()
+
+    resumed = RunState(str(path), resume=True)
+    assert resumed.get("a.png")["stage"] == "inferred"
+    assert resumed.get("b.png") == {"render_hash": "r2", "stage": "rendered"}
+    resumed.record("b.png", "inferred", inference_hash="i2")
+    resumed.close()
+    assert RunState(str(path), resume=True).get("b.png")["stage"] == "inferred"
+
+def test_resume_skips_torn_writes(tmp_path):
+    path = tmp_path / "run.state.jsonl"
+    path.write_text('{"key": "a.png", "stage": "rendered"}\n{"key": "b.png", "sta', encoding="utf-8")
+    state = RunState(str(path), resume=True)
+    assert state.get("a.png") == {"stage": "rendered"}
+    assert state.get("b.png") is None
+    state.close()
+
+def test_resume_without_state_starts_from_scratch(tmp_path):
+    state = RunState(str(tmp_path / "run.state.jsonl"), resume=True)
+    assert state.records == {}
+    state.close()
+
+def test_starting_over_truncates_the_previous_run(tmp_path):
+    path = tmp_path / "run.state.jsonl"
+    state = RunState(str(path), resume=False)
+    state.record("a.png", "rendered")
+    state.close()
+    RunState(str(path), resume=False).close()
+    assert read_lines(path) == []
@@ -0,0 +1,190 @@
+"""On-disk content addressed cache utility."""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Build a stable cache key out of json serializable parts.
+
+    Args:
+        parts (Any): values identifying the cached content
+
+    Returns:
+        str: sha256 hex digest of the parts
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+class DiskCache:
+    """
+    Content addressed cache of files on disk with size based LRU eviction.
+    Entries are written atomically, so a cache directory can be shared by concurrent workers.
+    The modification time of an entry is its creation time and is used for expiry,
+    the access time is refreshed on every hit and is used for LRU eviction.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float | None = None, refresh: bool = False) -> None:
+        """
+        Initialize the cache.
+
+        Args:
+            directory (str): cache directory
+            max_bytes (int): maximum total size of the cache
+            max_age (float | None): maximum age of any entry in seconds, None to keep entries until evicted by size
+            refresh (bool): ignore existing entries while still storing new ones
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.refresh = refresh
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """
+        Path of an entry in the cache.
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            str: path of the entry
+        """
+        return os.path.join(self.directory, key[:2], key)
+
+    def get_file(self, key: str, ttl: float | None = None) -> str | None:
+        """
+        Look up a cached file.
+
+        Args:
+            key (str): cache key
+            ttl (float | None): maximum age of the entry in seconds for this lookup
+
+        Returns:
+            str | None: path of the cached file or None on a miss
+        """
+        if self.refresh:
+            return None
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        age = now - stat.st_mtime
+        if (ttl is not None and age > ttl) or (self.max_age is not None and age > self.max_age):
+            return None
+        os.utime(path, (now, stat.st_mtime))
+        return path
+
+    def put_file(self, key: str, src_path: str) -> str:
+        """
+        Store a copy of a file in the cache.
+
+        Args:
+            key (str): cache key
+            src_path (str): file to store
+
+        Returns:
+            str: path of the cached file
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def get_json(self, key: str, ttl: float | None = None) -> Any:
+        """
+        Look up a cached json value.
+
+        Args:
+            key (str): cache key
+            ttl (float | None): maximum age of the entry in seconds for this lookup
+
+        Returns:
+            Any: cached value or None on a miss
+        """
+        path = self.get_file(key, ttl)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def put_json(self, key: str, value: Any) -> None:
+        """
+        Store a json value in the cache.
+
+        Args:
+            key (str): cache key
+            value (Any): json serializable value
+
+        Returns:
+            None
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(tmp_path, path)
+
+    def evict(self) -> None:
+        """
+        Remove expired entries and then the least recently used ones until the cache fits in max_bytes.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith(".tmp-"):
+                    # Leftover of a crashed writer
+                    if now - stat.st_mtime > 3600:
+                        os.remove(path)
+                    continue
+                if self.max_age is not None and now - stat.st_mtime > self.max_age:
+                    os.remove(path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from cache {self.directory}")
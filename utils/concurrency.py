@@ -0,0 +1,219 @@
+"""Adaptive concurrency utility."""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# Limiters shared by every job of this process, keyed by endpoint name
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Seconds after which the best latency of an endpoint is forgotten
+LATENCY_WINDOW = 30.0
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit of a downstream endpoint.
+    The limit doubles every round trip until the endpoint pushes back, then grows by one per round trip.
+    Failures halve it and latencies above latency_tolerance times the best recent latency shrink it by backoff_ratio,
+    so the limit settles just below the point where the endpoint starts queueing requests.
+    """
+
+    def __init__(self, name: str, max_limit: int, min_limit: int = 1, initial_limit: int = 0, latency_tolerance: float = 2.0, backoff_ratio: float = 0.9, log_interval: float = 10.0) -> None:
+        """
+        Initialize the limiter.
+
+        Args:
+            name (str): endpoint name used for logging
+            max_limit (int): ceiling of the limit
+            min_limit (int): floor of the limit
+            initial_limit (int): limit to start from, 0 to start from min(max_limit, 2)
+            latency_tolerance (float): latency increase over the best recent latency treated as queueing
+            backoff_ratio (float): ratio the limit is multiplied by when the latency increases
+            log_interval (float): minimum seconds between two logged limit changes
+        """
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.log_interval = log_interval
+        self._limit = float(min(self.max_limit, max(self.min_limit, initial_limit or 2)))
+        self._slow_start = True
+        # Best latency of the current and previous windows, so a lasting change of the endpoint is picked up
+        self._min_latencies = [None, None]
+        self._window_started = time.monotonic()
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._started = time.monotonic()
+        self._last_logged = 0.0
+        self.samples = 0
+        self.failures = 0
+        self.history = [(0.0, self.limit)]
+
+    @property
+    def limit(self) -> int:
+        """
+        Current concurrency limit.
+
+        Returns:
+            int: maximum number of concurrent requests to the endpoint
+        """
+        return int(self._limit)
+
+    def acquire(self) -> None:
+        """
+        Wait until a request to the endpoint fits in the limit.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency: float, success: bool) -> None:
+        """
+        Release a request acquired with acquire and adjust the limit with its outcome.
+
+        Args:
+            latency (float): seconds the request took
+            success (bool): whether the endpoint served the request
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._update(latency, success, self._in_flight + 1)
+            self._condition.notify_all()
+
+    def observe(self, latency: float, success: bool, in_flight: int) -> None:
+        """
+        Adjust the limit with the outcome of a request whose concurrency is bounded by the caller.
+
+        Args:
+            latency (float): seconds the request took
+            success (bool): whether the endpoint served the request
+            in_flight (int): requests in flight when it completed, including itself
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._update(latency, success, in_flight)
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Hold a request slot for the duration of a call to the endpoint. Exceptions count as failures.
+
+        Returns:
+            Iterator[None]: context of the request
+        """
+        self.acquire()
+        start = time.monotonic()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.release(time.monotonic() - start, success)
+
+    def _update(self, latency: float, success: bool, in_flight: int) -> None:
+        previous = self.limit
+        now = time.monotonic()
+        self.samples += 1
+        if now - self._window_started >= LATENCY_WINDOW:
+            self._min_latencies = [self._min_latencies[1], None]
+            self._window_started = now
+        if success:
+            self._min_latencies[1] = min(latency, self._min_latencies[1] or latency)
+        else:
+            self.failures += 1
+        min_latency = min(each_latency for each_latency in self._min_latencies if each_latency is not None) if success else 0.0
+        queueing = success and latency > self.latency_tolerance * min_latency
+        if not success or queueing:
+            # A single round trip of bad samples is one signal, not one per request
+            if now - self._last_decrease >= latency:
+                self._limit = max(self.min_limit, self._limit * (0.5 if not success else self.backoff_ratio))
+                self._slow_start = False
+                self._last_decrease = now
+        elif in_flight * 2 >= self.limit:
+            # The limit only grows while it is actually used
+            self._limit = min(self.max_limit, self._limit + (1 if self._slow_start else 1 / self._limit))
+        if self.limit != previous:
+            self.history.append((now - self._started, self.limit))
+            message = f"Concurrency limit of {self.name} changed from {previous} to {self.limit} (latency {latency:.2f}s, best {min_latency:.2f}s, {'ok' if success else 'failed'})"
+            if now - self._last_logged >= self.log_interval:
+                self._last_logged = now
+                logger.info(message)
+            else:
+                logger.debug(message)
+
+    def summary(self) -> list:
+        """
+        Statistics of the limiter.
+
+        Returns:
+            list: name, ceiling, current limit, lowest and highest limit, samples, failures and limit changes over time
+        """
+        with self._condition:
+            limits = [limit for _, limit in self.history]
+            changes = self.history if len(self.history) <= 12 else self.history[:6] + [None] + self.history[-5:]
+            timeline = " ".join("..." if change is None else f"{change[0]:.0f}s:{change[1]}" for change in changes)
+            return [self.name, self.max_limit, self.limit, min(limits), max(limits), self.samples, self.failures, timeline]
+
+def configure_limiter(name: str, max_limit: int, **options) -> AdaptiveLimiter:
+    """
+    Create the limiter of an endpoint, replacing any previous one. Must be called before the workers are started.
+
+    Args:
+        name (str): endpoint name
+        max_limit (int): ceiling of the limit
+        options: other AdaptiveLimiter arguments
+
+    Returns:
+        AdaptiveLimiter: limiter of the endpoint
+    """
+    with _limiters_lock:
+        _limiters[name] = AdaptiveLimiter(name, max_limit, **options)
+        return _limiters[name]
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    """
+    Get the limiter shared by all the requests of this process to an endpoint.
+
+    Args:
+        name (str): endpoint name
+
+    Returns:
+        AdaptiveLimiter: limiter of the endpoint, a sequential one if it was never configured
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, 1)
+        return _limiters[name]
+
+def log_limiter_stats() -> None:
+    """
+    Log how the concurrency limits of this process evolved.
+
+    Returns:
+        None
+    """
+    with _limiters_lock:
+        limiters = [limiter for limiter in _limiters.values() if limiter.samples]
+    if not limiters:
+        return
+    from tabulate import tabulate
+    data = [["Endpoint", "Ceiling", "Limit", "Lowest", "Highest", "Requests", "Failures", "Limit over time"]]
+    data += [limiter.summary() for limiter in limiters]
+    logger.info(f"Adaptive concurrency limits:\n{tabulate(data, headers='firstrow', tablefmt='grid')}")
@@ -0,0 +1,250 @@
+"""Compile the grafana config into a flat, deduplicated plan of render jobs."""
+
+import re
+import hashlib
+import logging
+import itertools
+from typing import Any
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+from utils.cache import DiskCache, make_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of compiled plans changes, so plans cached by older versions are ignored
+PLAN_VERSION = 3
+
+# Keys of the grafana entries left out of the compiled plans, they are joined back from the config on every run
+SECRET_KEYS = ("username", "password")
+
+# {name} placeholders of matrix variables in aliases, outputs, panel names and contexts
+PLACEHOLDER_PATTERN = re.compile(r"\{(\w+)\}")
+
+def substitute_placeholders(value: Any, variables: dict[str, list[str]]) -> Any:
+    """
+    Replace the {name} placeholders of matrix variables in a config value.
+
+    Args:
+        value (Any): config value, only strings are substituted
+        variables (dict[str, list[str]]): values of the matrix variables of one combination
+
+    Returns:
+        Any: value with its placeholders replaced, multi-value variables joined with a comma
+    """
+    if not isinstance(value, str):
+        return value
+    return PLACEHOLDER_PATTERN.sub(lambda match: ",".join(variables[match.group(1)]) if match.group(1) in variables else match.group(0), value)
+
+def expand_matrix(each_dashboard: dict) -> list[dict]:
+    """
+    Expand a dashboard entry over every combination of the values of its matrix.
+    Each combination sets the var-<name> query parameters of the raw_url and substitutes the {name} placeholders.
+
+    Args:
+        each_dashboard (dict): dashboard entry of the config, optionally with a matrix of variable names to values
+
+    Returns:
+        list[dict]: dashboard entries without a matrix, the entry itself when it has none
+    """
+    matrix = each_dashboard.get("matrix") or {}
+    if not matrix:
+        return [each_dashboard]
+    names = list(matrix)
+    # A list as a matrix value selects several values of a multi-value variable at once
+    choices = [[[str(value) for value in each_value] if isinstance(each_value, list) else [str(each_value)] for each_value in matrix[name]] for name in names]
+    expanded = []
+    for combination in itertools.product(*choices):
+        variables = dict(zip(names, combination))
+        entry = {key: substitute_placeholders(value, variables) for key, value in each_dashboard.items() if key not in ("matrix", "panels")}
+        parsed_url = urlparse(entry["raw_url"])
+        # Blank parameters such as var-x= are kept, grafana treats them differently from missing ones
+        query_params = parse_qs(parsed_url.query, keep_blank_values=True)
+        for name, values in variables.items():
+            query_params[f"var-{name}"] = values
+        entry["raw_url"] = urlunparse(parsed_url._replace(query=urlencode(query_params, doseq=True)))
+        entry["panels"] = [{key: substitute_placeholders(value, variables) for key, value in each_panel.items()} for each_panel in each_dashboard.get("panels") or []]
+        expanded.append(entry)
+    return expanded
+
+def render_identity(each_grafana: dict, raw_url: str, each_panel: dict) -> str:
+    """
+    Key of the render request a panel entry makes, the same for entries whose images would be identical.
+
+    Args:
+        each_grafana (dict): grafana entry of the config
+        raw_url (str): dashboard url
+        each_panel (dict): panel entry of the config
+
+    Returns:
+        str: key of the render request
+    """
+    parsed_url = urlparse(raw_url)
+    d_uid = parsed_url.path.split('/')[2]
+    query_params = sorted((key, value) for key, values in parse_qs(parsed_url.query, keep_blank_values=True).items() for value in values)
+    return make_cache_key("plan", each_grafana["url"], each_grafana.get("username", ""), d_uid, query_params,
+                          each_panel.get("id", -1), each_panel.get("name", ""), str(each_panel.get("width", "1280")), str(each_panel.get("height", "720")))
+
+def compile_config(config_data: dict) -> list[dict]:
+    """
+    Compile the grafana config into a flat list of render jobs.
+    Matrices are expanded, entries repeating a render into the same output are dropped, and entries repeating a
+    render into another output become mirrors of the first one, which are copied instead of rendered again.
+
+    Args:
+        config_data (dict): grafana config
+
+    Returns:
+        list[dict]: render jobs with their grafana, dashboard and panel entries and the key of their render request.
+        The grafana entries hold the index of the entry in the config instead of its credentials
+    """
+    plan = []
+    jobs_by_render = {}
+    outputs = set()
+    panel_entries = duplicates = 0
+    for index, each_grafana in enumerate((config_data or {}).get("grafana") or []):
+        grafana_entry = {key: value for key, value in each_grafana.items() if key not in ("dashboards", *SECRET_KEYS)}
+        grafana_entry["index"] = index
+        for each_dashboard in each_grafana.get("dashboards") or []:
+            for dashboard_entry in expand_matrix(each_dashboard):
+                panels = dashboard_entry.get("panels") or []
+                dashboard_entry = {key: value for key, value in dashboard_entry.items() if key not in ("matrix", "panels")}
+                if not panels:
+                    logger.info(f"No panels specified for dashboard {dashboard_entry.get('alias', '')}. Hence skipping it")
+                    continue
+                for each_panel in panels:
+                    panel_entries += 1
+                    render_key = render_identity(each_grafana, dashboard_entry["raw_url"], each_panel)
+                    output = (dashboard_entry["output"], each_panel.get("id", -1), each_panel.get("alias") or each_panel.get("name", ""))
+                    if output in outputs:
+                        if render_key in jobs_by_render:
+                            duplicates += 1
+                            continue
+                        logger.warning(f"Panel {output[2]} of dashboard {dashboard_entry.get('alias', '')} is written to {output[0]} by several different renders")
+                    outputs.add(output)
+                    if render_key in jobs_by_render:
+                        # Same render into another output, it is copied once the first one is rendered
+                        jobs_by_render[render_key]["panel"]["mirrors"].append({"output": dashboard_entry["output"], **each_panel})
+                        duplicates += 1
+                        continue
+                    job = {"grafana": grafana_entry, "dashboard": dashboard_entry, "panel": {**each_panel, "mirrors": []}, "render_key": render_key}
+                    jobs_by_render[render_key] = job
+                    plan.append(job)
+    logger.info(f"Compiled {panel_entries} panel entries into {len(plan)} render jobs, {duplicates} duplicate renders removed")
+    return plan
+
+def grafana_secrets(config_data: dict) -> dict[int, dict]:
+    """
+    Credentials of every grafana entry of a config.
+
+    Args:
+        config_data (dict): grafana config
+
+    Returns:
+        dict[int, dict]: SECRET_KEYS values of every grafana entry, keyed by the index of the entry
+    """
+    return {index: {key: each_grafana[key] for key in SECRET_KEYS if key in each_grafana}
+            for index, each_grafana in enumerate((config_data or {}).get("grafana") or [])}
+
+def secret_spans(root: Any, text: str, secrets: dict[int, dict]) -> list[list] | None:
+    """
+    Positions of the credentials of every grafana entry in the config text, so runs reusing a compiled plan read
+    them back without parsing the whole config.
+
+    Args:
+        root (Any): root yaml node of the config
+        text (str): content of the config
+        secrets (dict[int, dict]): credentials returned by grafana_secrets
+
+    Returns:
+        list[list] | None: grafana index, key, start and end of every credential, None when some of them can't be read back from their position
+    """
+    spans = []
+    grafana = next((value for key, value in root.value if key.id == "scalar" and key.value == "grafana"), None) if root is not None and root.id == "mapping" else None
+    for index, entry in enumerate(grafana.value if grafana is not None and grafana.id == "sequence" else []):
+        for key, value in entry.value if entry.id == "mapping" else []:
+            if key.id == "scalar" and key.value in SECRET_KEYS:
+                spans.append([index, key.value, value.start_mark.index, value.end_mark.index])
+    try:
+        found = read_secrets(text, spans)
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
+    # Merge keys, anchors or multi-line scalars may not read back the same, those configs are parsed on every run
+    return spans if found == {index: values for index, values in secrets.items() if values} else None
+
+def read_secrets(text: str, spans: list[list]) -> dict[int, dict]:
+    """
+    Read the credentials of the grafana entries back from their positions in the config text.
+
+    Args:
+        text (str): content of the config
+        spans (list[list]): positions returned by secret_spans
+
+    Returns:
+        dict[int, dict]: credentials of every grafana entry, keyed by the index of the entry
+    """
+    from utils.yaml_parser import load_scalar
+    secrets = {}
+    for index, key, start, end in spans:
+        secrets.setdefault(index, {})[key] = load_scalar(text[start:end])
+    return secrets
+
+def load_render_plan(config: str, plan_cache: DiskCache | None = None) -> tuple[list[dict], dict[int, dict]]:
+    """
+    Load the render plan of a config file, parsing and compiling the config only when its content is new.
+    Credentials never reach the cache, the plan keeps their position in the config and they are read from there.
+
+    Args:
+        config (str): path to the config file
+        plan_cache (DiskCache | None): cache of compiled plans keyed by the hash of the config content
+
+    Returns:
+        tuple[list[dict], dict[int, dict]]: render jobs returned by compile_config and the credentials of every grafana entry
+    """
+    from utils.yaml_parser import load_config, parse_config, parse_config_node
+    try:
+        with open(config, "rb") as file:
+            content = file.read()
+        text = content.decode("utf-8")
+    except (OSError, UnicodeDecodeError):
+        # load_config reports the unreadable file and exits like for every other config
+        config_data = load_config(config)
+        return compile_config(config_data), grafana_secrets(config_data)
+    cache_key = make_cache_key("plan", PLAN_VERSION, hashlib.sha256(content).hexdigest())
+    cached = plan_cache.get_json(cache_key) if plan_cache is not None else None
+    if cached is not None:
+        logger.info(f"Using the render plan compiled from {config} earlier, {len(cached['jobs'])} render jobs")
+        if cached["secret_spans"] is None:
+            return cached["jobs"], grafana_secrets(parse_config(text, config))
+        return cached["jobs"], read_secrets(text, cached["secret_spans"])
+    config_data, root = parse_config_node(text, config)
+    plan = compile_config(config_data)
+    secrets = grafana_secrets(config_data)
+    if plan_cache is not None:
+        plan_cache.put_json(cache_key, {"jobs": plan, "secret_spans": secret_spans(root, text, secrets)})
+    return plan, secrets
+
+def plan_to_grafana_data(plan: list[dict], secrets: dict[int, dict]) -> list[dict]:
+    """
+    Group the render jobs of a plan back into grafana and dashboard entries, the layout the exporters consume.
+    Jobs of the same dashboard url and output are grouped under one dashboard entry, and the credentials of every
+    grafana entry are joined back.
+
+    Args:
+        plan (list[dict]): render jobs returned by compile_config
+        secrets (dict[int, dict]): credentials of every grafana entry returned by load_render_plan
+
+    Returns:
+        list[dict]: grafana entries with their dashboards and panels, like the grafana list of the config
+    """
+    grafana_data = {}
+    dashboards = {}
+    for job in plan:
+        grafana_key = job["grafana"]["index"]
+        if grafana_key not in grafana_data:
+            grafana_entry = {key: value for key, value in job["grafana"].items() if key != "index"}
+            grafana_data[grafana_key] = {**grafana_entry, **secrets.get(grafana_key, {}), "dashboards": []}
+        dashboard_key = (grafana_key, job["dashboard"]["raw_url"], job["dashboard"]["output"])
+        if dashboard_key not in dashboards:
+            dashboards[dashboard_key] = {**job["dashboard"], "panels": []}
+            grafana_data[grafana_key]["dashboards"].append(dashboards[dashboard_key])
+        dashboards[dashboard_key]["panels"].append(job["panel"])
+    return list(grafana_data.values())
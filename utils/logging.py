@@ -1,6 +1,10 @@
 """Logging utility."""
 
+import time
+import logging
 import logging.config
+from contextlib import contextmanager
+from typing import Iterator
 
 
 def configure_logging(log_level: str) -> None:
@@ -41,4 +45,22 @@ def configure_logging(log_level: str) -> None:
         },
     }
 
-    logging.config.dictConfig(log_config_dict)
\ No newline at end of file
+    logging.config.dictConfig(log_config_dict)
+
+@contextmanager
+def log_duration(logger: logging.Logger, step: str) -> Iterator[None]:
+    """
+    Log how long a step of the run took.
+
+    Args:
+        logger (logging.Logger): logger to report to
+        step (str): description of the step
+
+    Returns:
+        Iterator[None]: context of the timed step
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info(f"{step} took {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,229 @@
+"""Streaming pipeline utility."""
+
+import time
+import queue
+import logging
+import threading
+from typing import Any, Iterable, Iterator, NamedTuple
+from collections import Counter, deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+_SENTINEL = object()
+_POLL_INTERVAL = 0.05
+_BATCH_MAX_WAIT = 1.0
+
+class Stage(NamedTuple):
+    """
+    A single stage of the pipeline.
+
+    Attributes:
+        name (str): stage name used for logging
+        job (callable): job to execute as job(each_item, args)
+        args (tuple | None): arguments for the job. When None, every incoming item is an (each_item, args) pair
+        executor (Executor | None): executor for this stage. Defaults to the pipeline executor
+        batch_size (int): when above 1, the job is called with lists of up to batch_size items and returns a list of results
+        on_result (callable | None): called in the pipeline process with every result of the stage before it moves downstream
+        limiter (callable | None): called as limiter(each_item, args) to get the AdaptiveLimiter of the endpoint the job calls.
+            Jobs are held back while their endpoint is at its limit, without blocking the jobs of other endpoints
+        outcome (callable | None): classifies a result for the limiter, True if the endpoint served it, False if it failed
+            and None if it did not call the endpoint. Defaults to every result being served
+        expand (callable | None): called in the pipeline process with every result, the items it yields move downstream instead
+    """
+    name: str
+    job: callable
+    args: tuple | None
+    executor: Executor | None = None
+    batch_size: int = 1
+    on_result: callable = None
+    limiter: callable = None
+    outcome: callable = None
+    expand: callable = None
+
+def _put(out_q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """
+    Put an item on a bounded queue while honouring the stop event.
+
+    Args:
+        out_q (queue.Queue): queue to put the item on
+        item (Any): item to put
+        stop (threading.Event): event set once the pipeline is cancelled
+
+    Returns:
+        bool: True if the item was queued
+    """
+    while not stop.is_set():
+        try:
+            out_q.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _feed_source(source: Iterable, out_q: queue.Queue, stop: threading.Event) -> None:
+    """
+    Feed the source items into the first queue of the pipeline.
+
+    Args:
+        source (Iterable): source items
+        out_q (queue.Queue): first queue of the pipeline
+        stop (threading.Event): event set once the pipeline is cancelled
+
+    Returns:
+        None
+    """
+    try:
+        for item in source:
+            if not _put(out_q, item, stop):
+                return
+    except Exception as e:
+        logger.error(f"Pipeline source failed: {e}")
+    finally:
+        _put(out_q, _SENTINEL, stop)
+
+def _traced_job(stage_name: str, job: callable, each_item: Any, args: tuple | None) -> Any:
+    """
+    Run a job inside a span named after its stage. The job can annotate the span with its host, bytes or cache status.
+
+    Args:
+        stage_name (str): name of the stage of the job
+        job (callable): job to execute as job(each_item, args)
+        each_item (Any): item or batch of items of the job
+        args (tuple | None): arguments for the job
+
+    Returns:
+        Any: result of the job
+    """
+    with span(stage_name, items=len(each_item) if isinstance(each_item, list) else 1) as attributes:
+        result = job(each_item, args)
+        if result is None or (isinstance(result, list) and result and all(each_result is None for each_result in result)):
+            attributes["status"] = "error"
+        return result
+
+def _run_stage(stage: Stage, executor: Executor, in_q: queue.Queue, out_q: queue.Queue, max_in_flight: int, stop: threading.Event) -> None:
+    """
+    Submit incoming items of a stage to its executor and forward the results downstream as they complete.
+
+    Args:
+        stage (Stage): stage to run
+        executor (Executor): executor to submit the jobs to
+        in_q (queue.Queue): queue of incoming items
+        out_q (queue.Queue): queue for the results
+        max_in_flight (int): maximum number of pulled but unfinished jobs, the limiters of the stage cap them per endpoint
+        stop (threading.Event): event set once the pipeline is cancelled
+
+    Returns:
+        None
+    """
+    pending = {}
+    # Jobs ready to be submitted, held back while the endpoint they call is at its limit
+    ready = deque()
+    in_flight = Counter()
+    batch = []
+    batch_started = 0.0
+    exhausted = False
+    while (not exhausted or pending or ready or batch) and not stop.is_set():
+        # Pull new work only while there is room, this is what bounds memory upstream
+        while not exhausted and len(pending) + len(ready) < max_in_flight:
+            try:
+                item = in_q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                break
+            if item is _SENTINEL:
+                exhausted = True
+                break
+            if stage.batch_size <= 1:
+                ready.append(item if stage.args is None else (item, stage.args))
+                continue
+            if not batch:
+                batch_started = time.monotonic()
+            batch.append(item)
+            if len(batch) >= stage.batch_size:
+                ready.append((batch, stage.args))
+                batch = []
+        # A partial batch is flushed once the input is exhausted or it has waited long enough for more items
+        if batch and len(pending) + len(ready) < max_in_flight and (exhausted or time.monotonic() - batch_started >= _BATCH_MAX_WAIT):
+            ready.append((batch, stage.args))
+            batch = []
+        for _ in range(len(ready)):
+            each_item, args = ready.popleft()
+            limiter = stage.limiter(each_item, args) if stage.limiter is not None else None
+            if limiter is not None and in_flight[limiter] >= limiter.limit:
+                ready.append((each_item, args))
+                continue
+            pending[executor.submit(_traced_job, stage.name, stage.job, each_item, args)] = (time.monotonic(), limiter)
+            in_flight[limiter] += 1
+        if not pending:
+            continue
+        done, _ = wait(pending, timeout=_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+        for future in done:
+            started, limiter = pending.pop(future)
+            latency = time.monotonic() - started
+            in_flight[limiter] -= 1
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Stage {stage.name} failed with an unexpected error: {e}")
+                if limiter is not None:
+                    limiter.observe(latency, False, in_flight[limiter] + 1)
+                continue
+            results = result if stage.batch_size > 1 else [result]
+            if limiter is not None:
+                outcomes = [each_result is not None and (stage.outcome is None or stage.outcome(each_result)) for each_result in results]
+                outcomes = [each_outcome for each_outcome in outcomes if each_outcome is not None]
+                if outcomes:
+                    # A batch is one request to the endpoint, it only fails if nothing of it was served
+                    limiter.observe(latency, any(outcomes), in_flight[limiter] + 1)
+            for each_result in results:
+                if each_result is None:
+                    continue
+                try:
+                    for each_output in (stage.expand(each_result) if stage.expand is not None else [each_result]):
+                        if stage.on_result is not None:
+                            try:
+                                stage.on_result(each_output)
+                            except Exception as e:
+                                logger.error(f"Stage {stage.name} failed to handle a result: {e}")
+                        _put(out_q, each_output, stop)
+                except Exception as e:
+                    logger.error(f"Stage {stage.name} failed to expand a result: {e}")
+    _put(out_q, _SENTINEL, stop)
+
+def run_pipeline(source: Iterable, stages: list[Stage], executor: Executor, queue_size: int) -> Iterator:
+    """
+    Stream items through the stages, each item moving to the next stage as soon as its job completes.
+    Stages are connected with bounded queues so a slow stage applies backpressure instead of buffering everything.
+
+    Args:
+        source (Iterable): items to feed into the first stage, consumed lazily
+        stages (list[Stage]): stages to run the items through in order
+        executor (Executor): default executor for the stages
+        queue_size (int): size of the queues and maximum in flight jobs per stage
+
+    Returns:
+        Iterator: results of the last stage in completion order
+    """
+    queue_size = max(1, queue_size)
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_feed_source, args=(source, queues[0], stop), daemon=True, name="yoda-source")]
+    for idx, stage in enumerate(stages):
+        threads.append(threading.Thread(target=_run_stage,
+                                        args=(stage, stage.executor or executor, queues[idx], queues[idx + 1], queue_size, stop),
+                                        daemon=True,
+                                        name=f"yoda-{stage.name}"))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _SENTINEL:
+                break
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,99 @@
+"""Run state checkpoint utility."""
+
+import os
+import json
+import logging
+import tempfile
+import threading
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+class RunState:
+    """
+    Checkpoint of the stage every panel of a run has reached, along with the hashes of its inputs.
+    Records are appended to a json lines file as soon as a panel completes a stage, so an interrupted run
+    keeps everything it finished. The last record of a panel wins when the file is loaded again.
+    """
+
+    def __init__(self, path: str, resume: bool) -> None:
+        """
+        Initialize the run state.
+
+        Args:
+            path (str): run state file path
+            resume (bool): load the records of the previous run instead of starting over
+        """
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume:
+            self._load()
+            logger.info(f"Resuming from {len(self.records)} panels recorded in {path}")
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write of an interrupted run
+                        continue
+                    self.records[record.pop("key")] = record
+        except FileNotFoundError:
+            logger.info(f"No run state found at {self.path}, starting from scratch")
+
+    def get(self, key: str) -> dict | None:
+        """
+        Record of a panel.
+
+        Args:
+            key (str): panel key
+
+        Returns:
+            dict | None: stage reached and input hashes of the panel, None if it has no record
+        """
+        with self._lock:
+            record = self.records.get(key)
+            return dict(record) if record is not None else None
+
+    def record(self, key: str, stage: str, reset: bool = False, **fields: Any) -> None:
+        """
+        Record that a panel reached a stage.
+
+        Args:
+            key (str): panel key
+            stage (str): stage reached by the panel
+            reset (bool): drop the fields of earlier stages, used when the panel was produced again
+            fields (Any): json serializable input hashes and outputs of the stage
+
+        Returns:
+            None
+        """
+        with self._lock:
+            record = {} if reset else dict(self.records.get(key, {}))
+            record.update(fields)
+            record["stage"] = stage
+            self.records[key] = record
+            self._file.write(json.dumps({"key": key, **record}) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        """
+        Rewrite the state with a single record per panel.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._file.close()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".tmp-")
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                for key, record in self.records.items():
+                    file.write(json.dumps({"key": key, **record}) + "\n")
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,245 @@
+"""Tracing utility."""
+
+import os
+import json
+import math
+import time
+import glob
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Directory every process of a run appends its spans to, inherited by worker processes through the environment
+TRACE_DIR_ENV = "YODA_TRACE_DIR"
+
+# Quantiles reported per span name
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current_span = contextvars.ContextVar("yoda_span", default=None)
+_trace_file = None
+_trace_file_lock = threading.Lock()
+
+def _reset_trace_file() -> None:
+    """
+    Forget the span file inherited from the parent process, every process writes its own.
+
+    Returns:
+        None
+    """
+    global _trace_file, _trace_file_lock
+    _trace_file = None
+    _trace_file_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_trace_file)
+
+def configure_tracing(trace_dir: str) -> None:
+    """
+    Record the spans of this process and of the worker processes it starts into a directory.
+
+    Args:
+        trace_dir (str): directory to write the span files to
+
+    Returns:
+        None
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV] = trace_dir
+
+def _write_span(record: dict) -> None:
+    global _trace_file
+    trace_dir = os.environ.get(TRACE_DIR_ENV)
+    if not trace_dir:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _trace_file_lock:
+        if _trace_file is None:
+            _trace_file = open(os.path.join(trace_dir, f"spans-{os.getpid()}.jsonl"), "a", encoding="utf-8")
+        _trace_file.write(line)
+        _trace_file.flush()
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[dict]:
+    """
+    Record a span around a step of the run. Spans are only written when tracing is configured.
+
+    Args:
+        name (str): span name, spans of the same name are summarized together
+        attributes (Any): json serializable attributes such as host, panel, bytes or retries
+
+    Returns:
+        Iterator[dict]: attributes of the span, status defaults to ok and becomes error when an exception escapes
+    """
+    attributes.setdefault("status", "ok")
+    token = _current_span.set(attributes)
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException:
+        attributes["status"] = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        _current_span.reset(token)
+        _write_span({"name": name, "start": start, "duration": duration, "pid": os.getpid(), "tid": threading.get_native_id(), "attributes": attributes})
+
+def annotate_span(**attributes: Any) -> None:
+    """
+    Add attributes to the innermost span of the current thread, if any.
+
+    Args:
+        attributes (Any): json serializable attributes
+
+    Returns:
+        None
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.update(attributes)
+
+def load_spans(trace_dir: str) -> list[dict]:
+    """
+    Load the spans written by every process of a run.
+
+    Args:
+        trace_dir (str): directory the span files were written to
+
+    Returns:
+        list[dict]: spans ordered by start time
+    """
+    spans = []
+    for path in glob.glob(os.path.join(trace_dir, "spans-*.jsonl")):
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    # Torn write of a killed worker
+                    continue
+    return sorted(spans, key=lambda each_span: each_span["start"])
+
+def quantile(values: list[float], q: float) -> float:
+    """
+    Nearest rank quantile.
+
+    Args:
+        values (list[float]): sorted values
+        q (float): quantile between 0 and 1
+
+    Returns:
+        float: value at the quantile
+    """
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+def summarize_spans(spans: list[dict]) -> dict[str, dict]:
+    """
+    Aggregate the spans by name. Quantiles only cover the spans that did the work, not the cached ones.
+
+    Args:
+        spans (list[dict]): spans of the run
+
+    Returns:
+        dict[str, dict]: count, cached, errors, bytes, retries, total duration and quantiles of every span name
+    """
+    summary = {}
+    for each_span in spans:
+        attributes = each_span["attributes"]
+        entry = summary.setdefault(each_span["name"], {"count": 0, "cached": 0, "errors": 0, "bytes": 0, "retries": 0, "sum": 0.0, "durations": []})
+        entry["count"] += 1
+        entry["sum"] += each_span["duration"]
+        entry["bytes"] += attributes.get("bytes", 0) or 0
+        entry["retries"] += attributes.get("retries", 0) or 0
+        if attributes.get("status") == "cached":
+            entry["cached"] += 1
+        else:
+            entry["errors"] += attributes.get("status") == "error"
+            entry["durations"].append(each_span["duration"])
+    for entry in summary.values():
+        durations = sorted(entry.pop("durations"))
+        entry["quantiles"] = {q: quantile(durations, q) for q in QUANTILES} if durations else {}
+    return summary
+
+def log_span_summary(spans: list[dict]) -> None:
+    """
+    Log the p50/p95/p99 duration of every kind of span.
+
+    Args:
+        spans (list[dict]): spans of the run
+
+    Returns:
+        None
+    """
+    if not spans:
+        return
+    from tabulate import tabulate
+    data = [["Stage", "Spans", "Cached", "Errors", "p50 (s)", "p95 (s)", "p99 (s)", "Total (s)", "Bytes", "Retries"]]
+    for name, entry in summarize_spans(spans).items():
+        quantiles = [f"{entry['quantiles'][q]:.3f}" if entry["quantiles"] else "n/a" for q in QUANTILES]
+        data.append([name, entry["count"], entry["cached"], entry["errors"], *quantiles, f"{entry['sum']:.2f}", entry["bytes"], entry["retries"]])
+    logger.info(f"Stage timings:\n{tabulate(data, headers='firstrow', tablefmt='grid')}")
+
+def export_chrome_trace(spans: list[dict], path: str) -> None:
+    """
+    Export the spans as a Chrome trace event file, viewable in chrome://tracing or Perfetto.
+
+    Args:
+        spans (list[dict]): spans of the run
+        path (str): json file to write
+
+    Returns:
+        None
+    """
+    main_pid = os.getpid()
+    events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "yoda" if pid == main_pid else f"yoda worker {pid}"}}
+              for pid in sorted({each_span["pid"] for each_span in spans})]
+    for each_span in spans:
+        events.append({
+            "name": each_span["name"],
+            "cat": each_span["name"].split(" ")[0],
+            "ph": "X",
+            "ts": int(each_span["start"] * 1e6),
+            "dur": int(each_span["duration"] * 1e6),
+            "pid": each_span["pid"],
+            "tid": each_span["tid"],
+            "args": each_span["attributes"],
+        })
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, default=str)
+
+def _metric_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def export_openmetrics(spans: list[dict], path: str) -> None:
+    """
+    Export the per stage summary in the OpenMetrics text format.
+
+    Args:
+        spans (list[dict]): spans of the run
+        path (str): text file to write
+
+    Returns:
+        None
+    """
+    summary = summarize_spans(spans)
+    lines = ["# TYPE yoda_stage_duration_seconds summary",
+             "# UNIT yoda_stage_duration_seconds seconds",
+             "# HELP yoda_stage_duration_seconds Duration of the spans of every stage, quantiles exclude cached spans."]
+    for name, entry in summary.items():
+        stage = _metric_label(name)
+        for q, value in entry["quantiles"].items():
+            lines.append(f'yoda_stage_duration_seconds{{stage="{stage}",quantile="{q}"}} {value}')
+        lines.append(f'yoda_stage_duration_seconds_sum{{stage="{stage}"}} {entry["sum"]}')
+        lines.append(f'yoda_stage_duration_seconds_count{{stage="{stage}"}} {entry["count"]}')
+    for metric, key, description in (("yoda_stage_cached", "cached", "Spans served from a cache."),
+                                     ("yoda_stage_errors", "errors", "Spans that failed."),
+                                     ("yoda_stage_bytes", "bytes", "Bytes transferred or written by the spans."),
+                                     ("yoda_stage_retries", "retries", "Retried requests of the spans.")):
+        lines += [f"# TYPE {metric} counter", f"# HELP {metric} {description}"]
+        lines += [f'{metric}_total{{stage="{_metric_label(name)}"}} {entry[key]}' for name, entry in summary.items()]
+    lines.append("# EOF")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
@@ -1,5 +1,44 @@
+import os
+import logging
 import requests
+import threading
 import multiprocessing as mp
+from multiprocessing.util import Finalize
+from tabulate import tabulate
+from typing import Any, Iterable
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Errors raised by the http clients returned from get_grafana_session
+HTTP_ERRORS = (requests.RequestException,) if httpx is None else (requests.RequestException, httpx.HTTPError)
+
+# Keep-alive sessions shared by every job of this process, keyed by grafana host and user
+_grafana_sessions = {}
+_grafana_sessions_lock = threading.Lock()
+_grafana_session_options = {"pool_size": 10, "max_connections": 0, "http2": False}
+_grafana_session_finalizer = None
+
+def _reset_grafana_sessions() -> None:
+    """
+    Forget the sessions inherited from the parent process, their sockets can't be shared across a fork.
+
+    Returns:
+        None
+    """
+    global _grafana_sessions_lock, _grafana_session_finalizer
+    _grafana_sessions.clear()
+    _grafana_sessions_lock = threading.Lock()
+    _grafana_session_finalizer = None
+
+os.register_at_fork(after_in_child=_reset_grafana_sessions)
 
 def create_grafana_session(g_username: str, g_password: str) -> requests.Session:
     """
@@ -18,35 +57,218 @@ def create_grafana_session(g_username: str, g_password: str) -> requests.Session
     session.auth = (g_username, g_password)
     return session
 
-def multi_process(chunk: list, job: callable, args: tuple) -> None:
+def configure_grafana_sessions(pool_size: int, max_connections: int, http2: bool) -> None:
     """
-    Function to process each chunk parallely.
+    Configure the sessions handed out by get_grafana_session. Must be called before the first session is created.
 
     Args:
-        chunk (list): chunk of work to process
-        job (function): job to execute
-        args (tuple): list of arguments for the job
+        pool_size (int): number of keep-alive connections kept per grafana host
+        max_connections (int): cap on concurrent connections per grafana host, 0 for no cap
+        http2 (bool): use HTTP/2 through httpx when it is installed
+
+    Returns:
+        None
+    """
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            h2 = None
+        if httpx is None or h2 is None:
+            logger.warning("HTTP/2 requires httpx[http2] to be installed. Falling back to HTTP/1.1")
+            http2 = False
+    _grafana_session_options.update({"pool_size": max(1, pool_size), "max_connections": max(0, max_connections), "http2": http2})
+
+def grafana_http2_enabled() -> bool:
+    """
+    Whether grafana requests use HTTP/2, once configure_grafana_sessions checked that httpx[http2] is installed.
+
+    Returns:
+        bool: True when HTTP/2 is enabled
+    """
+    return _grafana_session_options["http2"]
+
+def get_grafana_session(url: str, g_username: str, g_password: str) -> Any:
+    """
+    Get the keep-alive session shared by all the requests to a grafana host.
+
+    Args:
+        url (str): any url on the grafana host
+        g_username (str): Grafana username
+        g_password (str): Grafana password
+
+    Returns:
+        Any: requests.Session or httpx.Client when HTTP/2 is enabled
+    """
+    global _grafana_session_finalizer
+    parsed_url = urlparse(url)
+    key = (parsed_url.scheme, parsed_url.netloc, g_username)
+    with _grafana_sessions_lock:
+        if key in _grafana_sessions:
+            return _grafana_sessions[key]["session"]
+
+        pool_size = _grafana_session_options["pool_size"]
+        max_connections = _grafana_session_options["max_connections"]
+        stats = {"requests": 0}
+        if _grafana_session_options["http2"]:
+            session = httpx.Client(
+                http2=True,
+                verify=False,
+                auth=(g_username, g_password),
+                timeout=None,
+                limits=httpx.Limits(max_connections=max_connections or None, max_keepalive_connections=pool_size),
+                event_hooks={"request": [lambda request: stats.update(requests=stats["requests"] + 1)]},
+            )
+        else:
+            session = create_grafana_session(g_username, g_password)
+            # A blocking pool of max_connections caps the concurrent connections to the host
+            adapter = HTTPAdapter(pool_maxsize=max_connections or pool_size, pool_block=max_connections > 0)
+            session.mount(f"{parsed_url.scheme}://", adapter)
+            session.hooks["response"].append(lambda response, *args, **kwargs: stats.update(requests=stats["requests"] + 1))
+        _grafana_sessions[key] = {"session": session, "stats": stats}
+
+        if _grafana_session_finalizer is None and mp.parent_process() is not None:
+            # Worker processes report their own connection reuse when they exit
+            _grafana_session_finalizer = Finalize(None, log_grafana_session_stats, exitpriority=10)
+        return session
+
+def grafana_session_stats() -> list[list]:
+    """
+    Connection reuse statistics of the sessions of this process.
+
+    Returns:
+        list[list]: rows of host, user, requests, connections opened and reuse ratio
+    """
+    data = []
+    with _grafana_sessions_lock:
+        for (scheme, netloc, g_username), entry in _grafana_sessions.items():
+            session = entry["session"]
+            num_requests = entry["stats"]["requests"]
+            num_connections = None
+            if isinstance(session, requests.Session):
+                pool_manager = session.get_adapter(f"{scheme}://{netloc}").poolmanager
+                num_connections = sum(pool_manager.pools[pool_key].num_connections for pool_key in pool_manager.pools.keys())
+            reuse = f"{1 - num_connections / num_requests:.0%}" if num_connections is not None and num_requests else "n/a"
+            data.append([f"{scheme}://{netloc}", g_username, num_requests, num_connections if num_connections is not None else "n/a", reuse])
+    return data
+
+def log_grafana_session_stats() -> None:
+    """
+    Log the connection reuse statistics of the sessions of this process.
 
     Returns:
         None
     """
-    manager = mp.Manager()
-    return_dict = manager.dict()
-    jobs = []
-    extended_list = []
+    data = grafana_session_stats()
+    if not data:
+        return
+    table = tabulate([["Grafana", "User", "Requests", "Connections", "Reuse"]] + data, headers="firstrow", tablefmt="grid")
+    logger.info(f"Grafana connection reuse (pid {os.getpid()}):\n{table}")
+
+def download_to_file(session: Any, url: str, path: str, chunk_size: int = 1024) -> int:
+    """
+    Stream a response body into a file.
+
+    Args:
+        session (Any): session returned by get_grafana_session
+        url (str): url to download
+        path (str): file to write the body to
+        chunk_size (int): size of the chunks to write
+
+    Returns:
+        int: number of bytes written
+    """
+    written = 0
+    if isinstance(session, requests.Session):
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            with open(path, "wb") as file:
+                for chunk in response.iter_content(chunk_size):
+                    written += file.write(chunk)
+    else:
+        with session.stream("GET", url) as response:
+            response.raise_for_status()
+            with open(path, "wb") as file:
+                for chunk in response.iter_bytes(chunk_size):
+                    written += file.write(chunk)
+    return written
+
+def create_executor(backend: str, max_workers: int, initializer: callable = None, initargs: tuple = ()) -> Executor:
+    """
+    Create a long lived executor to run jobs for the lifetime of a command.
+
+    Args:
+        backend (str): executor backend. Valid options are [thread, process]
+        max_workers (int): maximum number of workers in the pool
+        initializer (callable): called with initargs in every worker process, which starts from a fresh interpreter
+        initargs (tuple): arguments of the initializer
+
+    Returns:
+        Executor: executor to submit jobs to
+    """
+    max_workers = max(1, max_workers)
+    match backend:
+        case "thread":
+            return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yoda")
+        case "process":
+            # Workers start on the first submit, once the pipeline and http threads run. Forking then could copy
+            # locks held by those threads, so workers are forked from the single threaded fork server instead.
+            context = mp.get_context("forkserver") if "forkserver" in mp.get_all_start_methods() else None
+            return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=initializer, initargs=initargs)
+        case _:
+            raise ValueError(f"Unsupported executor backend: {backend}")
+
+def submit_jobs(executor: Executor, items: Iterable, job: callable, args: tuple) -> list[Future]:
+    """
+    Submit a job for every item to the executor without waiting for any of them.
 
-    for idx, each_item in enumerate(chunk):
-        process = mp.Process(target=job, args=(each_item, args, return_dict, idx))
-        jobs.append(process)
-        process.start()
+    Args:
+        executor (Executor): executor to submit the jobs to
+        items (Iterable): items to process
+        job (callable): job to execute as job(each_item, args)
+        args (tuple): list of arguments for the job
+
+    Returns:
+        list[Future]: futures in the order of the submitted items
+    """
+    return [executor.submit(job, each_item, args) for each_item in items]
 
-    for proc in jobs:
-        proc.join()
+def collect_results(futures: list[Future]) -> list:
+    """
+    Wait for the submitted jobs and collect their results.
+    Jobs that return None or raise are dropped from the results.
+
+    Args:
+        futures (list[Future]): futures returned by submit_jobs
 
-    extended_list = []
-    for each_value in return_dict.values():
-        extended_list.extend([each_value])
-    return extended_list
+    Returns:
+        list: results in the order of the submitted items
+    """
+    results = []
+    for future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Job failed with an unexpected error: {e}")
+            continue
+        if result is not None:
+            results.append(result)
+    return results
+
+def multi_process(items: list, job: callable, args: tuple, executor: Executor) -> list:
+    """
+    Function to process all the items parallely on the executor.
+
+    Args:
+        items (list): work to process
+        job (function): job to execute
+        args (tuple): list of arguments for the job
+        executor (Executor): executor to run the jobs on
+
+    Returns:
+        list: results of the jobs
+    """
+    return collect_results(submit_jobs(executor, items, job, args))
 
 def flatten_list(nested_list):
     """
@@ -3,9 +3,68 @@
 import sys
 import yaml
 import logging
+from typing import Any
 
 logger = logging.getLogger(__name__)
 
+# The libyaml based loader is an order of magnitude faster on large configs, it is not built into every PyYAML
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def parse_config(content: str | bytes, config: str) -> dict:
+    """
+    Parses the content of a config file
+
+    Args:
+        content (str | bytes): content of the config file
+        config (str): path to the config file, for error messages
+
+    Returns:
+        data (dict): dictionary of the config file
+    """
+    try:
+        data = yaml.load(content, Loader=SafeLoader)
+        logger.debug("The %s file has successfully loaded", config)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error("An error occurred: %s", e)
+        sys.exit(1)
+    return data
+
+def parse_config_node(content: str, config: str) -> tuple[dict, Any]:
+    """
+    Parses the content of a config file, also returning its node tree with the position of every value
+
+    Args:
+        content (str): content of the config file
+        config (str): path to the config file, for error messages
+
+    Returns:
+        tuple[dict, Any]: dictionary of the config file and its root yaml node
+    """
+    try:
+        loader = SafeLoader(content)
+        try:
+            node = loader.get_single_node()
+            data = loader.construct_document(node) if node is not None else None
+        finally:
+            loader.dispose()
+        logger.debug("The %s file has successfully loaded", config)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.error("An error occurred: %s", e)
+        sys.exit(1)
+    return data, node
+
+def load_scalar(fragment: str) -> Any:
+    """
+    Parses a single yaml value cut out of a config file
+
+    Args:
+        fragment (str): yaml text of the value
+
+    Returns:
+        Any: the value
+    """
+    return yaml.load(fragment, Loader=SafeLoader)
+
 def load_config(config: str) -> dict:
     """
     Loads config file
@@ -18,12 +77,11 @@ def load_config(config: str) -> dict:
     """
     try:
         with open(config, "r", encoding="utf-8") as file:
-            data = yaml.safe_load(file)
-            logger.debug("The %s file has successfully loaded", config)
+            content = file.read()
     except FileNotFoundError as e:
         logger.error("Config file not found: %s", e)
         sys.exit(1)
     except Exception as e:  # pylint: disable=broad-exception-caught
         logger.error("An error occurred: %s", e)
         sys.exit(1)
-    return data
\ No newline at end of file
+    return parse_config(content, config)
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into micro-batches and runs one generation per batch on a worker thread,
+    so the event loop keeps accepting connections while the model is busy.
+    """
+
+    def __init__(self, generate_batch: Callable[[list], list], max_batch_size: int = 8, max_wait: float = 0.01):
+        """
+        Args:
+            generate_batch (Callable[[list], list]): blocking function returning one result per request of a batch
+            max_batch_size (int): maximum number of requests per batch
+            max_wait (float): maximum seconds to wait for more requests once a batch has its first one
+        """
+        self.generate_batch = generate_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._queue = None
+        self._worker = None
+
+    async def start(self) -> None:
+        """
+        Start the generation worker on the running event loop.
+        """
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the generation worker, failing the requests still waiting in the queue.
+        """
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Inference server is shutting down"))
+
+    async def submit(self, request: Any) -> Any:
+        """
+        Queue a request and wait for its own result.
+
+        Args:
+            request (Any): request handed to generate_batch
+
+        Returns:
+            Any: result generated for the request
+        """
+        if self._worker is None:
+            raise RuntimeError("MicroBatcher is not started")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    async def _collect(self) -> list[tuple[Any, asyncio.Future]]:
+        """
+        Wait for a request, then gather more until the batch is full or max_wait has passed.
+        """
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                # Take whatever is already queued without waiting any longer
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            # Callers that went away no longer need a result
+            batch = [(request, future) for request, future in batch if not future.done()]
+            if not batch:
+                continue
+            logger.info(f"Running a batch of {len(batch)} requests")
+            try:
+                results = await asyncio.to_thread(self.generate_batch, [request for request, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} results, got {len(results)}")
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Inference server is shutting down"))
+                raise
+            except Exception as e:
+                logger.error(f"Batch generation failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,57 @@
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+class ImageCache:
+    """
+    Bounded LRU of decoded images keyed by the sha256 of their encoded bytes.
+    Few-shot images repeat across requests, so each one is decoded once.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max(0, max_entries)
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data: bytes) -> Image.Image:
+        """
+        Decoded RGB image of the encoded bytes, from the cache when possible.
+
+        Args:
+            data (bytes): encoded image
+
+        Returns:
+            Image.Image: decoded image, shared between requests so it must not be modified
+        """
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+        image = decode_image(data)
+        with self._lock:
+            self._images[key] = image
+            self._images.move_to_end(key)
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+        return image
+
+def decode_image(data: bytes) -> Image.Image:
+    """
+    Decode an encoded image straight from memory.
+
+    Args:
+        data (bytes): encoded image
+
+    Returns:
+        Image.Image: decoded RGB image
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        return image.convert("RGB")
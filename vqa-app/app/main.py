@@ -1,28 +1,32 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
 from typing import List
-from PIL import Image
-from transformers import MllamaForConditionalGeneration, AutoProcessor
-import torch
+from app.batching import MicroBatcher
+from app.images import ImageCache, decode_image
+from app.model import load_model
 import os
+import json
+import asyncio
 import logging
 
-app = FastAPI()
 logger = logging.getLogger(__name__)
 
-CACHE_DIR = "/app/transformers_cache"
-os.makedirs(CACHE_DIR, exist_ok=True)
-os.environ["TRANSFORMERS_OFFLINE"] = "1"
+MAX_BATCH_SIZE = int(os.environ.get("VQA_MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("VQA_MAX_BATCH_WAIT_MS", "10"))
+FEW_SHOT_CACHE_SIZE = int(os.environ.get("VQA_FEW_SHOT_CACHE_SIZE", "64"))
 
-model_id = "unsloth/Llama-3.2-11B-Vision-Instruct-bnb-4bit"
-model = MllamaForConditionalGeneration.from_pretrained(
-    model_id,
-    cache_dir=CACHE_DIR,
-    torch_dtype=torch.bfloat16,
-    revision="25bca24a9e42116fe4a687fba648124be4af45f6",
-    trust_remote_code=True,
-    device_map="auto",
-)
-processor = AutoProcessor.from_pretrained(model_id, cache_dir=CACHE_DIR)
+model = load_model()
+batcher = MicroBatcher(model.generate_batch, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT_MS / 1000)
+few_shot_image_cache = ImageCache(FEW_SHOT_CACHE_SIZE)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await batcher.start()
+    yield
+    await batcher.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.post("/v1/chat/completions")
 async def inference(
@@ -32,25 +36,20 @@ async def inference(
     few_shot_images: List[UploadFile] = File([]),
     few_shot_texts: List[str] = Form([]),
     few_shot_outputs: List[str] = Form([]),
+    stream: bool = Form(False),
 ):
-    def load_image(upload_file: UploadFile) -> Image.Image:
-        img_path = f"/tmp/{upload_file.filename}"
-        with open(img_path, "wb") as f:
-            f.write(upload_file.file.read())
-        return Image.open(img_path).convert("RGB")
-
-    if not torch.cuda.is_available():
+    if not model.available():
         return {"result": "GPU not available. Sorry cannot proceed further"}
 
     messages = []
     images = []
 
     for img_file, txt, out in zip(few_shot_images, few_shot_texts, few_shot_outputs):
-        images.append(load_image(img_file))
+        images.append(await asyncio.to_thread(few_shot_image_cache.get, await img_file.read()))
         messages.append({"role": "user", "content": [{"type": "image"}, {"type": "text", "text": txt.strip()}]})
         messages.append({"role": "assistant", "content": out.strip()})
 
-    images.append(load_image(image))
+    images.append(await asyncio.to_thread(decode_image, await image.read()))
     messages.append({
         "role": "user",
         "content": [
@@ -59,17 +58,21 @@ async def inference(
         ]
     })
 
-    input_text = processor.apply_chat_template(messages, add_generation_prompt=True)
-    inputs = processor(
-        images=[images],
-        text=input_text,
-        add_special_tokens=False,
-        return_tensors="pt"
-    ).to(model.device)
+    request = {"messages": messages, "images": images}
+    if stream:
+        return StreamingResponse(stream_tokens(request), media_type="text/event-stream")
 
-    output = model.generate(**inputs, max_new_tokens=300)
-    result = processor.decode(output[0], skip_special_tokens=True)
-    final_response = result.strip().split("assistant")[-1].strip()
-
-    torch.cuda.empty_cache()
+    # Generation runs on the batcher's worker, batched with the other requests in flight
+    final_response = await batcher.submit(request)
     return {"result": final_response}
+
+async def stream_tokens(request: dict):
+    """
+    Server-sent events carrying the generated text as soon as it is decoded, followed by [DONE].
+    """
+    tokens = model.generate_stream(request)
+    done = object()
+    while (token := await asyncio.to_thread(next, tokens, done)) is not done:
+        if token:
+            yield f"data: {json.dumps({'token': token})}\n\n"
+    yield "data: [DONE]\n\n"
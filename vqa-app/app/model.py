@@ -0,0 +1,130 @@
+import os
+import time
+import logging
+import threading
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "/app/transformers_cache"
+MODEL_ID = "unsloth/Llama-3.2-11B-Vision-Instruct-bnb-4bit"
+MODEL_REVISION = "25bca24a9e42116fe4a687fba648124be4af45f6"
+MAX_NEW_TOKENS = 300
+
+class VisionModel:
+    """
+    Llama 3.2 vision model generating a batch of chat requests per call.
+    Every request is a dict holding its chat "messages" and the "images" referenced by them.
+    """
+
+    def __init__(self):
+        # Imported here so the fake model can run on machines without torch or transformers
+        import torch
+        from transformers import MllamaForConditionalGeneration, AutoProcessor
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        os.environ["TRANSFORMERS_OFFLINE"] = "1"
+        self.torch = torch
+        self.model = MllamaForConditionalGeneration.from_pretrained(
+            MODEL_ID,
+            cache_dir=CACHE_DIR,
+            torch_dtype=torch.bfloat16,
+            revision=MODEL_REVISION,
+            trust_remote_code=True,
+            device_map="auto",
+        )
+        self.processor = AutoProcessor.from_pretrained(MODEL_ID, cache_dir=CACHE_DIR)
+        # Generation appends to the end of every row, so shorter prompts are padded on the left
+        self.processor.tokenizer.padding_side = "left"
+        # Batched and streamed generations share the GPU one at a time
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return self.torch.cuda.is_available()
+
+    def _prepare(self, requests: list[dict]):
+        texts = [self.processor.apply_chat_template(request["messages"], add_generation_prompt=True) for request in requests]
+        return self.processor(
+            images=[request["images"] for request in requests],
+            text=texts,
+            add_special_tokens=False,
+            padding=True,
+            return_tensors="pt"
+        ).to(self.model.device)
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        inputs = self._prepare(requests)
+        with self._lock:
+            try:
+                with self.torch.inference_mode():
+                    output = self.model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS)
+            finally:
+                self.torch.cuda.empty_cache()
+        results = self.processor.batch_decode(output, skip_special_tokens=True)
+        return [result.strip().split("assistant")[-1].strip() for result in results]
+
+    def generate_stream(self, request: dict) -> Iterator[str]:
+        """
+        Generate the answer of a single request, yielding text as soon as it is decoded.
+        """
+        from transformers import TextIteratorStreamer
+
+        inputs = self._prepare([request])
+        streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+        def generate() -> None:
+            with self._lock:
+                try:
+                    with self.torch.inference_mode():
+                        self.model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS, streamer=streamer)
+                except Exception as e:
+                    logger.error(f"Streamed generation failed: {e}")
+                    # Unblock the consumer of the streamer
+                    streamer.end()
+                finally:
+                    self.torch.cuda.empty_cache()
+
+        threading.Thread(target=generate, daemon=True).start()
+        yield from streamer
+
+class FakeVisionModel:
+    """
+    Stand-in model for exercising the request path on CPU-only machines.
+    A call costs a fixed latency plus a small latency per request, like a batched generate on a GPU.
+    """
+
+    def __init__(self, batch_latency: float = 0.2, request_latency: float = 0.01):
+        self.batch_latency = batch_latency
+        self.request_latency = request_latency
+
+    def available(self) -> bool:
+        return True
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        time.sleep(self.batch_latency + self.request_latency * len(requests))
+        return [self._answer(request) for request in requests]
+
+    def generate_stream(self, request: dict) -> Iterator[str]:
+        time.sleep(self.batch_latency)
+        for word in self._answer(request).split(" "):
+            time.sleep(self.request_latency)
+            yield f"{word} "
+
+    def _answer(self, request: dict) -> str:
+        prompt = request["messages"][-1]["content"][-1]["text"]
+        return f"Fake answer for {len(request['images'])} images: {prompt}"
+
+def load_model() -> VisionModel | FakeVisionModel:
+    """
+    Load the vision model, or the fake one when VQA_FAKE_MODEL=1.
+
+    Returns:
+        VisionModel | FakeVisionModel: model serving the batches
+    """
+    if os.environ.get("VQA_FAKE_MODEL") == "1":
+        logger.info("Using the fake vision model")
+        return FakeVisionModel(
+            batch_latency=float(os.environ.get("VQA_FAKE_BATCH_LATENCY", "0.2")),
+            request_latency=float(os.environ.get("VQA_FAKE_REQUEST_LATENCY", "0.01")),
+        )
+    return VisionModel()
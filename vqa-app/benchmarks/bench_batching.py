@@ -0,0 +1,104 @@
+"""
+Benchmark the micro-batching request path of the vqa-app against one
+generation per request, using the fake vision model on a CPU-only machine.
+
+Requests arrive concurrently and every generate call costs a fixed latency
+plus a small latency per request, like a batched generate on a GPU.
+
+Usage:
+    python benchmarks/bench_batching.py --requests 64 --concurrency 16
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.batching import MicroBatcher
+from app.model import FakeVisionModel
+
+def build_request(idx: int) -> dict:
+    """
+    Request shaped like the ones built by the inference handler.
+
+    Args:
+        idx (int): request number
+
+    Returns:
+        dict: chat messages and images of the request
+    """
+    return {
+        "messages": [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": f"panel {idx}"}]}],
+        "images": [None],
+    }
+
+async def run(model: FakeVisionModel, requests: int, concurrency: int, max_batch_size: int, max_wait: float) -> dict:
+    """
+    Send the requests through a MicroBatcher with bounded client concurrency.
+
+    Args:
+        model (FakeVisionModel): model serving the batches
+        requests (int): number of requests to send
+        concurrency (int): concurrent clients
+        max_batch_size (int): maximum number of requests per batch
+        max_wait (float): maximum seconds to wait for a batch to fill
+
+    Returns:
+        dict: benchmark results
+    """
+    batch_sizes = []
+
+    def generate_batch(batch: list) -> list:
+        batch_sizes.append(len(batch))
+        return model.generate_batch(batch)
+
+    batcher = MicroBatcher(generate_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+    await batcher.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def client(idx: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            result = await batcher.submit(build_request(idx))
+            latencies.append(time.perf_counter() - start)
+            assert result.endswith(f"panel {idx}"), f"request {idx} got {result}"
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(idx) for idx in range(requests)))
+    elapsed = time.perf_counter() - start
+    await batcher.stop()
+
+    latencies.sort()
+    return {
+        "max batch size": max_batch_size,
+        "batches": len(batch_sizes),
+        "mean batch": round(statistics.mean(batch_sizes), 2),
+        "elapsed (s)": round(elapsed, 3),
+        "req/s": round(requests / elapsed, 2),
+        "p50 (ms)": round(latencies[len(latencies) // 2] * 1000, 1),
+        "p95 (ms)": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=64, help="Number of requests to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--batch-sizes", default="1,4,8,16", help="Comma separated maximum batch sizes to compare")
+    parser.add_argument("--max-wait-ms", type=float, default=10, help="Maximum wait for a batch to fill in milliseconds")
+    parser.add_argument("--batch-latency", type=float, default=0.05, help="Fake model latency per generate call in seconds")
+    parser.add_argument("--request-latency", type=float, default=0.005, help="Fake model latency per request of a batch in seconds")
+    args = parser.parse_args()
+
+    model = FakeVisionModel(batch_latency=args.batch_latency, request_latency=args.request_latency)
+    rows = [asyncio.run(run(model, args.requests, args.concurrency, int(size), args.max_wait_ms / 1000)) for size in args.batch_sizes.split(",")]
+    headers = list(rows[0].keys())
+    widths = [max(len(header), *(len(str(row[header])) for row in rows)) for header in headers]
+    print("  ".join(header.rjust(width) for header, width in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(row[header]).rjust(width) for header, width in zip(headers, widths)))
+
+if __name__ == "__main__":
+    main()